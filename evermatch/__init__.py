@@ -1,9 +1,5 @@
 
-from evermatch.schemas import input_schema
-from evermatch.schemas import output_schema as solution_schema
-from evermatch.solve_code import solve
-from evermatch.action_data_cleaning import automated_data_cleaning_solve
-from evermatch.action_local_data_ingestion import data_ingestion_solve
+import importlib
 
 
 __version__ = "1.0.0"
@@ -18,7 +14,7 @@ enframe_kwargs = {
     'prepend_usage': 'minimal',
     "advanced_parameters": [  # Will not be displayed in the UI and TicDat will automatically create an
         # Advanced Parameters table in the inputs tab.
-        'Write lp File', 'Automated Data Cleaning'],
+        'Write lp File', 'Automated Data Cleaning', 'Stage Cache'],
     'input_display_names': {},
     'solution_display_names': {}
     }
@@ -45,7 +41,8 @@ enframe_output_config = {
     }
 
 params_groups = {
-    "Optimization Configuration": ['MIP Gap', 'Time Limit (sec.)']
+    "Optimization Configuration": ['Solve Mode', 'Solver Backend', 'MIP Gap', 'Time Limit (sec.)',
+                                   'Heuristic Time Budget (sec.)', 'Parallel Workers', 'Candidate Pruning Top-K']
     }
 
 enframe_parameters_config = {
@@ -55,9 +52,33 @@ enframe_parameters_config = {
     }
 
 
-enframe_ticdat_actions = {
-    "1. Data Ingestion": data_ingestion_solve,
-    "2. Automated Cleaning": automated_data_cleaning_solve
+# Attributes imported on first access (module __getattr__), so importing the package does not load TicDat, pandas or
+# the solver libraries: attribute name -> (module, name in module)
+_lazy_attributes = {
+    'input_schema': ('evermatch.schemas', 'input_schema'),
+    'solution_schema': ('evermatch.schemas', 'output_schema'),
+    'solve': ('evermatch.solve_code', 'solve'),
+    'automated_data_cleaning_solve': ('evermatch.action_data_cleaning', 'automated_data_cleaning_solve'),
+    'data_ingestion_solve': ('evermatch.action_local_data_ingestion', 'data_ingestion_solve')
     }
 
+
+def __getattr__(name):
+    if name == 'enframe_ticdat_actions':
+        value = {
+            "1. Data Ingestion": __getattr__('data_ingestion_solve'),
+            "2. Automated Cleaning": __getattr__('automated_data_cleaning_solve')
+            }
+    elif name in _lazy_attributes:
+        module, attribute = _lazy_attributes[name]
+        value = getattr(importlib.import_module(module), attribute)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted([*globals(), *_lazy_attributes, 'enframe_ticdat_actions'])
+
 # enframe_ticdat_output_actions = {"Email Reports"}
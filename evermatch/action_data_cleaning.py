@@ -8,6 +8,7 @@ Created by Aster Santana (Apr 25, 2021), Coupa Software.
 from evermatch.schemas import input_schema
 
 from evermatch import constants
+from evermatch import table_cache
 
 
 def automated_data_cleaning_solve(dat):
@@ -27,6 +28,6 @@ def automated_data_cleaning_solve(dat):
 
 
 if __name__ == "__main__":
-    _dat = input_schema.csv.create_pan_dat(constants.input_path)
+    _dat = table_cache.create_pan_dat(input_schema, constants.input_path)
     output = automated_data_cleaning_solve(_dat)
     input_schema.csv.write_directory(output["dat"], constants.input_path)
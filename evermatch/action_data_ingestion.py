@@ -6,106 +6,224 @@ Reads raw_mar29_apr3 input data from the client data source and maps it to the a
 Created by Aster Santana (Apr 25, 2021), Coupa Software.
 """
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
 from evermatch import constants
-from evermatch.schemas import input_schema
+from evermatch import table_cache
+from evermatch.indexing import intern_tables
+from evermatch.schemas import input_schema, id_domains
 from evermatch.data_maintemance import data_check
+from evermatch.utils import module_digest
+
+# Raw column name -> input schema field name, for each table. Raw columns with the same name as the field are listed
+# too, since only the listed columns are read.
+RAW_COLUMNS = {
+    'requests': {'RequestNumber': 'Request ID',
+                 'LocationID': 'Site ID',
+                 'SurgeonID': 'Surgeon ID',
+                 'ExcludeTissueReturned': 'Exclude Tissue Returned',
+                 'TissueUse': 'Tissue Use',
+                 'SrgPref_AgeMin': 'Age Min',
+                 'SrgPref_AgeMax': 'Age Max',
+                 'SrgPref_CellCountMin': 'Cell Count Min',
+                 'SrgPref_DeathToPreservationMax': 'Death to Recovery Max (hrs.)',
+                 'SrgPref_DeathToSurgeryMax': 'Death to Surgery Max (days)',
+                 'SrgPref_DeathToCooling': 'Death to Cooling Max (hrs.)',
+                 'SrgPref_ClearZone': 'Clear Zone Min',
+                 'ExcludeCancer': 'Exclude Cancer',
+                 'ExcludeDiabetes': 'Exclude Diabetes',
+                 'ExcludeLASIKScars': 'Exclude LASIK Scars',
+                 'ExcludeMatedSets': 'Exclude Mated Set',
+                 'ExcludeModerateFolds': 'Exclude Moderate Folds',
+                 'ExcludePseudophakicAphakicLens': 'Exclude Artificial Lens'},
+    'tissues': {'TissueNumber': 'Tissue ID',
+                'TissueLocationID': 'Current Site ID',
+                'Returned': 'Returned',
+                'DeathToRecovery_Hrs': 'Death to Recovery (hrs.)',
+                'DeathToToday_Days': 'Death to Surgery (days)',
+                'DeathToCoolingHours': 'Death to Cooling (hrs.)',
+                'DonorAge': 'Donor Age',
+                'CellCount': 'Cell Count',
+                'PK': 'PK',
+                'DSAEK': 'DSAEK',
+                'DMEK': 'DMEK',
+                'Diabetes': 'Diabetes',
+                'HistoryOfCancer': 'Cancer',
+                'PseudophakicAphakicLens': 'Artificial Lens',
+                'ModerateFolds': 'Moderate Folds',
+                'LASIKScar': 'LASIK Scar',
+                'ClearZone': 'Clear Zone'},
+    'locations': {'LocationID': 'Site ID',
+                  'Location': 'Hospital'},
+    'surgeons': {'SurgeonID': 'Surgeon ID',
+                 'Surgeon': 'Name'},
+    'cost_matrix': {'Origin Site ID': 'Origin Site ID',
+                    'Dest. Site ID': 'Dest. Site ID',
+                    'Transp. Cost': 'Transp. Cost'},
+    'surgeons_pref': {'Surgeon ID': 'Surgeon ID',
+                      'Tissue Use': 'Tissue Use',
+                      'Cell Count Min': 'Cell Count Min',
+                      'Age Range': 'Age Range',
+                      'Death to Recovery Max (hrs.)': 'Death to Recovery Max (hrs.)',
+                      'Death to Surgery Max (days)': 'Death to Surgery Max (days)',
+                      'Death to Cooling Max (hrs.)': 'Death to Cooling Max (hrs.)',
+                      'Tissue Origin': 'Tissue Origin'}}
+
+# Max. number of rows parsed at once from a raw file
+CHUNK_ROWS = 100_000
+
+
+def raw_dtypes(table):
+    """
+    Explicit dtypes of the raw columns of a table: categorical for IDs and other text fields, from the input schema
+    data types. The numeric fields are parsed by parse_numbers instead, so a cell that is not a valid number does not
+    fail the read and is reported by the data check.
+    :param table: Input schema table name.
+    :return: dict {raw column name: dtype}.
+    """
+    rtn = dict()
+    for raw_col, field in RAW_COLUMNS[table].items():
+        data_type = input_schema.data_types[table].get(field)
+        if data_type is None or not data_type.number_allowed or data_type.strings_allowed:
+            rtn[raw_col] = 'category'
+    return rtn
 
-import pandas as pd
+
+def parse_numbers(values):
+    """
+    Parses a raw numeric column. The cells that are not numbers (e.g. 'unknown') are kept as they are, so the data
+    check reports them as data type failures, to be fixed by the Automated Data Cleaning action.
+    :param values: Series read from a raw csv file.
+    :return: Series of int64 or float64 values, or of object values if some cells are not numbers.
+    """
+    numbers = pd.to_numeric(values, errors='coerce')
+    bad = numbers.isna() & values.notna()
+    if not bad.any():
+        return numbers
+    return numbers.astype(object).where(~bad, values.astype(object))
 
 
-def request_data(dat, requests):
-    df = requests.copy()
-    df = df.rename(columns={'RequestNumber': 'Request ID',
-                            'TissueUse': 'Tissue Use',
-                            'SurgeonID': 'Surgeon ID',
-                            'LocationID': 'Site ID',
-                            'SrgPref_AgeMin': 'Age Min',
-                            'SrgPref_AgeMax': 'Age Max',
-                            'SrgPref_CellCountMin': 'Cell Count Min',
-                            'SrgPref_DeathToPreservationMax': 'Death to Recovery Max (hrs.)',
-                            'SrgPref_DeathToSurgeryMax': 'Death to Surgery Max (days)',
-                            'SrgPref_DeathToCooling': 'Death to Cooling Max (hrs.)',
-                            'SrgPref_ClearZone': 'Clear Zone Min',
-                            'ExcludeCancer': 'Exclude Cancer',
-                            'ExcludeDiabetes': 'Exclude Diabetes',
-                            'ExcludeLASIKScars': 'Exclude LASIK Scars',
-                            'ExcludeMatedSets': 'Exclude Mated Set',
-                            'ExcludeModerateFolds': 'Exclude Moderate Folds',
-                            'ExcludePseudophakicAphakicLens': 'Exclude Artificial Lens',
-                            'ExcludeTissueReturned': 'Exclude Tissue Returned'})
-
-    dat.requests = df[[
-        'Request ID',
-        'Site ID', 'Surgeon ID', 'Exclude Tissue Returned',
-        'Tissue Use', 'Age Min', 'Age Max', 'Cell Count Min', 'Death to Recovery Max (hrs.)',
-        'Death to Surgery Max (days)', 'Death to Cooling Max (hrs.)', 'Clear Zone Min', 'Exclude Cancer',
-        'Exclude Diabetes', 'Exclude LASIK Scars', 'Exclude Mated Set', 'Exclude Moderate Folds',
-        'Exclude Artificial Lens']]
+def compact_numbers(values, data_type):
+    """
+    Casts a parsed integer column to a compact dtype when the cast is lossless: int8 for 0/1 flags and int32 for the
+    other integer fields. Columns with missing values or cells that are not numbers are not integer columns, and are
+    kept as they are.
+    :param values: Series returned by parse_numbers.
+    :param data_type: Input schema data type of the field.
+    :return: Series.
+    """
+    if data_type is None or not data_type.must_be_int or values.dtype.kind != 'i':
+        return values
+    dtype = np.int8 if 0 <= data_type.min and data_type.max <= 1 else np.int32
+    info = np.iinfo(dtype)
+    if len(values) and (values.min() < info.min or values.max() > info.max):
+        return values
+    return values.astype(dtype)
+
+
+def _parse_chunk(chunk, table, dtypes):
+    """Parses the numeric columns of a chunk of a raw table into compact dtypes."""
+    for col in chunk.columns.difference(list(dtypes)):
+        data_type = input_schema.data_types[table].get(RAW_COLUMNS[table][col])
+        chunk[col] = compact_numbers(parse_numbers(chunk[col]), data_type)
+    return chunk
+
+
+def concat_chunks(chunks):
+    """
+    Concatenates the parsed chunks of a table one column at a time. Numeric columns get the smallest common dtype of
+    their chunks, and categorical columns the union of the categories of their chunks (in order of appearance).
+    :param chunks: Non-empty list of DataFrames with the same columns.
+    :return: DataFrame with a RangeIndex.
+    """
+    if len(chunks) == 1:
+        return chunks[0].reset_index(drop=True)
+    columns = dict()
+    for col, dtype in chunks[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            values = [chunk[col] for chunk in chunks]
+            # the chunks without any value have categories of another dtype
+            empty = next((v.cat.categories[:0] for v in values if len(v.cat.categories)), None)
+            if empty is not None:
+                values = [v if len(v.cat.categories) else v.cat.set_categories(empty) for v in values]
+            columns[col] = union_categoricals(values)
+        else:
+            columns[col] = pd.concat([chunk[col] for chunk in chunks], ignore_index=True)
+    return pd.DataFrame(columns)
+
+
+def _stream_raw_table(table, path):
+    dtypes = raw_dtypes(table)
+    with pd.read_csv(path, usecols=list(RAW_COLUMNS[table]), dtype=dtypes, chunksize=CHUNK_ROWS) as reader:
+        chunks = [_parse_chunk(chunk, table, dtypes) for chunk in reader]
+    if not chunks:
+        chunks = [_parse_chunk(pd.read_csv(path, usecols=list(RAW_COLUMNS[table]), dtype=dtypes), table, dtypes)]
+    return concat_chunks(chunks)
+
+
+def read_raw_table(table, path):
+    """
+    Reads the columns of a table from a raw csv file, streaming CHUNK_ROWS rows at a time: the text columns of each
+    chunk are parsed as categoricals and its numeric columns are parsed and compacted (see compact_numbers) before the
+    next chunk is read, so the whole file is never held as text or as 64-bit columns.
+    :param table: Input schema table name.
+    :param path: Path of the raw csv file.
+    :return: DataFrame with the raw columns of RAW_COLUMNS[table].
+    """
+    return table_cache.read_file(path, lambda p: _stream_raw_table(table, p), f'raw {table}/{CHUNK_ROWS}',
+                                 module_digest('action_data_ingestion'))
+
+
+def read_raw_data(dir_path):
+    """
+    Reads the raw tables concurrently.
+    :param dir_path: Directory of the raw csv files (one per input table, named after it).
+    :return: dict {table: raw DataFrame}.
+    """
+    tables = list(RAW_COLUMNS)
+    with ThreadPoolExecutor(max_workers=min(len(tables), os.cpu_count() or 1)) as executor:
+        return dict(zip(tables, executor.map(lambda t: read_raw_table(t, os.path.join(dir_path, f'{t}.csv')), tables)))
 
+
+def _map_columns(df, table):
+    """Maps the raw columns of a table to the input schema fields, in schema order, without copying the data."""
+    fields = list(input_schema.primary_key_fields[table]) + list(input_schema.data_fields[table])
+    df = df.set_axis([RAW_COLUMNS[table].get(col, col) for col in df.columns], axis=1)
+    return df[fields]
+
+
+def request_data(dat, requests):
+    dat.requests = _map_columns(requests, 'requests')
     return dat
 
 
 def tissue_data(dat, tissues):
-    df = tissues.copy()
-    df = df.rename(columns={'TissueNumber': 'Tissue ID',
-                            'TissueLocationID': 'Current Site ID',
-                            'DeathToRecovery_Hrs': 'Death to Recovery (hrs.)',
-                            'DeathToToday_Days': 'Death to Surgery (days)',
-                            'DeathToCoolingHours': 'Death to Cooling (hrs.)',
-                            'DonorAge': 'Donor Age',
-                            'CellCount': 'Cell Count',
-                            'HistoryOfCancer': 'Cancer',
-                            'PseudophakicAphakicLens': 'Artificial Lens',
-                            'ModerateFolds': 'Moderate Folds',
-                            'LASIKScar': 'LASIK Scar',
-                            'ClearZone': 'Clear Zone'
-                            })
-
-    dat.tissues = df[['Tissue ID',
-                      'Current Site ID', 'Returned',
-                      'Death to Recovery (hrs.)', 'Death to Surgery (days)', 'Death to Cooling (hrs.)', 'Donor Age',
-                      'Cell Count', 'PK', 'DSAEK', 'DMEK', 'Diabetes', 'Cancer', 'Artificial Lens',
-                      'Moderate Folds', 'LASIK Scar', 'Clear Zone']]
+    dat.tissues = _map_columns(tissues, 'tissues')
     return dat
 
 
 def location_data(dat, locations):
-    df = locations.copy()
-    df = df.rename(columns={'LocationID': 'Site ID',
-                            'Location': 'Hospital'})
-
-    dat.locations = df[['Site ID', 'Hospital']]
+    dat.locations = _map_columns(locations, 'locations')
     return dat
 
 
 def surgeon_data(dat, surgeons):
-    df = surgeons.copy()
-    df = df.rename(columns={'SurgeonID': 'Surgeon ID',
-                            'Surgeon': 'Name'})
-
-    dat.surgeons = df[['Surgeon ID', 'Name']]
+    dat.surgeons = _map_columns(surgeons, 'surgeons')
     return dat
 
 
 def cost_matrix(dat, cost_matrix1):
-    df = cost_matrix1.copy()
-
-    dat.cost_matrix = df[['Origin Site ID',
-                          'Dest. Site ID',
-                          'Transp. Cost']]
+    dat.cost_matrix = _map_columns(cost_matrix1, 'cost_matrix')
     return dat
 
 
 def surgeons_pref(dat, surgeons_pref1):
-    df = surgeons_pref1.copy()
-
-    dat.surgeons_pref = df[['Surgeon ID',
-                            'Cell Count Min',
-                            'Age Range',
-                            'Death to Recovery Max (hrs.)',
-                            'Death to Surgery Max (days)',
-                            'Death to Cooling Max (hrs.)',
-                            'Tissue Origin']]
+    dat.surgeons_pref = _map_columns(surgeons_pref1, 'surgeons_pref')
     return dat
 
 
@@ -130,6 +248,7 @@ def data_ingestion_solve(request_df, tissue_df, location_df, surgeon_df, cost_ma
     dat = surgeon_data(dat, surgeon_df)
     dat = cost_matrix(dat, cost_matrix_df)
     dat = surgeons_pref(dat, surgeons_pref_df)
+    intern_tables(dat, id_domains)
 
     data_check(dat, input_schema)
     print('#businesslog App layers populated successfully')
@@ -138,15 +257,10 @@ def data_ingestion_solve(request_df, tissue_df, location_df, surgeon_df, cost_ma
 
 if __name__ == "__main__":
 
-    request_ = pd.read_csv(constants.raw_input_path/'requests.csv')
-    tissue_ = pd.read_csv(constants.raw_input_path / 'tissues.csv')
-    location_ = pd.read_csv(constants.raw_input_path/'locations.csv')
-    surgeon_ = pd.read_csv(constants.raw_input_path / 'surgeons.csv')
-    cost_matrix_ = pd.read_csv(constants.raw_input_path / 'cost_matrix.csv')
-    surgeons_pref_ = pd.read_csv(constants.raw_input_path / 'surgeons_pref.csv')
+    raw = read_raw_data(constants.raw_input_path)
     # parameter_ = pd.read_csv(constants.raw_input_path / 'parameters.csv')
 
-    output = data_ingestion_solve(request_, tissue_, location_, surgeon_, cost_matrix_, surgeons_pref_)["dat"]
+    output = data_ingestion_solve(raw['requests'], raw['tissues'], raw['locations'], raw['surgeons'],
+                                  raw['cost_matrix'], raw['surgeons_pref'])["dat"]
     print('#businesslog Writing data to the data base')
     input_schema.csv.write_directory(output, constants.raw_input_path)
-
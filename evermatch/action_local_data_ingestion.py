@@ -7,7 +7,9 @@ Created by Aster Santana (Apr 25, 2021), Coupa Software.
 """
 
 from evermatch import constants
-from evermatch.schemas import input_schema
+from evermatch import table_cache
+from evermatch.indexing import intern_tables
+from evermatch.schemas import input_schema, id_domains
 from evermatch.data_maintemance import data_check
 
 
@@ -21,13 +23,14 @@ def data_ingestion_solve(dat):
     print('#businesslog Executing Data Ingestion Action:')
 
     rtn = dat
+    intern_tables(dat, id_domains)
     data_check(dat, input_schema)
     print('#businesslog App layers populated successfully')
     return {"dat": rtn}
 
 
 if __name__ == "__main__":
-    _dat = input_schema.csv.create_pan_dat(constants.raw_input_path)
+    _dat = table_cache.create_pan_dat(input_schema, constants.raw_input_path)
     output = data_ingestion_solve(_dat)["dat"]
     print('#businesslog Writing data to the data base')
     input_schema.csv.write_directory(output, constants.input_path)
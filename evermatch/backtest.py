@@ -0,0 +1,275 @@
+"""
+Historical backtest: replays dated snapshots of the input data through ingestion, cleaning and solve.
+
+The snapshots directory holds one sub-directory per day (e.g. raw_mar29_apr3), processed in name order. A snapshot is
+either in the raw format of the client data source (read by action_data_ingestion) or in the input schema format (read
+by action_local_data_ingestion), and may have a parameters.csv file. Snapshots in the legacy layout of the input schema
+format (e.g. raw_mar29_apr3: 'DSEAK' header, extra columns such as 'Death Date') are normalized before they are read.
+The same parameter overrides can be applied to every day, to evaluate parameter choices.
+
+Each day runs ingestion -> automated data cleaning -> solve in a worker process, and its outputs and log are written to
+<output>/<day>/. The KPIs of the days (transportation cost, shortfall penalty, average score, solve time...) are
+aggregated into <output>/backtest_report.csv. The days are solved with the stage cache off (see stage_cache.py), so
+their solve times are measured rather than copied from a previous run.
+
+As soon as a day finishes, its KPIs are saved in <output>/state/<day>.json with a digest of its input files and
+parameter overrides. An interrupted backtest is resumed by running it again, and days whose digest is unchanged since
+the last run are skipped (failed days are run again).
+
+Usage (from the evermatch directory):
+python backtest.py ../test_evermatch/snapshots --param "Cell Count Max Violation=20%" --workers 4
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import time
+
+import numpy as np
+import pandas as pd
+
+from evermatch import action_data_cleaning
+from evermatch import action_data_ingestion
+from evermatch import action_local_data_ingestion
+from evermatch import constants
+from evermatch import solve_code
+from evermatch import stage_cache
+from evermatch import table_cache
+from evermatch.schemas import input_schema, output_schema
+from evermatch.sweep import parse_parameter_value
+from evermatch.utils import timeit
+
+REPORT_FILE = 'backtest_report.csv'
+
+# Legacy header -> input schema field name, for each table of the legacy snapshots
+LEGACY_HEADERS = {'tissues': {'DSEAK': 'DSAEK'}}
+
+# rpt_kpi_summary KPIs copied to the report
+REPORT_KPIS = ['Objective Value', 'Transportation Cost', 'Assignment Shortfall Penalty', 'MIP Gap (%)', 'Solve Time']
+
+
+def snapshot_days(snapshots_path):
+    """:return: dict {day: snapshot directory}, in name order."""
+    return {name: os.path.join(snapshots_path, name) for name in sorted(os.listdir(snapshots_path))
+            if os.path.isdir(os.path.join(snapshots_path, name))}
+
+
+def snapshot_digest(day_path, overrides):
+    """Hex digest of the csv files of a snapshot and of the parameter overrides."""
+    digest = hashlib.sha1(json.dumps(overrides, sort_keys=True, default=str).encode())
+    for name in sorted(os.listdir(day_path)):
+        if name.lower().endswith('.csv'):
+            digest.update(name.encode())
+            with open(os.path.join(day_path, name), 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+    return digest.hexdigest()
+
+
+def _is_raw_format(day_path):
+    """Whether a snapshot has the raw columns of the client data source (see action_data_ingestion.RAW_COLUMNS)."""
+    header = pd.read_csv(os.path.join(day_path, 'tissues.csv'), nrows=0).columns
+    return set(action_data_ingestion.RAW_COLUMNS['tissues']).issubset(header)
+
+
+def _schema_files(day_path):
+    """:return: dict {table: csv file path} of the input schema tables found in a snapshot."""
+    file_names = {f.lower().replace(' ', '_'): f for f in os.listdir(day_path)}
+    return {table: os.path.join(day_path, file_names[f'{table.lower()}.csv']) for table in input_schema.all_tables
+            if f'{table.lower()}.csv' in file_names}
+
+
+def _is_legacy_layout(day_path):
+    """Whether a snapshot in the input schema format has legacy headers or columns that are not input schema fields."""
+    for table, path in _schema_files(day_path).items():
+        fields = set(input_schema.primary_key_fields[table]) | set(input_schema.data_fields[table])
+        if not set(pd.read_csv(path, nrows=0).columns).issubset(fields):
+            return True
+    return False
+
+
+def read_schema_snapshot(day_path):
+    """
+    Reads a snapshot in the input schema format. A snapshot in the legacy layout is first copied to a temporary
+    directory with its legacy headers renamed (see LEGACY_HEADERS) and the columns that are not input schema fields
+    dropped, the cells being copied as text.
+    :param day_path: Snapshot directory.
+    :return: A PanDat for the input schema.
+    """
+    if not _is_legacy_layout(day_path):
+        return table_cache.create_pan_dat(input_schema, day_path)
+    print(f"#businesslog {os.path.basename(day_path)} is in the legacy layout, normalizing its headers and columns")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for table, path in _schema_files(day_path).items():
+            fields = list(input_schema.primary_key_fields[table]) + list(input_schema.data_fields[table])
+            df = pd.read_csv(path, dtype=str, keep_default_na=False).rename(columns=LEGACY_HEADERS.get(table, {}))
+            df[[field for field in fields if field in df.columns]].to_csv(os.path.join(tmp_dir, f'{table}.csv'),
+                                                                          index=False)
+        return table_cache.create_pan_dat(input_schema, tmp_dir)
+
+
+def ingest(day_path, overrides):
+    """
+    Reads a snapshot with the ingestion action of its format, and sets its parameters.
+    :param day_path: Snapshot directory.
+    :param overrides: dict {parameter name: value} overriding the parameters of the snapshot.
+    :return: A PanDat for the input schema.
+    """
+    if _is_raw_format(day_path):
+        raw = action_data_ingestion.read_raw_data(day_path)
+        dat = action_data_ingestion.data_ingestion_solve(raw['requests'], raw['tissues'], raw['locations'],
+                                                         raw['surgeons'], raw['cost_matrix'],
+                                                         raw['surgeons_pref'])['dat']
+        parameters_path = os.path.join(day_path, 'parameters.csv')
+        if os.path.exists(parameters_path):
+            dat.parameters = pd.read_csv(parameters_path, dtype=object)
+    else:
+        dat = action_local_data_ingestion.data_ingestion_solve(read_schema_snapshot(day_path))['dat']
+    if overrides:
+        params = dict(zip(dat.parameters['Parameter'], dat.parameters['Value']))
+        params.update(overrides)
+        dat.parameters = pd.DataFrame({'Parameter': list(params),
+                                       'Value': pd.Series(list(params.values()), dtype=object)})
+    return dat
+
+
+def day_kpis(dat, sln):
+    """KPIs of the solution of one day."""
+    row = {'Tissues': len(dat.tissues), 'Requests': len(dat.requests)}
+    if sln is None:
+        return {**row, 'Status': 'No solution'}
+    kpis = dict(zip(sln.rpt_kpi_summary['KPI'], sln.rpt_kpi_summary['Value']))
+    row.update({'Status': 'Solved', **{kpi: kpis.get(kpi, np.nan) for kpi in REPORT_KPIS}})
+    matching = sln.rpt_matching
+    scores = pd.concat([matching[col] for col in ['Score', 'Score - Alt. 1', 'Score - Alt. 2']]).dropna()
+    row.update({'Matched Requests': int(matching['Tissue ID'].notna().sum()), 'Assignments': len(scores),
+                'Average Score': float(scores.mean()) if len(scores) else np.nan})
+    return row
+
+
+def run_day(day, day_path, overrides, output_path):
+    """
+    Runs ingestion, cleaning and solve for one day. Runs in the worker processes.
+    :return: dict with the KPIs and stage times of the day. Errors are reported in its 'Status'.
+    """
+    out_dir = os.path.join(output_path, day)
+    os.makedirs(out_dir, exist_ok=True)
+    row, start = dict(), time()
+    with open(os.path.join(out_dir, 'log.txt'), 'w') as log, contextlib.redirect_stdout(log):
+        try:
+            stage_start = time()
+            dat = ingest(day_path, {**overrides, stage_cache.CACHE_PARAMETER: 'Off'})
+            row['Ingestion Time'] = time() - stage_start
+            stage_start = time()
+            dat = action_data_cleaning.automated_data_cleaning_solve(dat)['dat']
+            row['Cleaning Time'] = time() - stage_start
+            stage_start = time()
+            sln = solve_code.solve(dat)
+            row['Solve Stage Time'] = time() - stage_start
+            row.update(day_kpis(dat, sln))
+            if sln is not None:
+                output_schema.csv.write_directory(sln, out_dir)
+        except Exception as e:
+            traceback.print_exc(file=log)
+            row['Status'] = f'Error: {e!r}'
+    row['Day Time'] = time() - start
+    return row
+
+
+def _load_state(state_path, day):
+    try:
+        with open(os.path.join(state_path, f'{day}.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_state(state_path, day, digest, row):
+    """Saves the KPIs of a day. The file is replaced atomically, so an interrupted run leaves no partial state."""
+    os.makedirs(state_path, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=state_path, suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'digest': digest, 'row': row}, f, default=lambda v: v.item() if hasattr(v, 'item') else str(v))
+    os.replace(tmp_path, os.path.join(state_path, f'{day}.json'))
+
+
+@timeit
+def backtest(snapshots_path, output_path, overrides=None, workers=None, force=False):
+    """
+    Replays the daily snapshots of a directory.
+    :param snapshots_path: Directory with one snapshot directory per day.
+    :param output_path: Directory of the report, the state and the outputs of each day.
+    :param overrides: Optional dict {parameter name: value} overriding the parameters of every day.
+    :param workers: Number of worker processes. Defaults to the number of cores.
+    :param force: Whether to run the days whose inputs and parameters are unchanged since the last run.
+    :return: DataFrame with one row per day: its KPIs and stage times.
+    """
+    overrides = overrides or dict()
+    state_path = os.path.join(output_path, 'state')
+    days = snapshot_days(snapshots_path)
+    digests = {day: snapshot_digest(day_path, overrides) for day, day_path in days.items()}
+    rows, pending = dict(), list()
+    for day in days:
+        state = None if force else _load_state(state_path, day)
+        if state is not None and state['digest'] == digests[day] and not state['row']['Status'].startswith('Error'):
+            rows[day] = {**state['row'], 'Skipped': True}
+        else:
+            pending.append(day)
+    print(f"#businesslog Backtesting {len(pending)} days ({len(days) - len(pending)} unchanged days skipped)")
+    if pending:
+        workers = min(workers or os.cpu_count() or 1, len(pending))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run_day, day, days[day], overrides, output_path): day for day in pending}
+            for future in as_completed(futures):
+                day = futures[future]
+                rows[day] = row = future.result()
+                _save_state(state_path, day, digests[day], row)
+                rows[day]['Skipped'] = False
+                print(f"#businesslog {day}: {row['Status']} in {row['Day Time']:.1f} seconds")
+    report = pd.DataFrame([{'Day': day, **rows[day]} for day in days])
+    os.makedirs(output_path, exist_ok=True)
+    report.to_csv(os.path.join(output_path, REPORT_FILE), index=False)
+    return report
+
+
+def summary(report):
+    """Totals and averages of the KPIs over the solved days."""
+    solved = report[report['Status'] == 'Solved']
+    rtn = {'Days': len(report), 'Solved Days': len(solved)}
+    for col in ['Transportation Cost', 'Assignment Shortfall Penalty', 'Objective Value']:
+        if col in solved:
+            rtn[f'Total {col}'] = solved[col].sum()
+    for col in ['Average Score', 'Solve Time', 'Day Time']:
+        if col in solved:
+            rtn[f'Mean {col}'] = solved[col].mean()
+    return rtn
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Replay daily snapshots through ingestion, cleaning and solve.')
+    parser.add_argument('snapshots', help='Directory with one snapshot directory per day.')
+    parser.add_argument('--output', default=str(constants.output_path.parent / 'backtest'))
+    parser.add_argument('--param', action='append', default=[], metavar='"NAME=VALUE"',
+                        help='Parameter override applied to every day. Repeat for each parameter.')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help='Also run the unchanged days.')
+    args = parser.parse_args(args)
+    overrides = dict()
+    for item in args.param:
+        name, _, value = item.partition('=')
+        overrides[name.strip()] = parse_parameter_value(name.strip(), value.strip())
+    report = backtest(args.snapshots, args.output, overrides, args.workers, args.force)
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(report)
+    for name, value in summary(report).items():
+        print(f'#businesslog {name}: {value}')
+    print(f"#businesslog Backtest report written to {os.path.join(args.output, REPORT_FILE)}")
+
+
+if __name__ == "__main__":
+    main()
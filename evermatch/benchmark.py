@@ -0,0 +1,397 @@
+"""
+Scalable synthetic benchmark of the solve pipeline, with per-stage timing.
+
+Synthetic instances are drawn from a reference input dataset (raw_data by default), with the number of tissues,
+requests, sites and surgeons set independently:
+- Tissue and request attribute rows (tissue use mix, age and cell count ranges, death-to-X windows, flags) are
+  resampled from the valid rows of the reference tables, so the joint distribution of the attributes is preserved.
+- Tissues sit at a few origin sites (eye banks) and requests at destination sites, in the same tissues per origin site
+  and requests per destination site ratios as the reference. Requests are spread over surgeons the same way.
+- The cost matrix covers the same share of the origin x destination site pairs as the reference, with resampled costs,
+  and the surgeon preferences cover the same share of the (surgeon, tissue use) pairs, with resampled weights.
+
+Each stage of the solve (data check, candidate matches, parameters, soft requirement coefficients, model build, solve
+and output population) is timed separately, over a series of scale factors applied to some or all of the sizes. The
+results are written to a json file, with the scaling exponent of each stage (slope of log(time) over log(scale
+factor)) and the package import times, and compared to a stored baseline to flag the stages that got slower.
+
+Usage (from the evermatch directory):
+python benchmark.py --sizes 1000 800 200 300 --factors 1 2 4 --scale tissues requests --save-baseline
+python benchmark.py --sizes 1000 800 200 300 --factors 1 2 4 --scale tissues requests
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import warnings
+from functools import wraps
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+import evermatch.data_maintemance as data_maintenance
+import evermatch.optimization as optimization
+from evermatch import constants
+from evermatch import scoring
+from evermatch import table_cache
+from evermatch import validation
+from evermatch.opt_data import OptInputData, OptOutputData
+from evermatch.schemas import input_schema
+
+SIZE_NAMES = ['tissues', 'requests', 'sites', 'surgeons']
+
+# Tissue use names of the raw data that map to a tissue use of the input schema
+TISSUE_USE_ALIASES = {'PKP': 'PK'}
+
+# OptInputData steps timed as stages of their own
+OPT_INPUT_STAGES = ['intern_ids', 'get_candidate_matches', 'populate_parameters', 'soft_requirement_coefficients']
+
+STAGES = ['data_check', 'remove_inactive_records', *OPT_INPUT_STAGES, 'build_model', 'solve', 'populate_output']
+
+# Slowdowns smaller than this (in seconds) are not regressions, since the timing of fast stages is mostly noise
+MIN_REGRESSION_SECONDS = 0.05
+
+# Statements whose time is measured in a fresh interpreter (package import and startup costs)
+IMPORT_STATEMENTS = {
+    'import evermatch': 'import evermatch',
+    'input_schema': 'from evermatch import input_schema',
+    'solve': 'from evermatch import solve'}
+
+
+# region Synthetic instances
+def reference_profile(dat):
+    """
+    Derives the distributions of the synthetic instances from a reference input dataset.
+    :param dat: A PanDat for the input schema. Rows with data type failures are ignored.
+    :return: dict with the valid attribute rows of the tissues, requests and surgeon preferences, the transportation
+    costs and the site, surgeon and cost matrix ratios.
+    """
+    tissues, requests, cost_matrix, surgeons_pref = (
+        _valid_rows(dat, table) for table in ['tissues', 'requests', 'cost_matrix', 'surgeons_pref'])
+    n_origins = max(tissues['Current Site ID'].nunique(), 1)
+    n_dests = max(requests['Site ID'].nunique(), 1)
+    n_surgeons = max(requests['Surgeon ID'].nunique(), 1)
+    cost_pairs = cost_matrix['Origin Site ID'].nunique() * cost_matrix['Dest. Site ID'].nunique()
+    pref_pairs = surgeons_pref['Surgeon ID'].nunique() * len(input_schema.data_types['requests']['Tissue Use']
+                                                             .strings_allowed)
+    return {
+        'tissues': tissues.drop(columns=['Tissue ID', 'Current Site ID']).reset_index(drop=True),
+        'requests': requests.drop(columns=['Request ID', 'Site ID', 'Surgeon ID']).reset_index(drop=True),
+        'weights': surgeons_pref[scoring.SCORE_FIELDS].reset_index(drop=True),
+        'costs': cost_matrix['Transp. Cost'].to_numpy(),
+        'parameters': dat.parameters.copy(),
+        'tissues_per_origin': len(tissues) / n_origins,
+        'requests_per_dest': len(requests) / n_dests,
+        'requests_per_surgeon': len(requests) / n_surgeons,
+        'cost_density': len(cost_matrix) / cost_pairs if cost_pairs else 1.0,
+        'pref_density': len(surgeons_pref) / pref_pairs if pref_pairs else 1.0}
+
+
+def _valid_rows(dat, table):
+    """Rows of a table of dat without data type failures, with the raw tissue use names mapped to the schema ones."""
+    df = getattr(dat, table)
+    if 'Tissue Use' in df.columns:
+        df = df.assign(**{'Tissue Use': df['Tissue Use'].replace(TISSUE_USE_ALIASES)})
+    data_type_failures, _, _ = validation.find_failures(input_schema.PanDat(**{table: df}), input_schema)
+    bad = pd.Index([])
+    for table_field, failed in data_type_failures.items():
+        if table_field.table == table:
+            bad = bad.union(failed.index)
+    return df.drop(index=bad)
+
+
+def synthetic_instance(n_tissues, n_requests, n_sites, n_surgeons, profile, seed=0, params=None):
+    """
+    Draws a synthetic input dataset.
+    :param n_tissues: Number of tissues.
+    :param n_requests: Number of requests.
+    :param n_sites: Number of locations. Tissues and requests sit at a subset of them (see reference_profile).
+    :param n_surgeons: Number of surgeons. Requests are assigned to a subset of them.
+    :param profile: Distributions of the instance (see reference_profile).
+    :param seed: Seed of the random generator.
+    :param params: Optional parameters (name: value) overriding the reference ones.
+    :return: A PanDat for the input schema.
+    """
+    rng = np.random.default_rng(seed)
+    site_ids = np.array([str(k) for k in range(1, n_sites + 1)], dtype=object)
+    surgeon_ids = np.array([str(k) for k in range(1, n_surgeons + 1)], dtype=object)
+    origins = rng.choice(site_ids, _subset_size(n_tissues / profile['tissues_per_origin'], n_sites), replace=False)
+    dests = rng.choice(site_ids, _subset_size(n_requests / profile['requests_per_dest'], n_sites), replace=False)
+    active_surgeons = rng.choice(surgeon_ids, _subset_size(n_requests / profile['requests_per_surgeon'], n_surgeons),
+                                 replace=False)
+
+    locations = pd.DataFrame({'Site ID': site_ids, 'Hospital': [f'Hospital {k}' for k in site_ids]})
+    surgeons = pd.DataFrame({'Surgeon ID': surgeon_ids, 'Name': [f'Surgeon {k}' for k in surgeon_ids]})
+    # cost matrix: a random share of the origin x destination pairs
+    origin, dest = (a.ravel() for a in np.meshgrid(origins, dests, indexing='ij'))
+    keep = rng.random(len(origin)) < profile['cost_density']
+    cost_matrix = pd.DataFrame({'Origin Site ID': origin[keep], 'Dest. Site ID': dest[keep],
+                                'Transp. Cost': rng.choice(profile['costs'], int(keep.sum()))})
+    tissues = _resample(profile['tissues'], n_tissues, rng)
+    tissues.insert(0, 'Tissue ID', [f'W{k:08d}' for k in range(n_tissues)])
+    tissues.insert(1, 'Current Site ID', rng.choice(origins, n_tissues))
+    requests = _resample(profile['requests'], n_requests, rng)
+    requests.insert(0, 'Request ID', [f'H{k:08d}' for k in range(n_requests)])
+    requests.insert(1, 'Site ID', rng.choice(dests, n_requests))
+    requests.insert(2, 'Surgeon ID', rng.choice(active_surgeons, n_requests))
+    # surgeon preferences: a random share of the (surgeon, tissue use) pairs
+    tissue_uses = input_schema.data_types['requests']['Tissue Use'].strings_allowed
+    surgeon, tissue_use = (a.ravel() for a in np.meshgrid(active_surgeons, tissue_uses, indexing='ij'))
+    keep = rng.random(len(surgeon)) < profile['pref_density']
+    surgeons_pref = _resample(profile['weights'], int(keep.sum()), rng)
+    surgeons_pref.insert(0, 'Surgeon ID', surgeon[keep])
+    surgeons_pref.insert(1, 'Tissue Use', tissue_use[keep])
+
+    parameters = profile['parameters'].set_index('Parameter')['Value'].to_dict()
+    parameters.update(params or {})
+    parameters = pd.DataFrame({'Parameter': list(parameters), 'Value': list(parameters.values())})
+    return input_schema.PanDat(parameters=parameters, locations=locations, surgeons=surgeons, cost_matrix=cost_matrix,
+                               tissues=tissues, requests=requests, surgeons_pref=surgeons_pref)
+
+
+def _subset_size(expected, n):
+    return int(min(max(round(expected), 1), n))
+
+
+def _resample(df, n, rng):
+    return df.iloc[rng.integers(0, len(df), n)].reset_index(drop=True)
+# endregion
+
+
+# region Stage timing
+@contextlib.contextmanager
+def _timed_methods(cls, names, timings):
+    """Records the execution time of the methods names of cls in timings while the context is active."""
+    originals = {name: cls.__dict__[name] for name in names}
+
+    def timed(name, method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                timings[name] = timings.get(name, 0.0) + perf_counter() - start
+        return wrapper
+
+    try:
+        for name, method in originals.items():
+            setattr(cls, name, timed(name, method))
+        yield
+    finally:
+        for name, method in originals.items():
+            setattr(cls, name, method)
+
+
+def run_stages(dat, backend=None):
+    """
+    Runs the solve pipeline (see solve_code.solve) on the monolithic model, timing each stage. The logs of the
+    pipeline are suppressed.
+    :param dat: A good PanDat for the input schema. Inactive records are removed in place.
+    :param backend: Solver backend name (a key of optimization.SOLVER_BACKENDS). Defaults to the 'Solver Backend'
+    parameter.
+    :return: dict with the time of each stage (in seconds), the number of candidate pairs and the solution status and
+    objective value.
+    """
+    timings = dict()
+
+    def stage(name, func, *args):
+        start = perf_counter()
+        rtn = func(*args)
+        timings[name] = perf_counter() - start
+        return rtn
+
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        stage('data_check', data_maintenance.data_check, dat, input_schema)
+        stage('remove_inactive_records', data_maintenance.remove_inactive_records, dat)
+        params = input_schema.create_full_parameters_dict(dat)
+        with _timed_methods(OptInputData, OPT_INPUT_STAGES, timings):
+            opt_input_dat = OptInputData(dat)
+        opt_model = stage('build_model', optimization.build_optimization_model, opt_input_dat, params, backend)
+        stage('solve', opt_model.optimize)
+        model_sln = opt_model.model_sln
+        if model_sln:
+            stage('populate_output', lambda: OptOutputData(model_sln, params).populate_output_schema(
+                dat, opt_input_dat.cost_index))
+    return {'stages': {name: round(timings[name], 4) for name in STAGES if name in timings},
+            'total': round(sum(timings.values()), 4),
+            'n_candidates': len(opt_input_dat.edges),
+            'status': model_sln['status'] if model_sln else None,
+            'obj_val': model_sln['obj_val'] if model_sln else None}
+
+
+def run_benchmark(sizes, factors, scaled, profile, seed=0, repeat=1, backend=None, params=None, warm_cache=False):
+    """
+    Times the solve stages over a series of instance sizes.
+    :param sizes: dict {size name (see SIZE_NAMES): base size}.
+    :param factors: Scale factors of the series.
+    :param scaled: Size names multiplied by the scale factors. The other sizes stay at their base value.
+    :param profile: Distributions of the instances (see reference_profile).
+    :param seed: Seed of the instances.
+    :param repeat: Number of runs per instance. The fastest time of each stage is kept.
+    :param backend: Solver backend name. Defaults to the 'Solver Backend' parameter.
+    :param params: Optional parameters (name: value) of the instances.
+    :param warm_cache: Whether to use the on-disk cache (constants.cache_path) as is. By default each run gets an
+    empty cache, so the timings do not depend on previous runs.
+    :return: dict with the runs and the scaling exponents (see scaling_exponents), ready to be saved as json.
+    """
+    runs = list()
+    for factor in factors:
+        run_sizes = {name: int(round(size * factor)) if name in scaled else size for name, size in sizes.items()}
+        print(f"#businesslog Benchmarking {', '.join(f'{v} {k}' for k, v in run_sizes.items())}...")
+        results = list()
+        for _ in range(repeat):
+            dat = synthetic_instance(*[run_sizes[name] for name in SIZE_NAMES], profile, seed=seed, params=params)
+            with _cache_dir(warm_cache):
+                results.append(run_stages(dat, backend))
+        rtn = results[0]
+        rtn['stages'] = {name: min(r['stages'][name] for r in results) for name in rtn['stages']}
+        rtn['total'] = round(sum(rtn['stages'].values()), 4)
+        runs.append({'factor': factor, 'sizes': run_sizes, **rtn})
+        print(f"#businesslog {rtn['n_candidates']} candidates, total {rtn['total']:.2f} seconds")
+    return {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'machine': platform.machine(), 'backend': backend, 'seed': seed,
+            'scaled': list(scaled), 'imports': import_times(), 'runs': runs, 'scaling': scaling_exponents(runs)}
+
+
+def import_times(repeat=5):
+    """
+    Times the statements of IMPORT_STATEMENTS, each in a fresh interpreter.
+    :param repeat: Number of runs per statement. The fastest time is kept.
+    :return: dict {statement name: time in seconds}.
+    """
+    root = Path(__file__).resolve().parent.parent
+    rtn = dict()
+    for name, statement in IMPORT_STATEMENTS.items():
+        code = f'import time; start = time.perf_counter(); {statement}; print(time.perf_counter() - start)'
+        rtn[name] = round(min(float(subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True,
+                                                   text=True, check=True).stdout) for _ in range(repeat)), 4)
+    return rtn
+
+
+@contextlib.contextmanager
+def _cache_dir(warm_cache):
+    if warm_cache:
+        yield
+        return
+    cache_path = constants.cache_path
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        constants.cache_path = Path(tmp_dir)
+        try:
+            yield
+        finally:
+            constants.cache_path = cache_path
+
+
+def scaling_exponents(runs):
+    """
+    :param runs: Benchmark runs (see run_benchmark).
+    :return: dict {stage: slope of log(time) over log(scale factor)} - about 1 for a stage that scales linearly with
+    the scaled sizes, 2 for a quadratic one. Empty if there are less than two scale factors.
+    """
+    factors = np.array([run['factor'] for run in runs], dtype=float)
+    if len(np.unique(factors)) < 2:
+        return dict()
+    rtn = dict()
+    for name in [*STAGES, 'total']:
+        times = np.array([run['stages'].get(name, np.nan) if name != 'total' else run['total'] for run in runs])
+        if np.all(times > 0):
+            rtn[name] = round(float(np.polyfit(np.log(factors), np.log(times), 1)[0]), 2)
+    return rtn
+# endregion
+
+
+# region Baseline comparison
+def compare_to_baseline(results, baseline, tolerance=0.25, min_seconds=MIN_REGRESSION_SECONDS):
+    """
+    Compares the stage timings of benchmark results to a baseline, run by run (runs are matched by their sizes), and
+    the import times.
+    :param results: Benchmark results (see run_benchmark).
+    :param baseline: Benchmark results of the baseline.
+    :param tolerance: Relative slowdown above which a stage is a regression.
+    :param min_seconds: Absolute slowdown (in seconds) under which a stage is not a regression.
+    :return: DataFrame with one row per compared (run, stage): sizes, stage, baseline and current time, ratio and
+    whether it is a regression. Import times have no sizes.
+    """
+    baseline_runs = {json.dumps(run['sizes'], sort_keys=True): run for run in baseline['runs']}
+    rows = list()
+
+    def compare(sizes, name, base_time, time):
+        if base_time is None or time is None:
+            return
+        rows.append({'sizes': sizes, 'stage': name, 'baseline': base_time, 'current': time,
+                     'ratio': round(time / base_time, 2) if base_time else np.nan,
+                     'regression': time > (1 + tolerance) * base_time and time - base_time >= min_seconds})
+
+    for name, time in results.get('imports', dict()).items():
+        compare('', name, baseline.get('imports', dict()).get(name), time)
+    for run in results['runs']:
+        base_run = baseline_runs.get(json.dumps(run['sizes'], sort_keys=True))
+        if base_run is None:
+            continue
+        for name in [*STAGES, 'total']:
+            compare(' '.join(str(run['sizes'][k]) for k in SIZE_NAMES), name,
+                    base_run['total'] if name == 'total' else base_run['stages'].get(name),
+                    run['total'] if name == 'total' else run['stages'].get(name))
+    return pd.DataFrame(rows, columns=['sizes', 'stage', 'baseline', 'current', 'ratio', 'regression'])
+# endregion
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Synthetic benchmark of the solve stages.')
+    parser.add_argument('--sizes', type=int, nargs=4, default=[1000, 800, 200, 300], metavar=('TISSUES', 'REQUESTS',
+                        'SITES', 'SURGEONS'), help='Base instance sizes.')
+    parser.add_argument('--factors', type=float, nargs='+', default=[1, 2, 4], help='Scale factors.')
+    parser.add_argument('--scale', nargs='+', choices=SIZE_NAMES, default=SIZE_NAMES,
+                        help='Sizes multiplied by the scale factors.')
+    parser.add_argument('--reference', type=Path, default=constants.raw_input_path,
+                        help='Directory of the reference input data.')
+    parser.add_argument('--backend', choices=list(optimization.SOLVER_BACKENDS), default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--warm-cache', action='store_true', help='Use the on-disk cache of previous runs.')
+    parser.add_argument('--output', type=Path, default=constants.benchmark_path / 'results.json')
+    parser.add_argument('--baseline', type=Path, default=constants.benchmark_path / 'baseline.json')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Relative slowdown flagged as a regression.')
+    args = parser.parse_args(args)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        reference = table_cache.create_pan_dat(input_schema, args.reference)
+    profile = reference_profile(reference)
+    results = run_benchmark(dict(zip(SIZE_NAMES, args.sizes)), args.factors, args.scale, profile, seed=args.seed,
+                            repeat=args.repeat, backend=args.backend, warm_cache=args.warm_cache)
+    stages = pd.DataFrame([{**run['sizes'], **run['stages'], 'total': run['total']} for run in results['runs']])
+    print(f"\n{stages.to_string(index=False)}\n")
+    print(f"#businesslog Import times: {results['imports']}")
+    print(f"#businesslog Scaling exponents: {results['scaling']}")
+    for path in [args.output, args.baseline] if args.save_baseline else [args.output]:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'#businesslog Results written to {path}')
+    if args.save_baseline or not args.baseline.exists():
+        return 0
+    with open(args.baseline) as f:
+        comparison = compare_to_baseline(results, json.load(f), args.tolerance)
+    print(f"\n{comparison.to_string(index=False)}\n")
+    regressions = comparison[comparison['regression']]
+    if len(regressions):
+        print(f"#businesslog {len(regressions)} stages are slower than the baseline: "
+              f"{', '.join(regressions['stage'] + ' (' + regressions['sizes'] + ')')}")
+        return 1
+    print('#businesslog No regression against the baseline')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
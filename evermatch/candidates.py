@@ -0,0 +1,193 @@
+"""
+Candidate generation for the Ever Sight matching problem.
+
+Finds every (tissue, request) pair that passes the hard requirements without materializing the full tissue x request
+cross join:
+- Requests are partitioned by tissue use and exclusion flags. Every request in a partition is compatible with the same
+  subset of tissues, which is found with one vectorized pass over the tissues table.
+- Within a partition, each range requirement (donor age, cell count, clear zone and the death-to-X windows) is turned
+  into an interval over the tissues sorted by that attribute. Each request expands only its narrowest interval, and the
+  resulting pairs are checked against the full set of requirements.
+"""
+
+import numpy as np
+import pandas as pd
+
+VIOLATION_LEVELS = {'0%': 0, '5%': 0.05, '10%': 0.1, '20%': 0.2, '30%': 0.3}
+
+# Parameters setting the violation level of each range requirement (see violation_factors)
+VIOLATION_PARAMETERS = ['Cell Count Max Violation', 'Age Range Max Violation', 'Death to Recovery Max Violation',
+                        'Death to Surgery Max Violation', 'Death to Cooling Max Violation']
+
+TISSUE_USES = ['PK', 'DSAEK', 'DMEK']
+
+# (tissue flag, request exclusion flag)
+EXCLUSION_FLAGS = [
+    ('Returned', 'Exclude Tissue Returned'),
+    ('Cancer', 'Exclude Cancer'),
+    ('Diabetes', 'Exclude Diabetes'),
+    ('LASIK Scar', 'Exclude LASIK Scars'),
+    ('Moderate Folds', 'Exclude Moderate Folds'),
+    ('Artificial Lens', 'Exclude Artificial Lens')]
+
+# Max. number of pairs expanded at once before filtering
+CHUNK_SIZE = 2_000_000
+
+
+def violation_factors(params):
+    """
+    Maps the '* Max Violation' parameters to their numeric level.
+    :param params: Full parameters dictionary.
+    :return: dict {requirement: violation level}
+    """
+    return {
+        'Cell Count': VIOLATION_LEVELS[params['Cell Count Max Violation']],
+        'Age Range': VIOLATION_LEVELS[params['Age Range Max Violation']],
+        'Death to Recovery': VIOLATION_LEVELS[params['Death to Recovery Max Violation']],
+        'Death to Surgery': VIOLATION_LEVELS[params['Death to Surgery Max Violation']],
+        'Death to Cooling': VIOLATION_LEVELS[params['Death to Cooling Max Violation']]}
+
+
+def _range_requirements(tissues, requests, violation):
+    """
+    Lists the range requirements as (tissue values, request lower bounds, request upper bounds). A missing bound is
+    None. Bounds are computed exactly as in the pairwise filter so comparisons are bit-for-bit identical.
+    """
+    def t_col(col):
+        return tissues[col].to_numpy()
+
+    def r_col(col):
+        return requests[col].to_numpy()
+
+    return [
+        (t_col('Donor Age'),
+         (1 - violation['Age Range']) * r_col('Age Min'), (1 + violation['Age Range']) * r_col('Age Max')),
+        (t_col('Cell Count'), (1 - violation['Cell Count']) * r_col('Cell Count Min'), None),
+        (t_col('Clear Zone'), r_col('Clear Zone Min'), None),
+        (t_col('Death to Recovery (hrs.)'),
+         None, (1 + violation['Death to Recovery']) * r_col('Death to Recovery Max (hrs.)')),
+        (t_col('Death to Surgery (days)'),
+         None, (1 + violation['Death to Surgery']) * r_col('Death to Surgery Max (days)')),
+        (t_col('Death to Cooling (hrs.)'),
+         None, (1 + violation['Death to Cooling']) * r_col('Death to Cooling Max (hrs.)'))]
+
+
+def _compatible_tissues(tissues, tissue_use, exclusions):
+    """Positional indices of the tissues matching a tissue use and a set of request exclusion flags."""
+    if tissue_use not in TISSUE_USES:
+        return np.empty(0, dtype=np.int64)
+    mask = tissues[tissue_use].to_numpy() == 1
+    for (tissue_flag, _), exclude in zip(EXCLUSION_FLAGS, exclusions):
+        mask &= tissues[tissue_flag].to_numpy() <= 1 - exclude
+    return np.flatnonzero(mask)
+
+
+def _expand(order, lo, hi, req_idx):
+    """Expands the windows order[lo[k]:hi[k]] of each request req_idx[k] into (tissue, request) pair arrays."""
+    counts = hi - lo
+    total = int(counts.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    starts = np.cumsum(counts) - counts
+    offsets = np.arange(total) - np.repeat(starts - lo, counts)
+    return order[offsets], np.repeat(req_idx, counts)
+
+
+def _is_feasible(t_idx, r_idx, requirements):
+    mask = np.ones(len(t_idx), dtype=bool)
+    for t_val, r_lower, r_upper in requirements:
+        if r_lower is not None:
+            mask &= t_val[t_idx] >= r_lower[r_idx]
+        if r_upper is not None:
+            mask &= t_val[t_idx] <= r_upper[r_idx]
+    return mask
+
+
+def _range_join(t_idx, r_idx, requirements):
+    """
+    Returns the pairs in t_idx x r_idx that satisfy all range requirements.
+    Each request is expanded over the narrowest interval among all requirements.
+    """
+    orders, windows = list(), list()
+    for t_val, r_lower, r_upper in requirements:
+        order = t_idx[np.argsort(t_val[t_idx], kind='stable')]
+        sorted_val = t_val[order]
+        lo = np.zeros(len(r_idx), dtype=np.int64)
+        hi = np.full(len(r_idx), len(order), dtype=np.int64)
+        if r_lower is not None:
+            lo = np.searchsorted(sorted_val, r_lower[r_idx], side='left')
+        if r_upper is not None:
+            hi = np.maximum(np.searchsorted(sorted_val, r_upper[r_idx], side='right'), lo)
+        orders.append(order)
+        windows.append((lo, hi))
+    sizes = np.stack([hi - lo for lo, hi in windows])
+    best = sizes.argmin(axis=0)
+    best_size = sizes[best, np.arange(len(r_idx))]
+
+    pairs_t, pairs_r = list(), list()
+    for k, (order, (lo, hi)) in enumerate(zip(orders, windows)):
+        sel = np.flatnonzero((best == k) & (best_size > 0))
+        # split requests into chunks to bound the number of pairs expanded at once
+        chunk_ids = np.cumsum(best_size[sel]) // CHUNK_SIZE
+        for chunk in np.unique(chunk_ids):
+            s = sel[chunk_ids == chunk]
+            cand_t, cand_r = _expand(order, lo[s], hi[s], r_idx[s])
+            keep = _is_feasible(cand_t, cand_r, requirements)
+            pairs_t.append(cand_t[keep])
+            pairs_r.append(cand_r[keep])
+    if not pairs_t:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(pairs_t), np.concatenate(pairs_r)
+
+
+def get_candidate_pairs(tissues, requests, params):
+    """
+    Finds all tissue/request pairs meeting the hard requirements.
+    :param tissues: tissues table (input schema).
+    :param requests: requests table (input schema).
+    :param params: Full parameters dictionary.
+    :return: (tissue positions, request positions) - two int arrays with the positional indices of each candidate pair
+    in the tissues and requests tables, sorted by tissue then request.
+    """
+    pairs_t, pairs_r = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    if len(tissues) and len(requests):
+        requirements = _range_requirements(tissues, requests, violation_factors(params))
+        group_cols = ['Tissue Use'] + [exclude_flag for _, exclude_flag in EXCLUSION_FLAGS]
+        groups = requests.reset_index(drop=True).groupby(group_cols, dropna=False, sort=False).indices
+        for key, r_idx in groups.items():
+            t_idx = _compatible_tissues(tissues, key[0], key[1:])
+            if len(t_idx):
+                cand_t, cand_r = _range_join(t_idx, np.asarray(r_idx, dtype=np.int64), requirements)
+                pairs_t.append(cand_t)
+                pairs_r.append(cand_r)
+    t_pos, r_pos = np.concatenate(pairs_t), np.concatenate(pairs_r)
+    order = np.lexsort((r_pos, t_pos))
+    return t_pos[order], r_pos[order]
+
+
+def feasible_mask(tissues, requests, t_pos, r_pos, params):
+    """
+    Flags the pairs that meet the range requirements at the violation levels of params. Tissue use and exclusion flags
+    do not depend on the parameters, so a subset of the candidate pairs for some violation levels is found from the
+    candidate pairs for looser violation levels, with the same result as get_candidate_pairs.
+    :param tissues: tissues table (input schema).
+    :param requests: requests table (input schema).
+    :param t_pos: Positional indices of the tissue of each pair.
+    :param r_pos: Positional indices of the request of each pair.
+    :param params: Full parameters dictionary.
+    :return: bool array.
+    """
+    return _is_feasible(t_pos, r_pos, _range_requirements(tissues, requests, violation_factors(params)))
+
+
+def get_candidate_matches(tissues, requests, params):
+    """
+    Finds all tissue/request pairs meeting the hard requirements.
+    :param tissues: tissues table (input schema).
+    :param requests: requests table (input schema).
+    :param params: Full parameters dictionary.
+    :return: DataFrame with the tissue and request fields of each candidate pair.
+    """
+    t_pos, r_pos = get_candidate_pairs(tissues, requests, params)
+    return pd.concat([tissues.iloc[t_pos].reset_index(drop=True),
+                      requests.iloc[r_pos].reset_index(drop=True)], axis=1)
@@ -11,6 +11,7 @@ Created by Aster Santana (Apr 25, 2021), Coupa Software.
 
 """
 
+import tempfile
 from pathlib import Path
 
 package_name = 'evermatch'
@@ -22,3 +23,8 @@ raw_input_path = Path.cwd().parent / f"test_{package_name}/data/" / raw_input_da
 input_path = Path.cwd().parent / f"test_{package_name}/data/inputs"
 output_path = Path.cwd().parent / f"test_{package_name}/data/outputs"
 
+# On-disk cache of derived data (see indexing.CostIndex)
+cache_path = Path(tempfile.gettempdir()) / f"{package_name}_cache"
+
+# Results and baseline of the synthetic benchmark (see benchmark.py)
+benchmark_path = Path.cwd().parent / f"test_{package_name}/benchmarks"
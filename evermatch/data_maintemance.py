@@ -8,6 +8,8 @@ Created by Aster Santana (Apr 25, 2021), Coupa Software.
 from evermatch.schemas import input_schema
 from evermatch.schemas import output_schema
 from evermatch import constants
+from evermatch import instrumentation
+from evermatch import validation
 
 from time import time
 import warnings
@@ -17,21 +19,22 @@ def data_check(dat, schema):
     print('#businesslog Running data integrity checks...')
     starting_time = time()
     assert schema.good_pan_dat_object(dat), 'Not a good PanDat object'
-    data_type_failures = schema.find_data_type_failures(dat)
+    data_type_failures, data_row_failures, foreign_key_failures = validation.find_failures(dat, schema)
+    instrumentation.count(rows=sum(len(getattr(dat, t)) for t in schema.all_tables),
+                          data_type_failures=len(data_type_failures), data_row_failures=len(data_row_failures),
+                          foreign_key_failures=len(foreign_key_failures))
     if data_type_failures:
         print(f'#businesslog Data type failures has been found. See some of them printed in the log.')
         for key, df in data_type_failures.items():
             print(key)
             print(df.head().to_string())
         warnings.warn(f'{len(data_type_failures)} data type failures has been found.')
-    data_row_failures = schema.find_data_row_failures(dat)
     if data_row_failures:
         print(f'#businesslog Data row failures has been found. See some of them printed in the log.')
         for key, df in data_row_failures.items():
             print(key)
             print(df.head().to_string())
         warnings.warn(f'{len(data_row_failures)} data row failures has been found.')
-    foreign_key_failures = schema.find_foreign_key_failures(dat)
     if foreign_key_failures:
         print(f'#businesslog Foreign key failures has been found. See some of them printed in the log.')
         for key, df in foreign_key_failures.items():
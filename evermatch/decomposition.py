@@ -0,0 +1,186 @@
+"""
+Exact decomposition of the Ever Sight matching problem into independent components.
+
+Every constraint of the model involves the candidate pairs of a single tissue or a single request, so the model
+separates over the connected components of the bipartite tissue/request candidate graph. Tissue use, site distances and
+exclusion flags usually split this graph into many components. Each component (or batch of tiny components) is solved on
+its own in a process pool, and the solutions are merged back into one solution dictionary with the sum of the objective
+values and KPIs, so the result is the same as solving the monolithic model.
+
+The 'Time Limit (sec.)' parameter bounds the whole solve: each batch gets its share of the time left when it starts, in
+proportion to its number of candidate pairs, and the batches that have not started by the deadline are skipped (the
+solve then has no solution). The components are found with scipy, and without it the model is solved as a single
+batch.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from time import time
+
+import numpy as np
+import pandas as pd
+
+import evermatch.optimization as optimization
+from evermatch import instrumentation
+from evermatch import pruning
+from evermatch.utils import timeit
+
+# Components with fewer candidate pairs than this are batched together, up to this many pairs per batch
+MIN_BATCH_EDGES = 5_000
+
+
+def component_labels(edges):
+    """
+    Finds the connected components of the bipartite candidate graph.
+    :param edges: CandidateEdges.
+    :return: int array with the component label of each edge. All edges are in one component if scipy is not
+    installed.
+    """
+    try:
+        from scipy import sparse
+        from scipy.sparse import csgraph
+    except ImportError:
+        # scipy is only required by the HiGHS and Min-Cost Flow backends, so the default CBC backend goes without it
+        return np.zeros(len(edges), dtype=np.int64)
+
+    n_nodes = edges.n_tissues + edges.n_requests
+    graph = sparse.csr_matrix((np.ones(len(edges), dtype=np.int8),
+                               (edges.tissue, edges.request.astype(np.int64) + edges.n_tissues)),
+                              shape=(n_nodes, n_nodes))
+    _, labels = csgraph.connected_components(graph, directed=False)
+    return labels[edges.tissue]
+
+
+def edge_batches(edges, min_batch_edges=None):
+    """
+    Groups the candidate edges into independent batches: one per large component and the tiny components packed
+    together.
+    :param edges: CandidateEdges.
+    :param min_batch_edges: Size (number of edges) under which components are batched together. Defaults to
+    MIN_BATCH_EDGES.
+    :return: list of sorted int arrays with the positions of the edges of each batch, largest batch first.
+    """
+    min_batch_edges = min_batch_edges or MIN_BATCH_EDGES
+    labels = component_labels(edges)
+    # number the components by decreasing size, so each batch is a contiguous range of component numbers
+    sizes = np.bincount(labels)
+    rank = np.empty(len(sizes), dtype=np.int64)
+    rank[np.argsort(-sizes, kind='stable')] = np.arange(len(sizes))
+    sorted_sizes = np.sort(sizes)[::-1]
+    sorted_sizes = sorted_sizes[sorted_sizes > 0]
+    n_large = int(np.sum(sorted_sizes >= min_batch_edges))
+    batch_of_rank = np.arange(len(sorted_sizes))
+    batch_of_rank[n_large:] = n_large + np.cumsum(sorted_sizes[n_large:]) // min_batch_edges
+    batch = batch_of_rank[rank[labels]]
+    order = np.argsort(batch, kind='stable')
+    bounds = np.searchsorted(batch[order], np.unique(batch), side='right')
+    return [np.sort(idx) for idx in np.split(order, bounds[:-1])]
+
+
+def time_shares(batches, workers):
+    """
+    Share of the time left that each batch gets when it starts: its share of the candidate pairs of the batches not
+    started yet, times the number of workers solving them at the same time (at most the whole time left).
+    :param batches: Positions of the edges of each batch (see edge_batches), in solve order.
+    :param workers: Number of worker processes.
+    :return: float array with the share of each batch.
+    """
+    sizes = np.array([len(idx) for idx in batches], dtype=np.float64)
+    remaining = np.cumsum(sizes[::-1])[::-1]
+    return np.minimum(workers * sizes / np.maximum(remaining, 1.0), 1.0)
+
+
+def _solve_batch(opt_input_dat, params, initial_edges, deadline=None, share=1.0):
+    """
+    Builds and solves the optimization model of one batch. Runs in the worker processes.
+    :param deadline: Optional time at which the whole solve must be done.
+    :param share: Share of the time left until the deadline given to this batch (see time_shares).
+    :return: Solution dictionary (see OptInputData.solution_dict), or None.
+    """
+    if deadline is not None:
+        time_left = deadline - time()
+        if time_left <= 0:
+            print("#businesslog Time limit reached, batch skipped")
+            return None
+        time_limit = share * time_left
+        params = {**params, 'Time Limit (sec.)': time_limit}
+        opt_input_dat.params = {**opt_input_dat.params, 'Time Limit (sec.)': time_limit}
+    if pruning.enabled(params):
+        return pruning.solve_pruned(opt_input_dat, params, initial_edges)
+    opt_model = optimization.build_optimization_model(opt_input_dat, params)
+    if initial_edges is not None:
+        opt_model.set_initial_solution(initial_edges)
+    opt_model.optimize()
+    return opt_model.model_sln
+
+
+def merge_solutions(model_slns, batches, solve_time):
+    """
+    Merges the solution dictionaries of independent batches.
+    :param model_slns: Solution dictionaries (see OptInputData.solution_dict), one per batch.
+    :param batches: Positions in the full candidate edges of the edges of each batch (see edge_batches).
+    :param solve_time: Wall-clock time to solve all batches.
+    :return: Solution dictionary of the whole problem, or None if any batch has no solution.
+    """
+    if not all(model_slns):
+        return None
+    status = next((sln['status'] for sln in model_slns if sln['status'] != 'Optimal'), 'Optimal')
+    obj_val = sum(sln['obj_val'] for sln in model_slns)
+    best_bound = sum(sln['best_bound'] for sln in model_slns)
+    mip_gap = np.nan if np.isnan(best_bound) else (
+        0.0 if obj_val == best_bound else abs(obj_val - best_bound) / max(abs(obj_val), 1e-10))
+    kpis = dict()
+    for sln in model_slns:
+        for kpi_name, value in sln['kpis'].items():
+            kpis[kpi_name] = kpis.get(kpi_name, 0.0) + value
+    # map the batch positions back to the full candidate edges, in the order of the full edges
+    x = np.concatenate([idx[sln['x']] for sln, idx in zip(model_slns, batches)])
+    order = np.argsort(x, kind='stable')
+    assignments = pd.concat([sln['assignments'] for sln in model_slns], ignore_index=True).iloc[order]
+    shortfalls = pd.concat([sln['shortfalls'] for sln in model_slns], ignore_index=True)
+    return {'status': status, 'x': x[order], 'assignments': assignments.reset_index(drop=True),
+            'shortfalls': shortfalls, 'obj_val': obj_val, 'best_bound': best_bound, 'mip_gap': mip_gap,
+            'solve_time': solve_time, 'kpis': kpis}
+
+
+@timeit
+def solve_by_components(opt_input_dat, params, initial_edges=None):
+    """
+    Solves the optimization model one independent batch of components at a time, in a process pool with the number of
+    processes given by the 'Parallel Workers' parameter (0 for all cores). Writing the lp file requires the monolithic
+    model, and the heuristic solve mode has a single time budget for the whole problem, so the decomposition is skipped
+    in these cases.
+    :param opt_input_dat: An OptInputData.
+    :param params: Full parameters dictionary.
+    :param initial_edges: Optional positions in opt_input_dat.edges of the assignments of an initial solution.
+    :return: Solution dictionary (see OptInputData.solution_dict), or None.
+    """
+    edges = opt_input_dat.edges
+    batches = edge_batches(edges) if len(edges) else list()
+    if (len(batches) <= 1 or params['Write lp File'] not in ['None', 'none'] or
+            params['Solve Mode'] == 'Fast heuristic'):
+        return _solve_batch(opt_input_dat, params, initial_edges)
+    print(f"#businesslog Solving {len(batches)} independent batches of components...")
+    instrumentation.count(batches=len(batches))
+    selected = None
+    if initial_edges is not None:
+        selected = np.zeros(len(edges), dtype=bool)
+        selected[initial_edges] = True
+    tasks = [(opt_input_dat.subset(idx), params, None if selected is None else np.flatnonzero(selected[idx]))
+             for idx in batches]
+    workers = min(params['Parallel Workers'] or os.cpu_count() or 1, len(tasks))
+    start = time()
+    if params['Time Limit (sec.)']:
+        deadline = start + params['Time Limit (sec.)']
+        tasks = [(*task, deadline, share) for task, share in zip(tasks, time_shares(batches, workers))]
+    if workers == 1:
+        model_slns = [_solve_batch(*task) for task in tasks]
+    else:
+        worker = partial(instrumentation.run_in_worker, instrumentation.enabled(), _solve_batch)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(worker, *zip(*tasks)))
+        for _, worker_records in results:
+            instrumentation.merge(worker_records)
+        model_slns = [model_sln for model_sln, _ in results]
+    return merge_solutions(model_slns, batches, time() - start)
@@ -0,0 +1,103 @@
+"""
+Incremental re-solve for intraday updates of the Ever Sight matching problem.
+
+Tissues and requests get updated throughout the day. Instead of a cold solve for every update, IncrementalSolver keeps
+the optimization data and model of the previous run and, for each delta (added, changed and removed tissues/requests):
+- Computes candidates, costs and scores only for the pairs involving added or changed rows (OptInputData.apply_delta).
+- Updates the model (OptModel.update_assignments). Only the CBC model is patched in place, and only when pairs are
+  added: any removed pair (a removed row, or a changed row that is no longer a candidate for some pair) triggers a full
+  rebuild of the model from the candidate edges, as do all updates with the other backends. A rebuild costs as much as
+  building the model of a cold solve.
+- Re-optimizes starting from the assignments of the previous solution that are still candidates.
+"""
+
+import numpy as np
+
+import evermatch.data_maintemance as data_maintenance
+import evermatch.optimization as optimization
+from evermatch.indexing import intern_tables
+from evermatch.opt_data import OptInputData, OptOutputData
+from evermatch.schemas import input_schema, output_schema, id_domains
+from evermatch.utils import timeit
+
+
+class IncrementalSolver:
+    """Keeps the state of a solve so that tissue/request deltas can be re-solved incrementally."""
+
+    def __init__(self, dat, backend=None):
+        """
+        Builds the optimization data and model (same steps as a cold solve). Call solve() for the first solution.
+        :param dat: A good PanDat for the input schema. It is copied, so later changes to it have no effect.
+        :param backend: Solver backend name (see optimization.SOLVER_BACKENDS). Defaults to the 'Solver Backend'
+        parameter.
+        """
+        dat = input_schema.copy_pan_dat(dat)
+        intern_tables(dat, id_domains)
+        data_maintenance.data_check(dat, input_schema)
+        data_maintenance.remove_inactive_records(dat)
+        self.params = input_schema.create_full_parameters_dict(dat)
+        self.opt_input_dat = OptInputData(dat)
+        self.opt_model = optimization.build_optimization_model(self.opt_input_dat, self.params, backend)
+        self.selected = list()  # (tissue ID, request ID) keys of the assignments of the last solution
+        self.sln = None
+
+    @property
+    def dat(self):
+        """Current input data, with all deltas applied."""
+        return self.opt_input_dat.dat
+
+    @timeit
+    def apply_delta(self, tissues=None, requests=None, removed_tissues=(), removed_requests=()):
+        """
+        Applies a delta to the data and patches the model. See OptInputData.apply_delta for the arguments.
+        :return: (removed_keys, added_keys) of the candidate pairs.
+        """
+        removed_keys, added_keys = self.opt_input_dat.apply_delta(tissues, requests, removed_tissues,
+                                                                  removed_requests)
+        self.opt_model.update_assignments(removed_keys, added_keys)
+        return removed_keys, added_keys
+
+    @timeit
+    def solve(self):
+        """
+        Optimizes the current model, warm started from the previous solution if there is one.
+        :return: A good PanDat for the output schema, or None.
+        """
+        dat = self.opt_input_dat
+        if self.selected:
+            t_codes = dat.tissue_index.encode([i for i, _ in self.selected])
+            r_codes = dat.request_index.encode([j for _, j in self.selected])
+            edge_idx = np.array([dat.edges.find(i, j) for i, j in zip(t_codes, r_codes) if i >= 0 and j >= 0],
+                                dtype=np.int64)
+            self.opt_model.set_initial_solution(edge_idx[edge_idx >= 0])
+        self.opt_model.optimize()
+        if not self.opt_model.model_sln:
+            self.selected, self.sln = list(), None
+            return None
+        assignments = self.opt_model.model_sln['assignments']
+        self.selected = list(zip(assignments['Tissue ID'], assignments['Request ID']))
+        opt_output_dat = OptOutputData(self.opt_model.model_sln, self.params)
+        opt_output_dat.populate_output_schema(dat.dat, dat.cost_index)
+        self.sln = opt_output_dat.sln
+        data_maintenance.data_check(self.sln, output_schema)
+        return self.sln
+
+
+def compute_delta(old_dat, new_dat):
+    """
+    Diffs two snapshots of the input data.
+    :param old_dat: PanDat for the input schema the incremental solver was built (or last updated) with.
+    :param new_dat: PanDat for the input schema with the current data.
+    :return: dict with the apply_delta arguments - 'tissues' and 'requests' (added or changed rows), and
+    'removed_tissues' and 'removed_requests' (IDs).
+    """
+    rtn = dict()
+    for table, id_col, removed in [('tissues', 'Tissue ID', 'removed_tissues'),
+                                   ('requests', 'Request ID', 'removed_requests')]:
+        old_df = getattr(old_dat, table).drop_duplicates(id_col, keep='last')
+        new_df = getattr(new_dat, table).drop_duplicates(id_col, keep='last')
+        rtn[removed] = list(old_df.loc[~old_df[id_col].isin(new_df[id_col]), id_col])
+        # rows of new_df without an identical row in old_df are added or changed
+        merged = new_df.merge(old_df, how='left', indicator=True)
+        rtn[table] = new_df[(merged['_merge'] == 'left_only').to_numpy()]
+    return rtn
@@ -0,0 +1,399 @@
+"""
+Compact, array-backed containers for the optimization input data.
+
+- intern_tables: gives the ID columns of each domain of the input tables one shared categorical dtype, so each ID string
+  is stored once and the rows hold compact integer codes until the output tables are written.
+- IdIndex: interns the IDs of one domain (tissues, requests, sites, surgeons) into dense integer codes.
+- CandidateEdges: candidate (tissue, request) pairs stored CSR-style by tissue, with parallel cost and score arrays.
+- CostIndex: transportation costs between site codes, as a dense or sorted sparse matrix that can be memory-mapped from
+  an on-disk cache.
+- ColumnView, RecordView, EdgeView and EdgeKeys: read-only dict/list-style views over the arrays above, keyed by the
+  original string IDs, so code written against the dict-based data model keeps working.
+"""
+
+import hashlib
+import os
+import tempfile
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+import pandas as pd
+
+from evermatch.utils import evict_lru, frame_digest, module_digest
+
+CODE_DTYPE = np.int32
+
+
+def _is_categorical(values):
+    return isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype)
+
+
+def _distinct(values):
+    """Distinct values in order of first appearance, as an object array. Found on the codes of categorical values."""
+    if _is_categorical(values):
+        return np.asarray(pd.unique(values), dtype=object)
+    return pd.unique(np.asarray(values, dtype=object))
+
+
+def intern_tables(dat, domains):
+    """
+    Interns the ID columns of the tables of dat in place: the columns of each ID domain get one shared categorical
+    dtype, whose categories are the distinct IDs of the domain over all its columns. Each ID string is then stored once,
+    the rows hold integer codes (int8 to int32, depending on the number of IDs), and merges, foreign key checks and
+    IdIndex lookups between columns of the same domain work on the codes. Missing IDs stay missing.
+    :param dat: A PanDat. Its interned tables are replaced by copies, so tables shared with other PanDat objects do not
+    change.
+    :param domains: dict {domain: list of (table, field)} (see schemas.id_domains). Missing tables or fields are
+    skipped.
+    """
+    for columns in domains.values():
+        columns = [(table, field) for table, field in columns
+                   if isinstance(getattr(dat, table, None), pd.DataFrame) and field in getattr(dat, table).columns]
+        if not columns:
+            continue
+        categories = pd.unique(np.concatenate([_distinct(getattr(dat, table)[field]) for table, field in columns]))
+        dtype = pd.CategoricalDtype(categories[pd.notna(categories)])
+        for table, field in columns:
+            df = getattr(dat, table)
+            if df[field].dtype != dtype:
+                setattr(dat, table, df.assign(**{field: df[field].astype(dtype)}))
+
+
+class IdIndex:
+    """Maps the IDs of one domain to dense integer codes 0..n-1."""
+
+    def __init__(self, ids):
+        """
+        :param ids: Unique IDs. The code of each ID is its position.
+        """
+        self.ids = pd.Index(np.asarray(ids, dtype=object) if _is_categorical(ids) else ids)
+        assert self.ids.is_unique, 'IDs must be unique'
+
+    @classmethod
+    def from_values(cls, *values):
+        """Interns the distinct values of one or more arrays, in order of first appearance."""
+        values = [_distinct(v) for v in values]
+        return cls(pd.unique(np.concatenate(values)) if values else [])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, item):
+        return item in self.ids
+
+    def code(self, item):
+        """Code of a single ID. Raises KeyError if the ID is unknown."""
+        return self.ids.get_loc(item)
+
+    def encode(self, values):
+        """Codes of an array of IDs, -1 for unknown IDs. Categorical IDs are looked up once per category."""
+        if _is_categorical(values):
+            values = values.array if isinstance(values, (pd.Series, pd.Index)) else values
+            lookup = np.append(self.ids.get_indexer(values.categories), -1).astype(CODE_DTYPE)
+            return lookup[values.codes]
+        return self.ids.get_indexer(values).astype(CODE_DTYPE)
+
+    def decode(self, codes):
+        """IDs of an array of codes."""
+        return self.ids.to_numpy()[codes]
+
+    def extend(self, values):
+        """
+        Interns new IDs in place. Codes of the existing IDs do not change.
+        :param values: IDs, possibly already interned.
+        :return: Codes of values.
+        """
+        new = _distinct(values)
+        new = new[self.ids.get_indexer(new) < 0]
+        if len(new):
+            self.ids = self.ids.append(pd.Index(new))
+        return self.encode(values)
+
+    def remove(self, codes):
+        """
+        Removes IDs in place and renumbers the remaining ones densely, preserving their order.
+        :param codes: Codes of the IDs to remove.
+        :return: int array mapping each old code to its new code (-1 for removed IDs).
+        """
+        keep = np.ones(len(self.ids), dtype=bool)
+        keep[codes] = False
+        remap = np.where(keep, np.cumsum(keep) - 1, -1).astype(CODE_DTYPE)
+        self.ids = self.ids[keep]
+        return remap
+
+
+class CandidateEdges:
+    """Candidate (tissue, request) pairs in CSR layout by tissue, with parallel cost and score arrays."""
+
+    def __init__(self, tissue, request, n_tissues, n_requests, cost=None, score=None):
+        """
+        :param tissue: Tissue code of each edge, sorted.
+        :param request: Request code of each edge, sorted within each tissue.
+        :param n_tissues: Number of tissue codes.
+        :param n_requests: Number of request codes.
+        :param cost: Transportation cost of each edge (defaults to 0).
+        :param score: Soft requirement score of each edge (defaults to 0).
+        """
+        self.reset(tissue, request, n_tissues, n_requests, cost, score)
+
+    def reset(self, tissue, request, n_tissues, n_requests, cost=None, score=None):
+        """Replaces all edges in place (same arguments as the constructor), so views on this object stay valid."""
+        tissue = np.asarray(tissue)
+        self.n_tissues = n_tissues
+        self.n_requests = n_requests
+        self.indptr = np.searchsorted(tissue, np.arange(n_tissues + 1)).astype(np.int64)
+        self.request = np.asarray(request, dtype=CODE_DTYPE)
+        self.cost = np.zeros(len(self.request)) if cost is None else np.asarray(cost, dtype=np.float64)
+        self.score = np.zeros(len(self.request)) if score is None else np.asarray(score, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.request)
+
+    @property
+    def tissue(self):
+        """Tissue code of each edge."""
+        return np.repeat(np.arange(self.n_tissues, dtype=CODE_DTYPE), np.diff(self.indptr))
+
+    def find(self, tissue, request):
+        """Position of edge (tissue, request), or -1 if it is not a candidate."""
+        lo, hi = self.indptr[tissue], self.indptr[tissue + 1]
+        k = lo + np.searchsorted(self.request[lo:hi], request)
+        return int(k) if k < hi and self.request[k] == request else -1
+
+    def by_request(self):
+        """
+        Request-major adjacency.
+        :return: (indptr, order) - the edges of request j are order[indptr[j]:indptr[j + 1]].
+        """
+        order = np.argsort(self.request, kind='stable')
+        indptr = np.searchsorted(self.request[order], np.arange(self.n_requests + 1)).astype(np.int64)
+        return indptr, order
+
+    def subset(self, mask):
+        """New edges with the selected edges only (codes are kept)."""
+        return CandidateEdges(self.tissue[mask], self.request[mask], self.n_tissues, self.n_requests,
+                              self.cost[mask], self.score[mask])
+
+
+class CostIndex:
+    """
+    Transportation costs between pairs of sites, looked up by site code. The costs are stored as a dense n x n matrix,
+    or as sorted (origin * n + dest) keys with parallel costs when less than DENSE_MIN_DENSITY of the pairs have a cost.
+    Costs are stored as float32 when this is lossless, and float64 otherwise. Missing pairs cost 0.
+    """
+    DENSE_MIN_DENSITY = 0.125
+    COST_COLUMNS = ['Origin Site ID', 'Dest. Site ID', 'Transp. Cost']
+    # Size of the on-disk cache over which the least recently used indexes are removed
+    CACHE_MAX_BYTES = 512 * 1024 ** 2
+
+    def __init__(self, sites, costs, keys=None):
+        """
+        :param sites: Site IDs. The code of each site is its position.
+        :param costs: Dense cost matrix, or the cost of each key if keys is given.
+        :param keys: Sorted origin * len(sites) + dest keys of the sparse matrix, or None for a dense matrix.
+        """
+        self.sites = IdIndex(sites)
+        self.costs = costs
+        self.keys = keys
+
+    @classmethod
+    def from_cost_matrix(cls, cost_matrix):
+        """
+        Builds the index from the cost_matrix table, keeping the last row of duplicated site pairs.
+        :param cost_matrix: cost_matrix table (input schema).
+        """
+        cost_matrix = cost_matrix.drop_duplicates(['Origin Site ID', 'Dest. Site ID'], keep='last')
+        sites = IdIndex.from_values(cost_matrix['Origin Site ID'], cost_matrix['Dest. Site ID'])
+        n_sites = len(sites)
+        keys = (sites.encode(cost_matrix['Origin Site ID']).astype(np.int64) * n_sites +
+                sites.encode(cost_matrix['Dest. Site ID']))
+        costs = np.nan_to_num(cost_matrix['Transp. Cost'].to_numpy(dtype=np.float64), nan=0.0)
+        if np.array_equal(costs.astype(np.float32), costs):
+            costs = costs.astype(np.float32)
+        if len(keys) >= cls.DENSE_MIN_DENSITY * n_sites ** 2:
+            dense = np.zeros(n_sites ** 2, dtype=costs.dtype)
+            dense[keys] = costs
+            return cls(sites.ids, dense.reshape(n_sites, n_sites))
+        order = np.argsort(keys)
+        return cls(sites.ids, costs[order], keys[order])
+
+    @classmethod
+    def cached(cls, cost_matrix, cache_path=None):
+        """
+        Loads the index of cost_matrix from the on-disk cache (memory-mapped), building and saving it on a cache miss.
+        The cache entry is keyed by a hash of the table content and of the source of this module. Loading an entry
+        marks it as recently used, and the least recently used entries are removed when the cache grows over
+        CACHE_MAX_BYTES.
+        :param cost_matrix: cost_matrix table (input schema).
+        :param cache_path: Cache directory. Defaults to constants.cache_path.
+        """
+        from evermatch import constants
+
+        root = os.path.join(cache_path or constants.cache_path, 'cost_index')
+        digest = hashlib.sha1(f"{module_digest('indexing')}/{frame_digest(cost_matrix[cls.COST_COLUMNS])}".encode())
+        path = os.path.join(root, digest.hexdigest())
+        if os.path.isdir(path):
+            try:
+                rtn = cls.load(path)
+                os.utime(path)  # most recently used
+                return rtn
+            except (OSError, ValueError):
+                pass
+        rtn = cls.from_cost_matrix(cost_matrix)
+        try:
+            rtn.save(path)
+        except (OSError, ValueError):
+            return rtn  # read-only or unusable cache directory, or IDs that can not be stored without pickling
+        evict_lru([root], cls.CACHE_MAX_BYTES)
+        return rtn
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index saved with save, memory-mapping the cost arrays."""
+        sites = np.load(os.path.join(path, 'sites.npy'))
+        costs = np.load(os.path.join(path, 'costs.npy'), mmap_mode='r')
+        keys_path = os.path.join(path, 'keys.npy')
+        keys = np.load(keys_path, mmap_mode='r') if os.path.exists(keys_path) else None
+        return cls(sites, costs, keys)
+
+    def save(self, path):
+        """
+        Saves the index to directory path. The directory is written under a temporary name and renamed, so concurrent
+        runs never read a partial entry.
+        """
+        sites = self.sites.ids.to_numpy()
+        if sites.dtype == object:
+            sites = np.asarray(sites.tolist())
+            if not np.array_equal(sites.astype(object), self.sites.ids.to_numpy()):
+                raise ValueError('Site IDs of mixed types can not be saved')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path))
+        np.save(os.path.join(tmp_path, 'sites.npy'), sites, allow_pickle=False)
+        np.save(os.path.join(tmp_path, 'costs.npy'), np.asarray(self.costs))
+        if self.keys is not None:
+            np.save(os.path.join(tmp_path, 'keys.npy'), np.asarray(self.keys))
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another run saved the same entry first
+            for name in os.listdir(tmp_path):
+                os.remove(os.path.join(tmp_path, name))
+            os.rmdir(tmp_path)
+
+    def lookup(self, origin, dest):
+        """
+        :param origin: Origin site codes (-1 for sites without costs).
+        :param dest: Destination site codes (-1 for sites without costs).
+        :return: float64 array with the transportation cost of each pair.
+        """
+        origin, dest = np.asarray(origin, dtype=np.int64), np.asarray(dest, dtype=np.int64)
+        found = (origin >= 0) & (dest >= 0)
+        rtn = np.zeros(len(origin))
+        if self.keys is None:
+            rtn[found] = self.costs[origin[found], dest[found]]
+            return rtn
+        pair_keys = origin[found] * len(self.sites) + dest[found]
+        pos = np.searchsorted(self.keys, pair_keys)
+        hit = pos < len(self.keys)
+        hit[hit] = self.keys[pos[hit]] == pair_keys[hit]
+        found[found] = hit
+        rtn[found] = self.costs[pos[hit]]
+        return rtn
+
+    def costs_between(self, origin, dest):
+        """Transportation cost of each pair of (origin, destination) site IDs."""
+        return self.lookup(self.sites.encode(origin), self.sites.encode(dest))
+
+
+class ColumnView(Mapping):
+    """Read-only dict-style view of an entity attribute, keyed by ID."""
+
+    def __init__(self, index, array):
+        self.index = index
+        self.array = array
+
+    def __getitem__(self, key):
+        return self.array[self.index.code(key)]
+
+    def __iter__(self):
+        return iter(self.index.ids)
+
+    def __len__(self):
+        return len(self.index)
+
+
+class RecordView(Mapping):
+    """Read-only dict-style view of several entity attributes, keyed by ID, with one dict per entity."""
+
+    def __init__(self, index, columns):
+        """
+        :param index: IdIndex of the entities.
+        :param columns: dict {field name: array aligned with the index codes}.
+        """
+        self.index = index
+        self.columns = columns
+
+    def __getitem__(self, key):
+        code = self.index.code(key)
+        return {col: values[code] for col, values in self.columns.items()}
+
+    def __iter__(self):
+        return iter(self.index.ids)
+
+    def __len__(self):
+        return len(self.index)
+
+
+class EdgeView(Mapping):
+    """Read-only dict-style view of an edge attribute ('cost' or 'score'), keyed by (tissue ID, request ID)."""
+
+    def __init__(self, edges, tissue_index, request_index, attr):
+        self.edges = edges
+        self.tissue_index = tissue_index
+        self.request_index = request_index
+        self.attr = attr
+
+    @property
+    def array(self):
+        return getattr(self.edges, self.attr)
+
+    def __getitem__(self, key):
+        i, j = key
+        try:
+            k = self.edges.find(self.tissue_index.code(i), self.request_index.code(j))
+        except KeyError:
+            raise KeyError(key) from None
+        if k < 0:
+            raise KeyError(key)
+        return self.array[k]
+
+    def __iter__(self):
+        return iter(EdgeKeys(self.edges, self.tissue_index, self.request_index))
+
+    def __len__(self):
+        return len(self.edges)
+
+    def items(self):
+        keys = EdgeKeys(self.edges, self.tissue_index, self.request_index)
+        return zip(keys, self.array)
+
+
+class EdgeKeys(Sequence):
+    """Read-only list-style view of the (tissue ID, request ID) keys of the candidate edges."""
+
+    def __init__(self, edges, tissue_index, request_index):
+        self.edges = edges
+        self.tissue_index = tissue_index
+        self.request_index = request_index
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[n] for n in range(*k.indices(len(self)))]
+        tissue = np.searchsorted(self.edges.indptr, k if k >= 0 else len(self) + k, side='right') - 1
+        return self.tissue_index.ids[tissue], self.request_index.ids[self.edges.request[k]]
+
+    def __iter__(self):
+        return zip(self.tissue_index.decode(self.edges.tissue), self.request_index.decode(self.edges.request))
+
+    def __len__(self):
+        return len(self.edges)
@@ -0,0 +1,264 @@
+"""
+Structured, hierarchical instrumentation of the solve.
+
+The stages of the solve run inside nested spans. Each span records its wall time, CPU time, peak RSS growth (how much
+the peak resident memory of the process grew during the span) and domain counters such as the number of candidate
+pairs, variables, constraints, non-zeros or selected matches. The finished spans are exported as JSON lines (one span
+per line, with the id of its parent span) and optionally as a Chrome trace file, to open in chrome://tracing or
+Perfetto.
+
+Instrumentation is disabled by default, and then costs one global flag check per span. It is enabled either with
+enable(), or by setting the EVERMATCH_TRACE environment variable to the path of the JSON lines file (and optionally
+EVERMATCH_CHROME_TRACE to the path of the Chrome trace file), in which case the spans are exported when the process
+exits.
+
+Spans are per thread. The spans of a function run in a worker process with run_in_worker() are returned with its result
+and added to the spans of the parent process with merge(), under its current span. The spans are only exported by the
+parent process.
+"""
+
+import atexit
+import json
+import multiprocessing
+import os
+import threading
+from functools import wraps
+from time import perf_counter, process_time, time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+_records = list()
+_next_id = 0
+
+
+def enabled():
+    """:return: Whether spans are recorded."""
+    return _enabled
+
+
+def enable():
+    """Starts recording spans."""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """Stops recording spans. The spans recorded so far are kept."""
+    global _enabled
+    _enabled = False
+
+
+def reset():
+    """Discards the spans recorded so far."""
+    with _lock:
+        _records.clear()
+
+
+def records():
+    """:return: list of dicts - the finished spans, in the order they finished."""
+    with _lock:
+        return list(_records)
+
+
+def _peak_rss():
+    """Peak resident set size of the process in bytes, or 0 if unknown."""
+    if resource is None:
+        return 0
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss if os.uname().sysname == 'Darwin' else max_rss * 1024
+
+
+class Span:
+    """A timed stage of the solve. Use span() to create one."""
+
+    __slots__ = ['name', 'counters', 'id', 'parent', 'depth', '_start', '_wall', '_cpu', '_rss']
+
+    def __init__(self, name, counters):
+        self.name = name
+        self.counters = counters
+        self.id = None
+        self.parent = None
+        self.depth = 0
+
+    def count(self, **counters):
+        """Sets domain counters of the span (e.g. candidate_pairs=1000)."""
+        self.counters.update(counters)
+
+    def __enter__(self):
+        global _next_id
+        stack = _stack()
+        with _lock:
+            self.id = _next_id
+            _next_id += 1
+        self.parent = stack[-1].id if stack else None
+        self.depth = len(stack)
+        stack.append(self)
+        self._rss = _peak_rss()
+        self._start = time()
+        self._cpu = process_time()
+        self._wall = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        wall = perf_counter() - self._wall
+        cpu = process_time() - self._cpu
+        stack = _stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        record = {'name': self.name, 'id': self.id, 'parent': self.parent, 'depth': self.depth,
+                  'pid': os.getpid(), 'thread': threading.get_ident(), 'start': self._start,
+                  'wall_time': wall, 'cpu_time': cpu, 'peak_rss_delta': _peak_rss() - self._rss,
+                  'counters': self.counters}
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        with _lock:
+            _records.append(record)
+        return False
+
+
+class _NullSpan:
+    """Span returned while instrumentation is disabled: records nothing."""
+
+    __slots__ = []
+
+    def count(self, **counters):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = list()
+    return stack
+
+
+def span(name, **counters):
+    """
+    Context manager timing a stage of the solve, nested in the current span of the thread (if any).
+    :param name: Name of the stage.
+    :param counters: Initial domain counters of the span. More can be set with count().
+    :return: A Span, or a no-op span if instrumentation is disabled.
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name, counters)
+
+
+def count(**counters):
+    """Sets domain counters of the current span of the thread. Does nothing if there is none."""
+    if not _enabled:
+        return
+    stack = _stack()
+    if stack:
+        stack[-1].count(**counters)
+
+
+def traced(name=None):
+    """
+    Decorator running the decorated function in a span.
+    :param name: Name of the span. Defaults to module.qualified name of the function.
+    """
+    def decorator(func):
+        span_name = name or f"{func.__module__.rsplit('.', 1)[-1]}.{func.__qualname__}"
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Span(span_name, dict()):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def run_in_worker(trace, func, *args):
+    """
+    Runs a function in a worker process, recording its spans if the parent process records spans.
+    :param trace: Whether the parent process records spans (see enabled()).
+    :param func: Function to run.
+    :param args: Arguments of func.
+    :return: (result of func, list of the spans recorded by func) - merge the spans in the parent with merge().
+    """
+    global _enabled
+    _enabled = trace
+    # a forked worker starts with a copy of the spans and of the open span stack of the parent
+    reset()
+    _local.stack = list()
+    result = func(*args)
+    return result, records() if trace else list()
+
+
+def merge(worker_records):
+    """
+    Adds the spans recorded in a worker process (see run_in_worker) under the current span of the thread, with new ids.
+    :param worker_records: list of span dicts.
+    """
+    global _next_id
+    if not _enabled or not worker_records:
+        return
+    stack = _stack()
+    parent, depth = (stack[-1].id, stack[-1].depth + 1) if stack else (None, 0)
+    with _lock:
+        ids = dict()
+        for record in worker_records:
+            ids[record['id']] = _next_id
+            _next_id += 1
+        for record in worker_records:
+            _records.append({**record, 'id': ids[record['id']], 'parent': ids.get(record['parent'], parent),
+                             'depth': record['depth'] + depth})
+
+
+def export_jsonl(path):
+    """Writes the finished spans to a JSON lines file, one span per line."""
+    with open(path, 'w') as f:
+        for record in records():
+            f.write(json.dumps(record, default=_json_default) + '\n')
+
+
+def export_chrome_trace(path):
+    """Writes the finished spans to a Chrome trace file (complete events, in microseconds)."""
+    events = [{'name': r['name'], 'cat': 'evermatch', 'ph': 'X', 'ts': r['start'] * 1e6, 'dur': r['wall_time'] * 1e6,
+               'pid': r['pid'], 'tid': r['thread'],
+               'args': {'cpu_time': r['cpu_time'], 'peak_rss_delta': r['peak_rss_delta'], **r['counters']}}
+              for r in records()]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=_json_default)
+
+
+def _json_default(value):
+    # numpy scalars in the counters
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def _export_at_exit(jsonl_path, chrome_trace_path):
+    if multiprocessing.parent_process() is not None:
+        return  # spawned worker process, its spans are merged in the parent
+    if jsonl_path:
+        export_jsonl(jsonl_path)
+    if chrome_trace_path:
+        export_chrome_trace(chrome_trace_path)
+
+
+if os.environ.get('EVERMATCH_TRACE') or os.environ.get('EVERMATCH_CHROME_TRACE'):
+    enable()
+    atexit.register(_export_at_exit, os.environ.get('EVERMATCH_TRACE'), os.environ.get('EVERMATCH_CHROME_TRACE'))
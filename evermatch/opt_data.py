@@ -9,10 +9,17 @@ to it.
 OptOutputData - Reads the solution from the optimization and populates the output tables (defined by the TicDat output
 schema).
 """
+import copy
 import math
 
 import numpy as np
 
+from evermatch import candidates
+from evermatch import instrumentation
+from evermatch import scoring
+from evermatch import stage_cache
+from evermatch.indexing import CODE_DTYPE, IdIndex, CandidateEdges, CostIndex
+from evermatch.indexing import ColumnView, RecordView, EdgeView, EdgeKeys
 from evermatch.schemas import input_schema
 from evermatch.schemas import output_schema
 import pandas as pd
@@ -20,6 +27,9 @@ import datetime
 
 from evermatch.utils import timeit
 
+# Max. number of tissues per request of each 'Num. of Assignments' parameter value
+NUM_ASSIGNMENTS = {'Up to one tissue_df per request_df': 1, 'Up to two tissues per request_df': 2,
+                   'Up to three tissues per request_df': 3}
 
 class OptInputData:
     """Class to map data from input schema to optimization input schema."""
@@ -33,13 +43,26 @@ class OptInputData:
         self.dat = dat
         self.params = input_schema.create_full_parameters_dict(dat)
 
-        self.candidate_matches = None
+        # ID INDICES (ID <-> dense integer code)
+        self.tissue_index = None
+        self.request_index = None
+        self.site_index = None
+        self.surgeon_index = None
+        self.cost_index = None  # transportation costs by site pair, with its own site codes
+
+        # ENTITY ATTRIBUTES (typed columns, row k <-> code k)
+        self.tissue_attrs = None  # tissues fields, with 'Current Site ID' as site codes
+        self.request_attrs = None  # requests fields, with 'Site ID' and 'Surgeon ID' as site and surgeon codes
+        self.pref_weights = None  # surgeons_pref score fields of each request's surgeon and tissue use
+
+        # CANDIDATE EDGES (CSR by tissue, with parallel transportation cost and score arrays)
+        self.edges = None
 
         # SET OF INDICES
-        self.I = list()  # materials
-        self.J = list()  # assets
+        self.I = list()  # tissues
+        self.J = list()  # requests
 
-        # DATA PARAMETERS
+        # DATA PARAMETERS (dict-style views over the arrays above)
         self.tc = dict()  # transportation cost
         self.r = dict()  # allocated rewards (score for relaxed requirements)
         self.cc = dict()  # tissue_df cell count
@@ -54,13 +77,16 @@ class OptInputData:
         self.dc = dict()  # tissue_df death to cooling
         self.dcu = dict()  # request_df death to cooling max
         self.q = dict()  # scores
-        self.N = {'Up to one tissue_df per request_df': 1, 'Up to two tissues per request_df': 2,
-                  'Up to three tissues per request_df': 3}[self.params['Num. of Assignments']]
+        self.N = NUM_ASSIGNMENTS[self.params['Num. of Assignments']]
         self.p = self.params['Assignment Shortfall Penalty']
 
         # VARIABLES KEYS
         self.x_keys = list()  # x[i, j] - keys for matching variables
 
+        # STAGE CACHE KEYS (see stage_cache.stage_keys), None if the cache is off
+        self.stage_keys = stage_cache.stage_keys(dat, self.params)
+
+        self.intern_ids()
         self.get_candidate_matches()
         self.populate_set_of_indices()
         self.populate_parameters()
@@ -69,127 +95,314 @@ class OptInputData:
         self.print_parameters()
         self.print_data_statistics()
 
-    def get_candidate_matches(self):
+    @instrumentation.traced()
+    def intern_ids(self):
         dat = self.dat
-        tissues_df = dat.tissues.copy()
-        requests_df = dat.requests.copy()
-        # cross join tissues and requests
-        tissues_df['Key'] = 0
-        requests_df['Key'] = 0
-        df = pd.merge(tissues_df, requests_df, on='Key', how='outer')
-        # exclude obvious infeasible combinations
-        cell_count_violation = {
-            '0%': 0, '5%': 0.05, '10%': 0.1, '20%': 0.2, '30%': 0.3}[self.params['Cell Count Max Violation']]
-        age_range_violation = {
-            '0%': 0, '5%': 0.05, '10%': 0.1, '20%': 0.2, '30%': 0.3}[self.params['Age Range Max Violation']]
-        death_to_recovery_violation = {
-            '0%': 0, '5%': 0.05, '10%': 0.1, '20%': 0.2, '30%': 0.3}[self.params['Death to Recovery Max Violation']]
-        death_to_surgery_violation = {
-            '0%': 0, '5%': 0.05, '10%': 0.1, '20%': 0.2, '30%': 0.3}[self.params['Death to Surgery Max Violation']]
-        death_to_cooling_violation = {
-            '0%': 0, '5%': 0.05, '10%': 0.1, '20%': 0.2, '30%': 0.3}[self.params['Death to Cooling Max Violation']]
-        df = df[
-            (df['Donor Age'] >= (1 - age_range_violation) * df['Age Min']) &
-            (df['Donor Age'] <= (1 + age_range_violation) * df['Age Max']) &
-            (df['Cell Count'] >= (1 - cell_count_violation) * df['Cell Count Min']) &
-            (df['Returned'] <= 1 - df['Exclude Tissue Returned']) &
-            (
-                    (df['PK'] == 1) & (df['Tissue Use'] == 'PK') |
-                    (df['DSEAK'] == 1) & (df['Tissue Use'] == 'DSEAK') |
-                    (df['DMEK'] == 1) & (df['Tissue Use'] == 'DMEK')
-            ) &
-            (df['Death to Recovery (hrs.)'] <= (1 + death_to_recovery_violation) * df['Death to Recovery Max (hrs.)']) &
-            (df['Death to Surgery (days)'] <= (1 + death_to_surgery_violation) * df['Death to Surgery Max (days)']) &
-            (df['Death to Cooling (hrs.)'] <= (1 + death_to_cooling_violation) * df['Death to Cooling Max (hrs.)']) &
-            (df['Clear Zone'] >= df['Clear Zone Min']) &
-            (df['Cancer'] <= 1 - df['Exclude Cancer']) &
-            (df['Diabetes'] <= 1 - df['Exclude Diabetes']) &
-            (df['LASIK Scar'] <= 1 - df['Exclude LASIK Scars']) &
-            (df['Moderate Folds'] <= 1 - df['Exclude Moderate Folds']) &
-            (df['Artificial Lens'] <= 1 - df['Exclude Artificial Lens'])
-            ]
-        self.candidate_matches = df
+        tissues = dat.tissues.drop_duplicates('Tissue ID', keep='last').reset_index(drop=True)
+        requests = dat.requests.drop_duplicates('Request ID', keep='last').reset_index(drop=True)
+        self.tissue_index = IdIndex(tissues['Tissue ID'])
+        self.request_index = IdIndex(requests['Request ID'])
+        self.site_index = IdIndex.from_values(dat.locations['Site ID'], tissues['Current Site ID'], requests['Site ID'])
+        self.surgeon_index = IdIndex.from_values(
+            dat.surgeons['Surgeon ID'], requests['Surgeon ID'], dat.surgeons_pref['Surgeon ID'])
+        self.tissue_attrs = self._tissue_attributes(tissues)
+        self.request_attrs, self.pref_weights = self._request_attributes(requests)
+        instrumentation.count(tissues=len(self.tissue_index), requests=len(self.request_index),
+                              sites=len(self.site_index), surgeons=len(self.surgeon_index))
 
+    def _tissue_attributes(self, tissues):
+        """Typed attribute columns of tissues (input schema rows), with site IDs as codes."""
+        rtn = _typed_columns(tissues.drop(columns='Tissue ID'))
+        rtn['Current Site ID'] = self.site_index.extend(tissues['Current Site ID'])
+        return rtn
+
+    def _request_attributes(self, requests):
+        """Typed attribute columns and surgeon preference weights of requests (input schema rows)."""
+        rtn = _typed_columns(requests.drop(columns='Request ID'))
+        rtn['Site ID'] = self.site_index.extend(requests['Site ID'])
+        rtn['Surgeon ID'] = self.surgeon_index.extend(requests['Surgeon ID'])
+        srg_pref = requests[['Surgeon ID', 'Tissue Use']].merge(
+            self.surgeon_preferences(), on=['Surgeon ID', 'Tissue Use'], how='left')
+        return rtn, srg_pref[scoring.SCORE_FIELDS].fillna(0.0)
+
+    def _cached_arrays(self, stage, compute):
+        """
+        Arrays of a stage, from the stage cache or computed and cached on a miss.
+        :param stage: Stage name (see stage_cache.STAGES).
+        :param compute: Function returning the arrays of the stage, as a dict {name: array}.
+        """
+        rtn = stage_cache.load(self.stage_keys, stage)
+        if rtn is None:
+            rtn = compute()
+            stage_cache.save(self.stage_keys, stage, rtn)
+        return rtn
+
+    @instrumentation.traced()
+    def get_candidate_matches(self):
+        def find_pairs():
+            t_codes, r_codes = candidates.get_candidate_pairs(self.tissue_attrs, self.request_attrs, self.params)
+            return {'tissue': t_codes.astype(CODE_DTYPE), 'request': r_codes.astype(CODE_DTYPE)}
+
+        pairs = self._cached_arrays('candidates', find_pairs)
+        self.edges = CandidateEdges(pairs['tissue'], pairs['request'], len(self.tissue_index), len(self.request_index))
+        instrumentation.count(candidate_pairs=len(self.edges))
+
+    @instrumentation.traced()
     def populate_set_of_indices(self):
+        edges = self.edges
         # tissues
-        self.I = list(set(self.candidate_matches['Tissue ID']))
+        self.I = list(self.tissue_index.decode(np.flatnonzero(np.diff(edges.indptr))))
         # requests
-        self.J = list(set(self.candidate_matches['Request ID']))
+        self.J = list(self.request_index.decode(np.flatnonzero(np.bincount(edges.request,
+                                                                           minlength=edges.n_requests))))
 
+    @instrumentation.traced()
     def populate_parameters(self):
-        dat = self.dat
-        df_cost = self.candidate_matches.merge(
-            dat.cost_matrix, left_on=['Current Site ID', 'Site ID'], right_on=['Origin Site ID', 'Dest. Site ID'],
-            how='left')
-        df_cost['Transp. Cost'] = df_cost['Transp. Cost'].fillna(0.0)
+        edges = self.edges
         # transportation cost
-        self.tc = dict(zip(zip(df_cost['Tissue ID'], df_cost['Request ID']), df_cost['Transp. Cost']))
+        self.cost_index = CostIndex.cached(self.dat.cost_matrix)
+        edges.cost = self._cached_arrays(
+            'costs', lambda: {'cost': self.edge_costs(edges.tissue, edges.request)})['cost']
+        self.tc = EdgeView(edges, self.tissue_index, self.request_index, 'cost')
+        self._define_entity_views()
+
+    def _define_entity_views(self):
+        tissues, requests = self.tissue_attrs, self.request_attrs
+
+        def tissue_view(col):
+            return ColumnView(self.tissue_index, tissues[col].to_numpy())
+
+        def request_view(col):
+            return ColumnView(self.request_index, requests[col].to_numpy())
+
         # allocated reward
-        srg_pref = dat.requests[['Request ID', 'Surgeon ID', 'Tissue Use']].merge(
-            dat.surgeons_pref, on=['Surgeon ID', 'Tissue Use'], how='left')
-        srg_pref = srg_pref.fillna(0.0)
-        for index, row in srg_pref.iterrows():
-            self.r[row['Request ID']] = {col: row[col] for col in [
-                'Cell Count Min', 'Age Range', 'Death to Recovery Max (hrs.)', 'Death to Surgery Max (days)',
-                'Death to Cooling Max (hrs.)', 'Tissue Origin']}
+        self.r = RecordView(self.request_index, {col: self.pref_weights[col].to_numpy()
+                                                 for col in scoring.SCORE_FIELDS})
         # tissue_df cell count
-        self.cc = dict(zip(dat.tissues['Tissue ID'], dat.tissues['Cell Count']))
+        self.cc = tissue_view('Cell Count')
         # request_df cell count minimum
-        self.ccl = dict(zip(dat.requests['Request ID'], dat.requests['Cell Count Min']))
+        self.ccl = request_view('Cell Count Min')
         # tissue_df donor age
-        self.a = dict(zip(dat.tissues['Tissue ID'], dat.tissues['Donor Age']))
+        self.a = tissue_view('Donor Age')
         # request_df donor age min
-        self.al = dict(zip(dat.requests['Request ID'], dat.requests['Age Min']))
+        self.al = request_view('Age Min')
         # request_df donor age max
-        self.au = dict(zip(dat.requests['Request ID'], dat.requests['Age Max']))
+        self.au = request_view('Age Max')
         # tissue_df death to recover
-        self.dr = dict(zip(dat.tissues['Tissue ID'], dat.tissues['Death to Recovery (hrs.)']))
+        self.dr = tissue_view('Death to Recovery (hrs.)')
         # request_df death to recover max
-        self.dru = dict(zip(dat.requests['Request ID'], dat.requests['Death to Recovery Max (hrs.)']))
+        self.dru = request_view('Death to Recovery Max (hrs.)')
         # tissue_df death to surgery
-        self.ds = dict(zip(dat.tissues['Tissue ID'], dat.tissues['Death to Surgery (days)']))
+        self.ds = tissue_view('Death to Surgery (days)')
         # request_df death to surgery max
-        self.dsu = dict(zip(dat.requests['Request ID'], dat.requests['Death to Surgery Max (days)']))
+        self.dsu = request_view('Death to Surgery Max (days)')
         # tissue_df death to cooling
-        self.dc = dict(zip(dat.tissues['Tissue ID'], dat.tissues['Death to Cooling (hrs.)']))
+        self.dc = tissue_view('Death to Cooling (hrs.)')
         # request_df death to cooling max
-        self.dcu = dict(zip(dat.requests['Request ID'], dat.requests['Death to Recovery Max (hrs.)']))
+        self.dcu = request_view('Death to Recovery Max (hrs.)')
+
+    def edge_costs(self, t_codes, r_codes):
+        """Transportation cost of each (tissue code, request code) pair."""
+        return self.transportation_costs(self.tissue_attrs['Current Site ID'].to_numpy()[t_codes],
+                                         self.request_attrs['Site ID'].to_numpy()[r_codes])
+
+    def edge_scores(self, t_codes, r_codes, reward_type=None):
+        """
+        Soft requirement score of each (tissue code, request code) pair.
+        :param reward_type: 'Fixed Reward' or 'Dynamic Reward'. Defaults to the 'Reward Type' parameter.
+        """
+        pairs = {col: values.to_numpy()[t_codes] for col, values in self.tissue_attrs.items()}
+        pairs.update({col: values.to_numpy()[r_codes] for col, values in self.request_attrs.items()})
+        weights = {col: self.pref_weights[col].to_numpy()[r_codes] for col in scoring.SCORE_FIELDS}
+        return scoring.soft_requirement_scores(pairs, weights, reward_type or self.params['Reward Type'])
+
+    def transportation_costs(self, origin, dest):
+        """
+        Looks up the transportation cost between pairs of sites. Missing entries cost 0.
+        :param origin: Origin site codes.
+        :param dest: Destination site codes.
+        :return: float array with the transportation cost of each pair.
+        """
+        cost_codes = self.cost_index.sites.encode(self.site_index.ids)
+        return self.cost_index.lookup(cost_codes[origin], cost_codes[dest])
+
+    def surgeon_preferences(self):
+        """Surgeon preference weights, one row per (Surgeon ID, Tissue Use)."""
+        return self.dat.surgeons_pref.drop_duplicates(['Surgeon ID', 'Tissue Use'], keep='last')
 
+    @instrumentation.traced()
     def define_variables_keys(self):
-        self.x_keys = list(set(self.candidate_matches[['Tissue ID', 'Request ID']].itertuples(index=False, name=None)))
+        self.x_keys = EdgeKeys(self.edges, self.tissue_index, self.request_index)
 
+    @instrumentation.traced()
     def soft_requirement_coefficients(self):
-        x_keys = self.x_keys
-        for i, j in x_keys:
-            r = self.r[j]
-            # cell count
-            if (self.params['Reward Type'] == 'Fixed Reward') and (self.ccl[j] <= self.cc[i]):
-                cq = r['Cell Count Min']
-            else:
-                cq = r['Cell Count Min'] * (self.cc[i] - self.ccl[j]) / self.ccl[j]
-            # age range
-            if (self.al[j] <= self.a[i]) and (self.a[i] <= self.au[j]):
-                aq = r['Age Range']
-            elif self.a[i] < self.al[j]:
-                aq = r['Age Range'] * (self.a[i] - self.al[j]) / self.al[j]
-            else:  # self.au[j] < self.a[i]
-                aq = r['Age Range'] * (self.au[j] - self.a[i]) / self.au[j]
-            # death to recovery
-            if (self.params['Reward Type'] == 'Fixed Reward') and (self.dr[i] <= self.dru[j]):
-                drq = r['Death to Recovery Max (hrs.)']
-            else:
-                drq = r['Death to Recovery Max (hrs.)'] * (self.dru[j] - self.dr[i]) / self.dru[j]
-            # death to surgery
-            if (self.params['Reward Type'] == 'Fixed Reward') and (self.ds[i] <= self.dsu[j]):
-                dsq = r['Death to Surgery Max (days)']
-            else:
-                dsq = r['Death to Surgery Max (days)'] * (self.dsu[j] - self.ds[i]) / self.dsu[j]
-            # death to cooling
-            if (self.params['Reward Type'] == 'Fixed Reward') and (self.dc[i] <= self.dcu[j]):
-                dcq = r['Death to Cooling Max (hrs.)']
-            else:
-                dcq = r['Death to Cooling Max (hrs.)'] * (self.dcu[j] - self.dc[i]) / self.dcu[j]
-            self.q[i, j] = cq + aq + drq + dsq + dcq
+        edges = self.edges
+        edges.score = self._cached_arrays(
+            'scores', lambda: {'score': self.edge_scores(edges.tissue, edges.request)})['score']
+        self.q = EdgeView(edges, self.tissue_index, self.request_index, 'score')
+
+    @timeit
+    def apply_delta(self, tissues=None, requests=None, removed_tissues=(), removed_requests=()):
+        """
+        Updates the data in place with added, changed and removed tissues/requests. Candidates, costs and scores are
+        only computed for the pairs involving added or changed rows.
+        :param tissues: tissues rows (input schema) to add, or to replace the rows with the same Tissue ID.
+        :param requests: requests rows (input schema) to add, or to replace the rows with the same Request ID.
+        :param removed_tissues: IDs of the tissues to remove.
+        :param removed_requests: IDs of the requests to remove.
+        :return: (removed_keys, added_keys) - the (tissue ID, request ID) keys of the candidate pairs that were dropped
+        and created. The pairs of a changed row that are still candidates appear in both.
+        """
+        dat, edges = self.dat, self.edges
+        tissues = dat.tissues.iloc[:0] if tissues is None else tissues.drop_duplicates('Tissue ID', keep='last')
+        requests = dat.requests.iloc[:0] if requests is None else requests.drop_duplicates('Request ID', keep='last')
+        # the data no longer matches the stage cache keys
+        self.stage_keys = None
+        # changed rows are removed and added back
+        drop_tissue_ids = pd.unique(np.concatenate([np.asarray(removed_tissues, dtype=object),
+                                                    tissues['Tissue ID'].to_numpy(dtype=object)]))
+        drop_request_ids = pd.unique(np.concatenate([np.asarray(removed_requests, dtype=object),
+                                                     requests['Request ID'].to_numpy(dtype=object)]))
+        drop_t = self.tissue_index.encode(drop_tissue_ids)
+        drop_t = drop_t[drop_t >= 0]
+        drop_r = self.request_index.encode(drop_request_ids)
+        drop_r = drop_r[drop_r >= 0]
+
+        # region Drop the edges of removed and changed rows, and renumber the remaining codes
+        t_codes, r_codes = edges.tissue, edges.request
+        dropped = np.isin(t_codes, drop_t) | np.isin(r_codes, drop_r)
+        removed_keys = list(zip(self.tissue_index.decode(t_codes[dropped]),
+                                self.request_index.decode(r_codes[dropped])))
+        kept = ~dropped
+        cost, score = edges.cost[kept], edges.score[kept]
+        t_map = self.tissue_index.remove(drop_t)
+        r_map = self.request_index.remove(drop_r)
+        t_codes, r_codes = t_map[t_codes[kept]], r_map[r_codes[kept]]
+        self.tissue_attrs = self.tissue_attrs[t_map >= 0].reset_index(drop=True)
+        self.request_attrs = self.request_attrs[r_map >= 0].reset_index(drop=True)
+        self.pref_weights = self.pref_weights[r_map >= 0].reset_index(drop=True)
+        # endregion
+
+        # region Add the new rows and find their candidate pairs
+        n_tissues, n_requests = len(self.tissue_index), len(self.request_index)
+        tissues = tissues.reset_index(drop=True)
+        requests = requests.reset_index(drop=True)
+        self.tissue_index.extend(tissues['Tissue ID'])
+        self.request_index.extend(requests['Request ID'])
+        request_attrs, pref_weights = self._request_attributes(requests)
+        self.tissue_attrs = pd.concat([self.tissue_attrs, self._tissue_attributes(tissues)], ignore_index=True)
+        self.request_attrs = pd.concat([self.request_attrs, request_attrs], ignore_index=True)
+        self.pref_weights = pd.concat([self.pref_weights, pref_weights], ignore_index=True)
+        # new tissues x all requests, then old tissues x new requests
+        new_t, new_r = candidates.get_candidate_pairs(self.tissue_attrs.iloc[n_tissues:], self.request_attrs,
+                                                      self.params)
+        old_t, old_r = candidates.get_candidate_pairs(self.tissue_attrs.iloc[:n_tissues],
+                                                      self.request_attrs.iloc[n_requests:], self.params)
+        new_t = np.concatenate([new_t + n_tissues, old_t]).astype(CODE_DTYPE)
+        new_r = np.concatenate([new_r, old_r + n_requests]).astype(CODE_DTYPE)
+        added_keys = list(zip(self.tissue_index.decode(new_t), self.request_index.decode(new_r)))
+        # endregion
+
+        t_codes, r_codes = np.concatenate([t_codes, new_t]), np.concatenate([r_codes, new_r])
+        cost = np.concatenate([cost, self.edge_costs(new_t, new_r)])
+        score = np.concatenate([score, self.edge_scores(new_t, new_r)])
+        order = np.lexsort((r_codes, t_codes))
+        edges.reset(t_codes[order], r_codes[order], len(self.tissue_index), len(self.request_index),
+                    cost[order], score[order])
+
+        # keep the input tables in sync, they are used to populate the output schema
+        dat.tissues = pd.concat([dat.tissues[~dat.tissues['Tissue ID'].isin(drop_tissue_ids)], tissues],
+                                ignore_index=True)
+        dat.requests = pd.concat([dat.requests[~dat.requests['Request ID'].isin(drop_request_ids)], requests],
+                                 ignore_index=True)
+        self.populate_set_of_indices()
+        self._define_entity_views()
+        instrumentation.count(removed_pairs=len(removed_keys), added_pairs=len(added_keys), candidate_pairs=len(edges))
+        print(f"#businesslog Delta applied: {len(removed_keys)} candidate pairs removed, {len(added_keys)} added")
+        return removed_keys, added_keys
+
+    def subset(self, edge_idx):
+        """
+        Lean copy with some of the candidate edges only, to solve part of the problem on its own (see decomposition).
+        Tissues and requests are re-interned so codes are dense. The input tables and entity attributes are not kept,
+        which makes the copy cheap to send to other processes.
+        :param edge_idx: Sorted positions in self.edges of the edges to keep.
+        :return: OptInputData with the data needed to build and solve the optimization model.
+        """
+        edges = self.edges
+        t_codes, r_codes = edges.tissue[edge_idx], edges.request[edge_idx]
+        tissues, t_codes = np.unique(t_codes, return_inverse=True)
+        requests, r_codes = np.unique(r_codes, return_inverse=True)
+        rtn = copy.copy(self)
+        rtn.dat = rtn.cost_index = rtn.stage_keys = None
+        rtn.tissue_attrs = rtn.request_attrs = rtn.pref_weights = None
+        rtn.tissue_index = IdIndex(self.tissue_index.decode(tissues))
+        rtn.request_index = IdIndex(self.request_index.decode(requests))
+        rtn.edges = CandidateEdges(t_codes, r_codes, len(tissues), len(requests),
+                                   edges.cost[edge_idx], edges.score[edge_idx])
+        rtn.populate_set_of_indices()
+        rtn.r = rtn.cc = rtn.ccl = rtn.a = rtn.al = rtn.au = dict()
+        rtn.dr = rtn.dru = rtn.ds = rtn.dsu = rtn.dc = rtn.dcu = dict()
+        rtn.tc = EdgeView(rtn.edges, rtn.tissue_index, rtn.request_index, 'cost')
+        rtn.q = EdgeView(rtn.edges, rtn.tissue_index, rtn.request_index, 'score')
+        rtn.define_variables_keys()
+        return rtn
+
+    def solution_dict(self, status, edge_idx, shortfall, obj_val, best_bound, mip_gap, solve_time):
+        """
+        Builds the solution dictionary read by OptOutputData, in compact form: only the selected assignments and the
+        non-zero shortfalls are listed, and the KPIs are computed from the cost array.
+        :param status: Optimization status.
+        :param edge_idx: Positions in self.edges of the selected assignments (x[i, j] = 1).
+        :param shortfall: Array with the assignment shortfall y[j] of each request in self.J, or None if the model has
+        no shortfall variables.
+        :param obj_val: Objective value.
+        :param best_bound: Best bound on the objective value.
+        :param mip_gap: Relative MIP gap.
+        :param solve_time: Solve time in seconds.
+        :return: dict with 'status', 'x' (sorted edge positions), 'assignments' (DataFrame with 'Tissue ID',
+        'Request ID' and 'Score' of each selected assignment), 'shortfalls' (DataFrame with 'Request ID' and 'Penalty'
+        of each request with a non-zero shortfall), 'obj_val', 'best_bound', 'mip_gap', 'solve_time' and 'kpis'.
+        """
+        edges = self.edges
+        edge_idx = np.sort(np.asarray(edge_idx, dtype=np.int64))
+        kpis = {'Transportation Cost': float(edges.cost[edge_idx].sum())}
+        instrumentation.count(selected_matches=len(edge_idx))
+        assignments = pd.DataFrame({
+            'Tissue ID': self.tissue_index.decode(edges.tissue[edge_idx]),
+            'Request ID': self.request_index.decode(edges.request[edge_idx]),
+            'Score': np.round(edges.score[edge_idx], 2)})
+        shortfalls = pd.DataFrame({'Request ID': pd.Series(dtype=object), 'Penalty': pd.Series(dtype=np.float64)})
+        if shortfall is not None:
+            shortfall = np.asarray(shortfall, dtype=np.float64)
+            kpis['Assignment Shortfall Penalty'] = float(self.p * shortfall.sum())
+            nonzero = np.flatnonzero(shortfall)
+            shortfalls = pd.DataFrame({'Request ID': np.asarray(self.J, dtype=object)[nonzero],
+                                       'Penalty': shortfall[nonzero]})
+        return {'status': status, 'x': edge_idx, 'assignments': assignments, 'shortfalls': shortfalls,
+                'obj_val': obj_val, 'best_bound': best_bound, 'mip_gap': mip_gap, 'solve_time': solve_time,
+                'kpis': kpis}
+
+    def incumbent_from_matching(self, rpt_matching):
+        """
+        Maps the assignments of a previous rpt_matching to the current candidate edges, keeping only the ones that are
+        still valid, so they can be used as an initial solution.
+        :param rpt_matching: rpt_matching table (output schema) from a previous run.
+        :return: int array with the positions in self.edges of a feasible set of assignments.
+        """
+        # main assignments first, so they are preferred when a tissue or request has too many assignments
+        tissue_cols = ['Tissue ID', 'Tissue ID - Alt. 1', 'Tissue ID - Alt. 2']
+        pairs = pd.concat([rpt_matching[['Request ID', col]].set_axis(['Request ID', 'Tissue ID'], axis=1)
+                           for col in tissue_cols if col in rpt_matching.columns]).dropna()
+        t_codes = self.tissue_index.encode(pairs['Tissue ID'])
+        r_codes = self.request_index.encode(pairs['Request ID'])
+        edge_idx = np.array([self.edges.find(i, j) if i >= 0 and j >= 0 else -1 for i, j in zip(t_codes, r_codes)],
+                            dtype=np.int64)
+        valid = pd.DataFrame({'edge': edge_idx, 'tissue': t_codes, 'request': r_codes})
+        valid = valid[valid['edge'] >= 0].drop_duplicates('tissue')
+        max_assignments = 1 if self.params['Request Coverage'] == 'Exactly one tissue_df per request_df' else self.N
+        valid = valid[valid.groupby('request').cumcount() < max_assignments]
+        return valid['edge'].to_numpy()
 
     def print_parameters(self):
         params_dict = {'Parameter': list(), 'Value': list()}
@@ -207,6 +420,15 @@ class OptInputData:
         print('\n', meta_df, '\n')
 
 
+def _typed_columns(df):
+    """Copy of df with integer columns downcast to the smallest integer dtype that holds them."""
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_integer_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+    return df
+
+
 class OptOutputData:
     """Class to map data from optimization solution dictionary to output schema (a TicDat output schema)."""
 
@@ -223,19 +445,19 @@ class OptOutputData:
         assert self.model_sln, "Model does not have a solution yet, possibly because it's infeasible (see log above)."
         print('#businesslog Objective Value: {}'.format(self.model_sln['obj_val']))
 
-        sln_vars = self.model_sln['vars']
-        # Retrieve production variables
-        x_df = pd.Series(sln_vars['x']).reset_index()
-        x_df.columns = ['Tissue ID', 'Request ID', 'Value']
-        self.matching_df = x_df[['Tissue ID', 'Request ID', 'Value']]
+        # Retrieve the selected assignments (x[i, j] = 1) with their scores
+        self.matching_df = self.model_sln['assignments'][['Tissue ID', 'Request ID', 'Score']]
 
-        # Retrieve penalty variables
-        y_df = pd.Series(sln_vars['y']).reset_index()
-        y_df.columns = ['Request ID', 'Penalty']
-        self.penalty_df = y_df[['Request ID', 'Penalty']]
+        # Retrieve the non-zero penalty variables
+        self.penalty_df = self.model_sln['shortfalls'][['Request ID', 'Penalty']]
 
     @timeit
-    def populate_output_schema(self, dat):
+    def populate_output_schema(self, dat, cost_index=None):
+        """
+        :param dat: The input PanDat that was optimized.
+        :param cost_index: Optional CostIndex of dat.cost_matrix (see OptInputData.cost_index). Loaded from the on-disk
+        cache if not given.
+        """
         sln = output_schema.PanDat()
 
         # region Populate the rtp_production table
@@ -243,56 +465,34 @@ class OptOutputData:
                 'Tissue ID - Alt. 1', 'Transp. Cost - Alt. 1', 'Score - Alt. 1',
                 'Tissue ID - Alt. 2', 'Transp. Cost - Alt. 2', 'Score - Alt. 2', 'Penalty']
         matching = self.matching_df
-        matching = matching[matching['Value'] > 0.5]
         # bring in request_df and tissue_df location
         matching = matching.merge(dat.requests[['Request ID', 'Site ID']], on='Request ID', how='left')
         matching = matching.merge(dat.tissues[['Tissue ID', 'Current Site ID']], on='Tissue ID', how='left')
-        matching = matching[['Request ID', 'Tissue ID', 'Current Site ID', 'Site ID', 'Value']].reset_index()
-        # get scores
-        score_df = pd.DataFrame(self.model_sln['scores'], columns=['Tissue ID', 'Request ID', 'Score'])
-        matching = matching.merge(score_df, on=['Request ID', 'Tissue ID'], how='left')
+        matching = matching[['Request ID', 'Tissue ID', 'Current Site ID', 'Site ID', 'Score']].reset_index()
         # get transportation cost
-        matching = matching.merge(dat.cost_matrix, how='left',
-                                  left_on=['Current Site ID', 'Site ID'], right_on=['Origin Site ID', 'Dest. Site ID'])
-        # split assignment into main, alt. 1, and alt. 2
-        matching_dict = {col: list() for col in cols[:-1]}
-        for request_id, group_df in matching.groupby('Request ID'):
-            group_df = group_df[group_df['Value'] > 0.5]
-            group_df['Transp. Cost'] = group_df['Transp. Cost'].fillna(0)
-            if group_df.empty:
-                for col in cols[1:]:
-                    matching_dict[col].append(np.nan)
-                continue
-            group_df = group_df.sort_values(['Transp. Cost', 'Score'], ascending=[True, False]).reset_index()
-            matching_dict['Request ID'].append(request_id)
-            # main assignment
-            try:
-                r0 = group_df.iloc[0]
-            except IndexError:
-                r0 = {'Tissue ID': np.nan, 'Transp. Cost': np.nan, 'Score': np.nan}
-            matching_dict['Tissue ID'].append(r0['Tissue ID'])
-            matching_dict['Transp. Cost'].append(r0['Transp. Cost'])
-            matching_dict['Score'].append(r0['Score'])
-            # first alternative assignment
-            try:
-                r1 = group_df.iloc[1]
-            except IndexError:
-                r1 = {'Tissue ID': np.nan, 'Transp. Cost': np.nan, 'Score': np.nan}
-            matching_dict['Tissue ID - Alt. 1'].append(r1['Tissue ID'])
-            matching_dict['Transp. Cost - Alt. 1'].append(r1['Transp. Cost'])
-            matching_dict['Score - Alt. 1'].append(r1['Score'])
-            # second alternative assignment
-            try:
-                r2 = group_df.iloc[2]
-            except IndexError:
-                r2 = {'Tissue ID': np.nan, 'Transp. Cost': np.nan, 'Score': np.nan}
-            matching_dict['Tissue ID - Alt. 2'].append(r2['Tissue ID'])
-            matching_dict['Transp. Cost - Alt. 2'].append(r2['Transp. Cost'])
-            matching_dict['Score - Alt. 2'].append(r2['Score'])
-        rpt_matching = pd.DataFrame(matching_dict, columns=cols[:-1])
+        if cost_index is None:
+            cost_index = CostIndex.cached(dat.cost_matrix)
+        matching['Transp. Cost'] = cost_index.costs_between(matching['Current Site ID'], matching['Site ID'])
+        # split assignment into main, alt. 1, and alt. 2: rank the assignments of each request by transportation cost
+        # (missing costs count as 0), then by decreasing score (missing scores last), keeping ties in their order
+        matching = matching[matching['Request ID'].notna()].copy()
+        matching['Transp. Cost'] = matching['Transp. Cost'].fillna(0)
+        matching = matching.sort_values(['Request ID', 'Transp. Cost', 'Score'], ascending=[True, True, False],
+                                        kind='stable', na_position='last')
+        matching['Rank'] = matching.groupby('Request ID', sort=False).cumcount()
+        request_ids = matching['Request ID'].drop_duplicates()
+        matching_dict = {'Request ID': request_ids.tolist()}
+        for rank, suffix in enumerate(['', ' - Alt. 1', ' - Alt. 2']):
+            ranked = matching[matching['Rank'] == rank].set_index('Request ID')
+            for col in ['Tissue ID', 'Transp. Cost', 'Score']:
+                matching_dict[col + suffix] = ranked[col].reindex(request_ids).tolist()
+        # object IDs even without assignments, so the merge below matches the penalties IDs
+        rpt_matching = pd.DataFrame(matching_dict, columns=cols[:-1]).astype({'Request ID': object})
         # get assignment shortfall penalties
         rpt_matching = rpt_matching.merge(self.penalty_df, on='Request ID', how='left')
+        rpt_matching['Penalty'] = rpt_matching['Penalty'].fillna(0.0)
         sln.rpt_matching = rpt_matching[cols]
+        instrumentation.count(selected_matches=len(self.matching_df), matched_requests=len(rpt_matching))
         # endregion
 
         # region Populate rpt_kpi_summary table
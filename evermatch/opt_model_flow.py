@@ -0,0 +1,146 @@
+"""
+Network optimization model for the Ever Sight matching problem.
+
+This module has one class, OptModel, with the same interface as opt_model_pulp.OptModel. The model is a bipartite
+transportation problem (at most one request per tissue, N assignments or a penalized shortfall per request), whose
+constraint matrix is totally unimodular, so it is solved exactly as a min-cost assignment instead of a MIP:
+- Each request j in dat.J is split into N slots (one slot in the 'Exactly one' coverage mode), and every slot must be
+  matched to a distinct tissue.
+- Slot (j, k) can be matched to any candidate tissue i of j at cost tc[i, j] (minus q[i, j] when scored requirements
+  are relaxed), or, with alternative assignments, to its own shortfall node at cost p.
+The assignment is solved with the sparse Jonker-Volgenant algorithm (scipy.sparse.csgraph).
+"""
+from time import time
+
+import numpy as np
+
+from evermatch import instrumentation
+from evermatch.utils import timeit
+
+
+class OptModel:
+    """Class to define and solve the optimization model as a min-cost assignment."""
+
+    def __init__(self, dat, name="EverMatch"):
+        self.dat = dat
+        self.params = dat.params
+        self.name = name
+        self._reset()
+
+    def _reset(self):
+        """Empties the model, before it is (re)built."""
+        self.weights = None  # assignment cost of each candidate edge
+        self.slots = 1  # number of slots of each request
+        self.shortfall = False  # whether a request slot can be left unassigned at a cost p
+        self.model_sln = dict()
+        self.complexities = list()
+
+    @timeit
+    def build_base_model(self):
+        print("#businesslog Adding assignment arcs...")
+        self.weights = self.dat.edges.cost.copy()
+        print("#businesslog Base optimization model built successfully")
+
+    def add_complexity_alternative_assignments(self):
+        # N slots per request, each one either assigned or short at a penalty p
+        self.slots = self.dat.N
+        self.shortfall = True
+        self.complexities.append('alternative_assignments')
+
+    def add_complexity_relax_scored_requirement(self):
+        self.weights = self.weights - self.dat.edges.score
+        self.complexities.append('relax_scored_requirement')
+
+    @timeit
+    def update_assignments(self, removed_keys, added_keys):
+        """
+        Updates the model after OptInputData.apply_delta. The arcs are read from the candidate edges when optimizing,
+        so the model is rebuilt and the complexities are added again.
+        :param removed_keys: Keys of the candidate pairs dropped from dat.
+        :param added_keys: Keys of the candidate pairs created in dat.
+        """
+        complexities = self.complexities
+        self._reset()
+        self.build_base_model()
+        for complexity in complexities:
+            getattr(self, f'add_complexity_{complexity}')()
+
+    def set_initial_solution(self, edge_idx):
+        """
+        The assignment algorithm does not take an initial solution, so it is ignored.
+        :param edge_idx: Positions in dat.edges of the assignments in the initial solution.
+        """
+        print("#businesslog Warm start is not supported by the Min-Cost Flow solver backend, solving from scratch")
+
+    def _assignment_graph(self):
+        """
+        Biadjacency matrix with one row per request slot and one column per tissue code, followed by one column per
+        shortfall node (one per slot). Weights are shifted to be at least 1, since the algorithm treats zeros as missing
+        arcs. Every slot is matched exactly once, so the shift does not change the optimal assignment.
+        :return: (graph, arc_of) - two csr_matrix with the same arcs: graph holds the weights and arc_of the position in
+        dat.edges of each arc plus 2 (so shortfall arcs hold 1 and no entry is zero).
+        """
+        from scipy import sparse
+
+        dat = self.dat
+        edges = dat.edges
+        requests = dat.request_index.encode(dat.J)
+        # row of the first slot of each request code
+        first_slot = np.full(edges.n_requests, -1, dtype=np.int64)
+        first_slot[requests] = np.arange(len(requests)) * self.slots
+        n_rows = len(requests) * self.slots
+        edge_pos = np.arange(len(edges))
+        rows = [first_slot[edges.request][None, :] + np.arange(self.slots)[:, None]]
+        cols = [np.broadcast_to(edges.tissue, (self.slots, len(edges)))]
+        weights = [np.broadcast_to(self.weights, (self.slots, len(edges)))]
+        arcs = [np.broadcast_to(edge_pos, (self.slots, len(edges)))]
+        if self.shortfall:
+            rows.append(np.arange(n_rows))
+            cols.append(edges.n_tissues + np.arange(n_rows))
+            weights.append(np.full(n_rows, float(dat.p)))
+            arcs.append(np.full(n_rows, -1))
+        rows, cols, weights, arcs = (np.concatenate([a.ravel() for a in v]) for v in (rows, cols, weights, arcs))
+        shift = 1.0 - min(weights.min(), 0.0) if len(weights) else 0.0
+        graph = sparse.csr_matrix((weights + shift, (rows, cols)),
+                                  shape=(n_rows, edges.n_tissues + (n_rows if self.shortfall else 0)))
+        # edge position of each arc, looked up by (row, col) after solving
+        arc_of = sparse.csr_matrix((arcs + 2.0, (rows, cols)), shape=graph.shape)
+        return graph, arc_of
+
+    @timeit
+    def optimize(self):
+        from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+
+        dat = self.dat
+        if self.params['Write lp File'] not in ['None', 'none']:
+            print("#businesslog 'Write lp File' is only supported by the CBC solver backend")
+        print("#businesslog Solving the assignment problem...")
+        start = time()
+        if not len(dat.edges):
+            # no candidate pairs, so no requests to assign either
+            print('#businesslog Optimization status: Optimal')
+            self.model_sln = dat.solution_dict('Optimal', [], np.zeros(len(dat.J)) if self.shortfall else None, 0.0,
+                                               0.0, 0.0, time() - start)
+            return
+        graph, arc_of = self._assignment_graph()
+        instrumentation.count(variables=graph.nnz, constraints=sum(graph.shape), nonzeros=2 * graph.nnz)
+        self.model_sln = None
+        try:
+            row_ind, col_ind = min_weight_full_bipartite_matching(graph)
+        except ValueError:
+            row_ind = None
+        # with more slots than tissues, the matching only covers the tissues and some slots are left unmatched
+        if row_ind is None or len(row_ind) < graph.shape[0]:
+            print('#businesslog Optimization status: Infeasible')
+            return
+        solve_time = time() - start
+        print('#businesslog Optimization status: Optimal')
+        arcs = np.asarray(arc_of[row_ind, col_ind]).ravel().astype(np.int64) - 2
+        edge_idx = arcs[arcs >= 0]
+        obj_val = float(self.weights[edge_idx].sum())
+        y = None
+        if self.shortfall:
+            y = np.bincount(row_ind[arcs < 0] // self.slots, minlength=len(dat.J)).astype(float)
+            obj_val += float(dat.p * y.sum())
+        # the assignment is optimal, so the bound is the objective value
+        self.model_sln = dat.solution_dict('Optimal', edge_idx, y, obj_val, obj_val, 0.0, solve_time)
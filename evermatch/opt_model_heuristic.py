@@ -0,0 +1,368 @@
+"""
+Latency-bounded heuristic for the Ever Sight matching problem ('Solve Mode' = 'Fast heuristic').
+
+This module has one class, OptModel, with the same interface as opt_model_pulp.OptModel, so the solution goes through
+the same OptOutputData path. Assignments are built greedily by increasing cost (tc[i, j], minus q[i, j] when scored
+requirements are relaxed), respecting that a tissue is assigned at most once and a request at most N times. They are
+then improved by local search until no move improves the objective or the time budget ('Heuristic Time Budget (sec.)')
+runs out. The budget covers the whole heuristic: the adjacency is built with numpy, and if the greedy construction
+itself runs out of time, the partial assignment is returned (with shortfalls for the requests left short). Moves:
+- insert: assign a free tissue to a request with a free slot.
+- replace: assign a free tissue to a request in place of a more expensive one.
+- move: move an assigned tissue to a request with a free slot.
+- swap: exchange the tissues of two requests (2-opt).
+- drop: unassign a tissue that costs more than the shortfall penalty.
+- augment: fill a free request slot along a short ejection chain of reassigned tissues.
+The KPI summary reports a cheap lower bound from two relaxations: every request gets its N cheapest candidates
+independently of the other requests, or (with alternative assignments) every tissue goes to its best request
+independently of the request caps.
+"""
+from bisect import bisect_left
+from time import time
+
+import numpy as np
+
+from evermatch import instrumentation
+from evermatch.utils import timeit
+
+# Max. number of reassigned tissues along an augmenting path, to cover requests in the exact coverage mode, and to fill
+# free request slots during the local search
+MAX_PATH_LENGTH = 200
+AUGMENT_DEPTH = 6
+
+# Number of edges filtered at once by the greedy construction, between two checks of the deadline
+GREEDY_BLOCK = 1 << 14
+
+
+class OptModel:
+    """Class to find a good solution of the optimization model quickly, within a time budget."""
+
+    def __init__(self, dat, name="EverMatch"):
+        self.dat = dat
+        self.params = dat.params
+        self.name = name
+        self._reset()
+
+    def _reset(self):
+        """Empties the model, before it is (re)built."""
+        self.weights = None  # objective coefficient of each candidate edge
+        self.cap = 1  # max. number of assignments of each request
+        self.shortfall = False  # whether a request can be short of assignments at a cost p per missing assignment
+        self.initial_edges = None
+        self.model_sln = dict()
+        self.complexities = list()
+
+    @timeit
+    def build_base_model(self):
+        self.weights = self.dat.edges.cost.copy()
+        print("#businesslog Heuristic model built successfully")
+
+    def add_complexity_alternative_assignments(self):
+        self.cap = self.dat.N
+        self.shortfall = True
+        self.complexities.append('alternative_assignments')
+
+    def add_complexity_relax_scored_requirement(self):
+        self.weights = self.weights - self.dat.edges.score
+        self.complexities.append('relax_scored_requirement')
+
+    @timeit
+    def update_assignments(self, removed_keys, added_keys):
+        """
+        Updates the model after OptInputData.apply_delta. The model only holds the edge weights, so it is rebuilt.
+        :param removed_keys: Keys of the candidate pairs dropped from dat.
+        :param added_keys: Keys of the candidate pairs created in dat.
+        """
+        complexities = self.complexities
+        self._reset()
+        self.build_base_model()
+        for complexity in complexities:
+            getattr(self, f'add_complexity_{complexity}')()
+
+    def set_initial_solution(self, edge_idx):
+        """
+        Starts the local search from an initial solution instead of the greedy one.
+        :param edge_idx: Positions in dat.edges of the assignments in the initial solution.
+        """
+        self.initial_edges = np.asarray(edge_idx, dtype=np.int64)
+        print(f"#businesslog Warm start with {len(self.initial_edges)} assignments")
+
+    def lower_bound(self, request_order=None):
+        """
+        Cheap lower bound on the objective value. The best of two relaxations:
+        - Without tissue uniqueness: each request takes its cheapest candidates (cheaper than the shortfall penalty
+          with alternative assignments), independently of the other requests.
+        - With alternative assignments, without the request caps: each tissue goes to its cheapest candidate if it is
+          cheaper than the penalty, reducing the total shortfall penalty p * N * |J|.
+        :param request_order: Optional (indptr, order) of the edges of each request by increasing weight (see
+        _LocalSearch), to avoid sorting the edges again.
+        """
+        dat = self.dat
+        edges = dat.edges
+        indptr, order = _request_major(edges, self.weights) if request_order is None else request_order
+        weights = self.weights[order]
+        rank = np.arange(len(order)) - np.repeat(indptr[:-1], np.diff(indptr))
+        if not self.shortfall:
+            return float(weights[rank == 0].sum())
+        best = np.minimum(weights[rank < self.cap], dat.p)
+        by_request = best.sum() + dat.p * (len(dat.J) * self.cap - len(best))
+        nonempty = np.diff(edges.indptr) > 0
+        best_tissue = np.minimum.reduceat(self.weights, edges.indptr[:-1][nonempty]) if len(edges) else np.empty(0)
+        by_tissue = dat.p * len(dat.J) * self.cap - np.maximum(dat.p - best_tissue, 0).sum()
+        return float(max(by_request, by_tissue))
+
+    @timeit
+    def optimize(self):
+        dat = self.dat
+        if self.params['Write lp File'] not in ['None', 'none']:
+            print("#businesslog 'Write lp File' is only supported by the CBC solver backend")
+        print("#businesslog Running the fast heuristic...")
+        instrumentation.count(variables=len(dat.edges))
+        start = time()
+        search = _LocalSearch(dat.edges, self.weights, self.cap, dat.p if self.shortfall else None)
+        if self.initial_edges is not None:
+            search.start_from(self.initial_edges)
+        deadline = start + self.params['Heuristic Time Budget (sec.)']
+        if not search.greedy(deadline):
+            print("#businesslog The time budget ran out during the greedy construction")
+        if not self.shortfall:
+            search.cover_requests(dat.request_index.encode(dat.J), deadline)
+        search.improve(deadline)
+        solve_time = time() - start
+        self.model_sln = None
+        edge_idx = np.asarray(search.tissue_edge, dtype=np.int64)
+        edge_idx = edge_idx[edge_idx >= 0]
+        counts = np.bincount(dat.edges.request[edge_idx], minlength=dat.edges.n_requests)
+        requests = dat.request_index.encode(dat.J)
+        if not self.shortfall and (counts[requests] < 1).any():
+            print('#businesslog Optimization status: Not Solved (the heuristic could not cover all requests)')
+            return
+        print('#businesslog Optimization status: Feasible')
+        obj_val = float(self.weights[edge_idx].sum())
+        y = None
+        if self.shortfall:
+            y = (self.cap - counts[requests]).astype(float)
+            obj_val += float(dat.p * y.sum())
+        best_bound = min(self.lower_bound(search.request_order), obj_val)
+        mip_gap = 0.0 if obj_val == best_bound else abs(obj_val - best_bound) / max(abs(obj_val), 1e-10)
+        print(f"#businesslog Heuristic objective: {obj_val}, lower bound: {best_bound}, gap: {100 * mip_gap:.2f}%")
+        self.model_sln = dat.solution_dict('Feasible', edge_idx, y, obj_val, best_bound, mip_gap, solve_time)
+
+
+def _request_major(edges, weights, order=None):
+    """
+    Edges of each request by increasing weight.
+    :param edges: CandidateEdges.
+    :param weights: Objective coefficient of each edge.
+    :param order: Optional positions of the edges sorted by weight (stable), if already computed.
+    :return: (indptr, order) - the edges of request j are order[indptr[j]:indptr[j + 1]].
+    """
+    if order is None:
+        order = np.argsort(weights, kind='stable')
+    order = order[np.argsort(edges.request[order], kind='stable')]
+    indptr = np.searchsorted(edges.request[order], np.arange(edges.n_requests + 1)).astype(np.int64)
+    return indptr, order
+
+
+class _LocalSearch:
+    """Assignment state and moves of the heuristic, on plain lists for fast scalar access."""
+
+    def __init__(self, edges, weights, cap, penalty):
+        """
+        :param edges: CandidateEdges.
+        :param weights: Objective coefficient of each edge.
+        :param cap: Max. number of assignments of each request.
+        :param penalty: Shortfall penalty p, or None if every request must have exactly one assignment.
+        """
+        self.cap = cap
+        self.penalty = penalty
+        self.tissue_codes = edges.tissue
+        self.request_codes = edges.request
+        # edges by increasing weight, and the edges of each request by increasing weight
+        self.weight_order = np.argsort(weights, kind='stable')
+        self.request_order = _request_major(edges, weights, self.weight_order)
+        self.weight_array = weights
+        self.weights = weights.tolist()
+        self.edge_tissue = self.tissue_codes.tolist()
+        self.edge_request = self.request_codes.tolist()
+        self.indptr = edges.indptr.tolist()  # the edges of tissue i are indptr[i]:indptr[i + 1]
+        self.request_ptr = self.request_order[0].tolist()
+        self.request_edges = self.request_order[1].tolist()
+        self.tissue_edge = [-1] * edges.n_tissues  # assigned edge of each tissue
+        self.request_assigned = [set() for _ in range(edges.n_requests)]  # assigned edges of each request
+
+    def _assign(self, e):
+        self.tissue_edge[self.edge_tissue[e]] = e
+        self.request_assigned[self.edge_request[e]].add(e)
+
+    def _unassign(self, e):
+        self.tissue_edge[self.edge_tissue[e]] = -1
+        self.request_assigned[self.edge_request[e]].discard(e)
+
+    def _find(self, i, j):
+        """Position of edge (i, j), or -1 if it is not a candidate (same as CandidateEdges.find, on the lists)."""
+        lo, hi = self.indptr[i], self.indptr[i + 1]
+        k = bisect_left(self.edge_request, j, lo, hi)
+        return k if k < hi and self.edge_request[k] == j else -1
+
+    def _gain(self, e):
+        """Objective decrease of filling a free slot with edge e."""
+        return self.penalty - self.weights[e] if self.penalty is not None else 0.0
+
+    def start_from(self, edge_idx):
+        for e in edge_idx.tolist():
+            if (self.tissue_edge[self.edge_tissue[e]] < 0 and
+                    len(self.request_assigned[self.edge_request[e]]) < self.cap):
+                self._assign(e)
+
+    def greedy(self, deadline):
+        """
+        Assigns edges by increasing weight while the tissue is free and the request has a free slot. The edges are
+        filtered by blocks with numpy, so only the ones that can still be assigned are visited one by one.
+        :param deadline: Time after which the construction stops, leaving the remaining edges unassigned.
+        :return: False if the construction stopped at the deadline.
+        """
+        order = self.weight_order
+        if self.penalty is not None:
+            order = order[:np.searchsorted(self.weight_array[order], self.penalty)]
+        tissue_free = np.asarray(self.tissue_edge) < 0
+        request_count = np.array([len(assigned) for assigned in self.request_assigned])
+        for start in range(0, len(order), GREEDY_BLOCK):
+            if time() >= deadline:
+                return False
+            block = order[start:start + GREEDY_BLOCK]
+            block = block[tissue_free[self.tissue_codes[block]] & (request_count[self.request_codes[block]] < self.cap)]
+            for e in block.tolist():
+                i, j = self.edge_tissue[e], self.edge_request[e]
+                if self.tissue_edge[i] < 0 and len(self.request_assigned[j]) < self.cap:
+                    self._assign(e)
+                    tissue_free[i] = False
+                    request_count[j] += 1
+        return True
+
+    def cover_requests(self, requests, deadline):
+        """Assigns the requests left without a tissue along augmenting paths, when there is one, until the deadline."""
+        for j in requests.tolist():
+            if time() >= deadline:
+                return
+            if not self.request_assigned[j]:
+                path = self._find_path(j, set(), MAX_PATH_LENGTH)
+                if path is not None:
+                    self._apply_path(path)
+
+    def _find_path(self, j, visited, depth):
+        """
+        Finds an augmenting path from request j to a free tissue, trying cheaper edges first.
+        :return: Edges to assign along the path (each one replaces the current edge of its tissue), or None.
+        """
+        request_edges = self.request_edges[self.request_ptr[j]:self.request_ptr[j + 1]]
+        for e in request_edges:
+            i = self.edge_tissue[e]
+            if i not in visited and self.tissue_edge[i] < 0:
+                return [e]
+        if depth == 0:
+            return None
+        for e in request_edges:
+            i = self.edge_tissue[e]
+            if i in visited or self.tissue_edge[i] == e:
+                continue
+            visited.add(i)
+            path = self._find_path(self.edge_request[self.tissue_edge[i]], visited, depth - 1)
+            if path is not None:
+                return [e] + path
+        return None
+
+    def _path_cost(self, path):
+        """Change in the edge weights of applying an augmenting path."""
+        replaced = [self.tissue_edge[self.edge_tissue[e]] for e in path]
+        return sum(self.weights[e] for e in path) - sum(self.weights[e] for e in replaced if e >= 0)
+
+    def _apply_path(self, path):
+        for e in path:
+            current = self.tissue_edge[self.edge_tissue[e]]
+            if current >= 0:
+                self._unassign(current)
+        for e in path:
+            self._assign(e)
+
+    def improve(self, deadline):
+        """Applies improving moves until there is none or the deadline passes."""
+        improved = True
+        while improved and time() < deadline:
+            improved = False
+            if self.penalty is not None:
+                improved = self._fill_slots(deadline)
+            for i in range(len(self.tissue_edge)):
+                if self._improve_tissue(i):
+                    improved = True
+                if i % 64 == 0 and time() >= deadline:
+                    return
+
+    def _fill_slots(self, deadline):
+        """
+        Fills free request slots along short augmenting paths (ejection chains) cheaper than the shortfall. As in Kuhn's
+        algorithm, tissues visited by failed searches are not visited again until a path is applied.
+        :return: True if any slot was filled.
+        """
+        improved, visited = False, set()
+        for j in range(len(self.request_assigned)):
+            if len(self.request_assigned[j]) < self.cap:
+                path = self._find_path(j, visited, AUGMENT_DEPTH)
+                if path is not None and self._path_cost(path) < self.penalty - 1e-9:
+                    self._apply_path(path)
+                    visited = set()
+                    improved = True
+                if time() >= deadline:
+                    break
+        return improved
+
+    def _improve_tissue(self, i):
+        """Applies the best improving move of tissue i, if any."""
+        weights, current = self.weights, self.tissue_edge[i]
+        best_gain, best_move = 1e-9, None
+        if current >= 0 and self.penalty is not None and weights[current] - self.penalty > best_gain:
+            # drop an assignment that costs more than the shortfall
+            best_gain, best_move = weights[current] - self.penalty, ('drop',)
+        for e in range(self.indptr[i], self.indptr[i + 1]):
+            if e == current:
+                continue
+            j = self.edge_request[e]
+            assigned = self.request_assigned[j]
+            if len(assigned) < self.cap:
+                # insert (free tissue) or move (assigned tissue) into a free slot
+                if current < 0:
+                    gain = self._gain(e)
+                elif self.penalty is not None:
+                    gain = weights[current] - weights[e]
+                else:
+                    continue
+                if gain > best_gain:
+                    best_gain, best_move = gain, ('insert', e)
+            elif current < 0:
+                # replace the most expensive tissue of the request
+                worst = max(assigned, key=weights.__getitem__)
+                gain = weights[worst] - weights[e]
+                if gain > best_gain:
+                    best_gain, best_move = gain, ('replace', e, worst)
+            else:
+                # swap with a tissue of the request, if it is a candidate of the current request
+                j1 = self.edge_request[current]
+                for other in assigned:
+                    back = self._find(self.edge_tissue[other], j1)
+                    if back < 0:
+                        continue
+                    gain = weights[current] + weights[other] - weights[e] - weights[back]
+                    if gain > best_gain:
+                        best_gain, best_move = gain, ('swap', e, other, back)
+        if best_move is None:
+            return False
+        if current >= 0:
+            self._unassign(current)
+        if best_move[0] == 'replace':
+            self._unassign(best_move[2])
+        elif best_move[0] == 'swap':
+            self._unassign(best_move[2])
+            self._assign(best_move[3])
+        if best_move[0] != 'drop':
+            self._assign(best_move[1])
+        return True
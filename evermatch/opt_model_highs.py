@@ -0,0 +1,175 @@
+"""
+Matrix-form optimization model for the Ever Sight matching problem.
+
+This module has one class, OptModel, with the same interface as opt_model_pulp.OptModel. The constraint matrix is
+assembled directly as a sparse matrix from the candidate edge arrays and the model is solved in-process by HiGHS
+(through scipy.optimize.milp), so there are no expression objects, temporary files or solver subprocess.
+
+Columns are laid out as x (one per candidate edge, in edge order) followed by y (one per request in dat.J).
+"""
+from time import time
+
+import numpy as np
+
+from evermatch import instrumentation
+from evermatch.utils import timeit
+
+STATUS = {0: 'Optimal', 1: 'Not Solved', 2: 'Infeasible', 3: 'Unbounded', 4: 'Undefined'}
+
+
+class OptModel:
+    """Class to define and solve the optimization model in matrix form."""
+
+    def __init__(self, dat, name="EverMatch"):
+        self.dat = dat
+        self.params = dat.params
+        self.name = name
+        self._reset()
+
+    def _reset(self):
+        """Empties the model, before it is (re)built."""
+        self.n_vars = dict()  # number of columns of each variable block
+        self.obj = dict()  # objective coefficients of each variable block
+        self.bounds = dict()  # (lower bounds, upper bounds, integrality) of each variable block
+        self.constraints = dict()  # constraint block name -> (sparse rows per variable block, lb, ub)
+        self.model_sln = dict()
+        self.complexities = list()
+        self.tissue_rows = None  # csr_matrix with one row per tissue in dat.I over the x columns
+        self.request_rows = None  # csr_matrix with one row per request in dat.J over the x columns
+
+    @timeit
+    def build_base_model(self):
+        self._add_decision_variables()
+        self._add_constraints()
+        self._add_objective()
+        print("#businesslog Base optimization model built successfully")
+
+    def _add_decision_variables(self):
+        print("#businesslog Adding decision variables...")
+        n = len(self.dat.edges)
+        # Binary
+        self.n_vars = {'x': n}
+        self.bounds = {'x': (np.zeros(n), np.ones(n), np.ones(n, dtype=np.uint8))}
+        self.obj = {'x': np.zeros(n)}
+
+    def _add_constraints(self):
+        print("#businesslog Adding constraints...")
+        from scipy import sparse
+
+        edges = self.dat.edges
+        n = len(edges)
+        # one row per tissue/request with at least one candidate, in dat.I/dat.J order
+        tissue_ptr = np.unique(edges.indptr)
+        self.tissue_rows = sparse.csr_matrix((np.ones(n), np.arange(n), tissue_ptr), shape=(len(tissue_ptr) - 1, n))
+        request_ptr, order = edges.by_request()
+        request_ptr = np.unique(request_ptr)
+        self.request_rows = sparse.csr_matrix((np.ones(n), order, request_ptr), shape=(len(request_ptr) - 1, n))
+
+        # Each tissue_df can be assigned to at most one tissue_df request_df
+        n_rows = self.tissue_rows.shape[0]
+        self.constraints['t'] = ({'x': self.tissue_rows}, np.full(n_rows, -np.inf), np.ones(n_rows))
+
+        # Each request_df must be assigned to exactly one tissue_df
+        if self.params['Request Coverage'] == 'Exactly one tissue_df per request_df':
+            n_rows = self.request_rows.shape[0]
+            self.constraints['r'] = ({'x': self.request_rows}, np.ones(n_rows), np.ones(n_rows))
+
+    def _add_objective(self):
+        print("#businesslog Adding objective function...")
+        cost = self.dat.edges.cost
+        self.obj['x'] = self.obj['x'] + cost
+
+    def add_complexity_alternative_assignments(self):
+        from scipy import sparse
+
+        dat = self.dat
+        n = len(dat.J)
+        # Add assignment shortfall variables
+        self.n_vars['y'] = n
+        self.bounds['y'] = (np.zeros(n), np.full(n, float(dat.N)), np.zeros(n, dtype=np.uint8))
+        # Add soft constraints for tissue_df request_df: sum(x) + y == N
+        self.constraints['r'] = ({'x': self.request_rows, 'y': sparse.identity(n, format='csr')},
+                                 np.full(n, float(dat.N)), np.full(n, float(dat.N)))
+        # Add assignment short fall penalty to the objective
+        penalty = np.full(n, float(dat.p))
+        self.obj['y'] = penalty
+        self.complexities.append('alternative_assignments')
+
+    def add_complexity_relax_scored_requirement(self):
+        self.obj['x'] = self.obj['x'] - self.dat.edges.score
+        self.complexities.append('relax_scored_requirement')
+
+    @timeit
+    def update_assignments(self, removed_keys, added_keys):
+        """
+        Updates the model after OptInputData.apply_delta. Assembling the arrays and sparse blocks from the candidate
+        edges is vectorized and takes about as long as patching them, so the model is rebuilt and the complexities are
+        added again.
+        :param removed_keys: Keys of the candidate pairs dropped from dat.
+        :param added_keys: Keys of the candidate pairs created in dat.
+        """
+        complexities = self.complexities
+        self._reset()
+        self.build_base_model()
+        for complexity in complexities:
+            getattr(self, f'add_complexity_{complexity}')()
+
+    def _constraint_matrix(self):
+        from scipy import sparse
+
+        blocks, lb, ub = list(), list(), list()
+        for rows, row_lb, row_ub in self.constraints.values():
+            n_rows = len(row_lb)
+            blocks.append([rows.get(v, sparse.csr_matrix((n_rows, n_cols))) for v, n_cols in self.n_vars.items()])
+            lb.append(row_lb)
+            ub.append(row_ub)
+        return sparse.bmat(blocks, format='csr'), np.concatenate(lb), np.concatenate(ub)
+
+    def set_initial_solution(self, edge_idx):
+        """
+        MIP starts are not exposed by scipy's HiGHS interface, so the initial solution is ignored.
+        :param edge_idx: Positions in dat.edges of the assignments in the initial solution.
+        """
+        print("#businesslog Warm start is not supported by the HiGHS solver backend, solving from scratch")
+
+    @timeit
+    def optimize(self):
+        from scipy.optimize import Bounds, LinearConstraint, milp
+
+        if self.dat.params['Write lp File'] not in ['None', 'none']:
+            print("#businesslog 'Write lp File' is only supported by the CBC solver backend")
+        print("#businesslog Solving the optimization model...")
+        if not len(self.dat.edges):
+            # no candidate pairs, so no requests to assign either: milp rejects a model without variables
+            print('#businesslog Optimization status: Optimal')
+            self.model_sln = self.dat.solution_dict('Optimal', [], np.zeros(len(self.dat.J)) if 'y' in self.n_vars
+                                                    else None, 0.0, 0.0, 0.0, 0.0)
+            return
+        c = np.concatenate([self.obj[v] for v in self.n_vars])
+        lb, ub, integrality = (np.concatenate([self.bounds[v][k] for v in self.n_vars]) for k in range(3))
+        constraints = list()
+        if self.constraints:
+            a, a_lb, a_ub = self._constraint_matrix()
+            constraints.append(LinearConstraint(a, a_lb, a_ub))
+        instrumentation.count(variables=len(c), constraints=a.shape[0] if self.constraints else 0,
+                              nonzeros=a.nnz if self.constraints else 0)
+        options = {'disp': True, 'mip_rel_gap': self.params['MIP Gap']}
+        if self.params['Time Limit (sec.)']:
+            options['time_limit'] = self.params['Time Limit (sec.)']
+        start = time()
+        res = milp(c, integrality=integrality, bounds=Bounds(lb, ub), constraints=constraints, options=options)
+        solve_time = time() - start
+        self.model_sln = None
+        status = STATUS.get(res.status, 'Undefined')
+        print('#businesslog Optimization status: {}'.format(status))
+        if res.x is not None:
+            values, offset = dict(), 0
+            for v, n_cols in self.n_vars.items():
+                values[v] = res.x[offset:offset + n_cols]
+                offset += n_cols
+            values['x'] = np.round(values['x'])
+            obj_val = float(res.fun)
+            best_bound = np.nan if res.get('mip_dual_bound') is None else float(res.mip_dual_bound)
+            mip_gap = np.nan if res.get('mip_gap') is None else float(res.mip_gap)
+            self.model_sln = self.dat.solution_dict(status, np.flatnonzero(values['x'] > 0.5), values.get('y'), obj_val,
+                                                    best_bound, mip_gap, solve_time)
@@ -6,28 +6,42 @@ Created by Aster Santana (Jun 15, 20), Opex Analytics.
 This module has one class, OptModel, which defines the optimization model.
 """
 from evermatch.constants import output_path
-from evermatch.schemas import input_schema
+
+import itertools
+import os
+import re
+import tempfile
 
 import pulp
-import ticdat
+from evermatch import instrumentation
 from evermatch.utils import timeit
 import numpy as np
 
+# Characters of the IDs that are not allowed in the variable and constraint names of an lp file
+LP_NAME_ILLEGAL = re.compile(r'[^A-Za-z0-9_.]')
+
 
 class OptModel:
     """Class to define and solve the optimization model."""
 
     def __init__(self, dat, name="EverMatch"):
         self.dat = dat
-        self.params = input_schema.create_full_parameters_dict(dat.dat)
+        self.params = dat.params
         self.name = name
+        self._reset()
+
+    def _reset(self):
+        """Empties the model, before it is (re)built."""
         self.model = None
         self.vars = dict()
         self.kpi = dict()
         self.obj_function = 0.0
         self.model_sln = dict()
         self.complexities = list()
-        self.xx_keys = ticdat.Slicer(dat.x_keys)
+        self.warm_start = False
+        self.tissue_cons = dict()  # tissue ID -> 't_' constraint
+        self.request_cons = dict()  # request ID -> 'r_' constraint
+        self._serial = itertools.count()  # numbers the variables and constraints
 
     @timeit
     def build_base_model(self):
@@ -37,79 +51,232 @@ class OptModel:
         self._add_objective()
         print("#businesslog Base optimization model built successfully")
 
+    def _name(self, prefix, *ids):
+        """
+        Unique name of a new variable or constraint. Names are numbered in creation order, which keeps them unique when
+        tissues or requests change (see update_assignments). Numbers are zero-padded since pulp orders the variables by
+        name, so the columns of the model follow the candidate edges. When the lp file is written, the names end with
+        the IDs of the tissue and/or request, with the characters not allowed in an lp file replaced by '_', so the
+        file can be read.
+        :param prefix: Variable or constraint prefix ('x', 'y', 't' or 'r').
+        :param ids: Tissue and/or request IDs of the variable or constraint.
+        """
+        name = f'{prefix}_{next(self._serial):09d}'
+        if self.params['Write lp File'] in ['None', 'none']:
+            return name
+        return '_'.join([name, *(LP_NAME_ILLEGAL.sub('_', str(v)) for v in ids)])
+
     def _add_decision_variables(self):
         print("#businesslog Adding decision variables...")
         # Binary
-        x = pulp.LpVariable.dicts(indexs=self.dat.x_keys, cat=pulp.LpBinary, name='x')  # Assignment
+        x = {key: pulp.LpVariable(self._name('x', *key), cat=pulp.LpBinary) for key in self.dat.x_keys}  # Assignment
         self.vars = {'x': x}
 
+    def _tissue_variables(self):
+        """
+        Assignment variables grouped by tissue, from the CSR layout of the candidate edges.
+        :return: list of (tissue ID, list of x variables), in the order of dat.I.
+        """
+        dat = self.dat
+        xs = list(self.vars['x'].values())  # in the order of the candidate edges
+        indptr = dat.edges.indptr
+        nonempty = np.flatnonzero(np.diff(indptr))
+        return [(i, xs[lo:hi]) for i, lo, hi in zip(dat.I, indptr[nonempty].tolist(), indptr[nonempty + 1].tolist())]
+
+    def _request_variables(self):
+        """
+        Assignment variables grouped by request, from one pass over the request codes of the candidate edges.
+        :return: list of (request ID, list of x variables), in the order of dat.J.
+        """
+        dat = self.dat
+        xs = list(self.vars['x'].values())
+        indptr, order = dat.edges.by_request()
+        xs = [xs[k] for k in order.tolist()]
+        nonempty = np.flatnonzero(np.diff(indptr))
+        return [(j, xs[lo:hi]) for j, lo, hi in zip(dat.J, indptr[nonempty].tolist(), indptr[nonempty + 1].tolist())]
+
+    def _add_row(self, cons, key, terms, sense, rhs, prefix):
+        """Adds the constraint sum(coef * var for var, coef in terms) <sense> rhs to the model, as cons[key]."""
+        cons[key] = pulp.LpConstraint(terms, sense=sense, name=self._name(prefix, key), rhs=rhs)
+        self.model.addConstraint(cons[key])
+
     def _add_constraints(self):
         print("#businesslog Adding constraints...")
-        dat, m = self.dat, self.model
-        xx_keys = self.xx_keys
-        x = self.vars['x']
 
         # Each tissue_df can be assigned to at most one tissue_df request_df
-        for i in dat.I:
-            m.addConstraint(pulp.lpSum(x[key] for key in xx_keys.slice(i, '*')) <= 1, name=f't_{i}')
+        for i, xs in self._tissue_variables():
+            self._add_row(self.tissue_cons, i, zip(xs, itertools.repeat(1)), pulp.LpConstraintLE, 1, 't')
 
         # Each request_df must be assigned to exactly one tissue_df
         if self.params['Request Coverage'] == 'Exactly one tissue_df per request_df':
-            for j in dat.J:
-                m.addConstraint(pulp.lpSum(x[key] for key in xx_keys.slice('*', j)) == 1, name=f'r_{j}')
+            for j, xs in self._request_variables():
+                self._add_row(self.request_cons, j, zip(xs, itertools.repeat(1)), pulp.LpConstraintEQ, 1, 'r')
 
     def _add_objective(self):
         print("#businesslog Adding objective function...")
-        dat, m = self.dat, self.model
-        x = self.vars['x']
-        transportation_cost = pulp.lpSum(dat.tc[key] * x[key] for key in dat.x_keys)
+        dat = self.dat
+        transportation_cost = pulp.LpAffineExpression(zip(self.vars['x'].values(), dat.edges.cost.tolist()))
         self.kpi.update({'Transportation Cost': transportation_cost})
         self.obj_function += transportation_cost
 
     def add_complexity_alternative_assignments(self):
-        dat, m = self.dat, self.model
-        xx_keys = self.xx_keys
-        x = self.vars['x']
+        dat = self.dat
         # Add assignment shortfall variables
-        y = pulp.LpVariable.dicts(indexs=self.dat.J, cat=pulp.LpContinuous, lowBound=0, upBound=dat.N, name='y')
+        y = {j: pulp.LpVariable(self._name('y', j), lowBound=0, upBound=dat.N, cat=pulp.LpContinuous) for j in dat.J}
         self.vars['y'] = y
-        # Add soft constraints for tissue_df request_df
-        for j in dat.J:
-            m.addConstraint(pulp.lpSum(x[key] for key in xx_keys.slice('*', j)) == dat.N - y[j], name=f'r_{j}')
+        # Add soft constraints for tissue_df request_df: sum(x) == N - y
+        for j, xs in self._request_variables():
+            self._add_row(self.request_cons, j, [*zip(xs, itertools.repeat(1)), (y[j], 1)], pulp.LpConstraintEQ,
+                          dat.N, 'r')
         # Add assignment short fall penalty to the objective
-        assignment_shortfall_penalty = pulp.lpSum(dat.p * y[j] for j in dat.J)
+        assignment_shortfall_penalty = pulp.LpAffineExpression(zip(y.values(), itertools.repeat(dat.p)))
         self.kpi.update({'Assignment Shortfall Penalty': assignment_shortfall_penalty})
         self.obj_function += assignment_shortfall_penalty
+        self.complexities.append('alternative_assignments')
 
     def add_complexity_relax_scored_requirement(self):
         dat = self.dat
+        self.obj_function += pulp.LpAffineExpression(zip(self.vars['x'].values(), (-dat.edges.score).tolist()))
+        self.complexities.append('relax_scored_requirement')
+
+    @timeit
+    def update_assignments(self, removed_keys, added_keys):
+        """
+        Updates the model after OptInputData.apply_delta. pulp has no public API to remove variables or constraints, so
+        when some pairs are no longer candidates the model is rebuilt from the candidate edges (linear in their number)
+        and the complexities are added again. Otherwise the model is patched in place: variables are added for the new
+        pairs, with their tissue/request constraints (and shortfall variables), and the coefficients of the pairs that
+        changed are updated.
+        :param removed_keys: Keys of the candidate pairs dropped from dat.
+        :param added_keys: Keys of the candidate pairs created in dat. Keys in both lists keep their variable.
+        """
+        dat = self.dat
+        added = set(added_keys)
+        n_removed = sum(key not in added for key in removed_keys)
+        if n_removed:
+            complexities = self.complexities
+            self._reset()
+            self.build_base_model()
+            for complexity in complexities:
+                getattr(self, f'add_complexity_{complexity}')()
+            print(f"#businesslog Model rebuilt: {n_removed} candidate pairs removed, {len(added - set(removed_keys))} "
+                  f"added")
+            return
+
+        # region Add the variables of the new pairs and update the coefficients of the changed ones
         x = self.vars['x']
-        self.obj_function += -pulp.lpSum(dat.q[key] * x[key] for key in dat.x_keys)
+        relaxed = 'relax_scored_requirement' in self.complexities
+        transportation_cost = self.kpi['Transportation Cost']
+        for key in added_keys:
+            k = dat.edges.find(dat.tissue_index.code(key[0]), dat.request_index.code(key[1]))
+            cost, score = dat.edges.cost[k], dat.edges.score[k]
+            if key in x:
+                v = x[key]
+            else:
+                v = x[key] = pulp.LpVariable(self._name('x', *key), cat=pulp.LpBinary)
+                self._add_to_constraints(key, v)
+            self.obj_function[v] = cost - score if relaxed else cost
+            transportation_cost[v] = cost
+        # endregion
+
+        # keep the variables in the order of the candidate edges
+        self.vars['x'] = {key: x[key] for key in dat.x_keys}
+        self.warm_start = False
+        print(f"#businesslog Model updated: {len(added - set(removed_keys))} variables added")
+
+    def _add_to_constraints(self, key, v):
+        """Adds the assignment variable v = x[i, j] to the constraints of tissue i and request j, creating them."""
+        dat = self.dat
+        i, j = key
+        if i in self.tissue_cons:
+            self.tissue_cons[i].addterm(v, 1)
+        else:
+            self._add_row(self.tissue_cons, i, [(v, 1)], pulp.LpConstraintLE, 1, 't')
+        if 'alternative_assignments' in self.complexities:
+            if j in self.request_cons:
+                self.request_cons[j].addterm(v, 1)
+            else:
+                y = self.vars['y'][j] = pulp.LpVariable(self._name('y', j), lowBound=0, upBound=dat.N,
+                                                        cat=pulp.LpContinuous)
+                self._add_row(self.request_cons, j, [(v, 1), (y, 1)], pulp.LpConstraintEQ, dat.N, 'r')
+                self.obj_function[y] = dat.p
+                self.kpi['Assignment Shortfall Penalty'][y] = dat.p
+        elif self.params['Request Coverage'] == 'Exactly one tissue_df per request_df':
+            if j in self.request_cons:
+                self.request_cons[j].addterm(v, 1)
+            else:
+                self._add_row(self.request_cons, j, [(v, 1)], pulp.LpConstraintEQ, 1, 'r')
+
+    def set_initial_solution(self, edge_idx):
+        """
+        Sets a MIP start for the solver. Must be called after the model and its complexities are built.
+        :param edge_idx: Positions in dat.edges of the assignments in the initial solution (see
+        OptInputData.incumbent_from_matching).
+        """
+        dat = self.dat
+        selected = np.zeros(len(dat.edges), dtype=bool)
+        selected[edge_idx] = True
+        for (key, v), value in zip(self.vars['x'].items(), selected):
+            v.setInitialValue(int(value))
+        if 'y' in self.vars:
+            counts = np.bincount(dat.edges.request[selected], minlength=dat.edges.n_requests)
+            for j, v in self.vars['y'].items():
+                v.setInitialValue(dat.N - counts[dat.request_index.code(j)])
+        self.warm_start = True
+        print(f"#businesslog Warm start with {selected.sum()} assignments")
 
     @timeit
     def optimize(self):
         self.model.setObjective(self.obj_function)
         if self.dat.params['Write lp File'] not in ['None', 'none']:
             self.model.writeLP(self.dat.params['Write lp File'])
+        if instrumentation.enabled():
+            instrumentation.count(variables=self.model.numVariables(), constraints=self.model.numConstraints(),
+                                  nonzeros=sum(len(c) for c in self.model.constraints.values()))
         print("#businesslog Solving the optimization model...")
-        solver = pulp.PULP_CBC_CMD(msg=True)
-        sol = self.model.solve(solver)
-        vars_sln = dict()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, 'cbc.log')
+            solver = pulp.PULP_CBC_CMD(msg=False, timeLimit=self.params['Time Limit (sec.)'] or None,
+                                       gapRel=self.params['MIP Gap'], warmStart=self.warm_start, logPath=log_path)
+            sol = self.model.solve(solver)
+            with open(log_path) as f:
+                solver_log = f.read()
+        print(solver_log)
         self.model_sln = None
         status = pulp.LpStatus[self.model.status]
         print('#businesslog Optimization status: {}'.format(status))
         if sol is not None:
-            obj_val = pulp.value(self.model.objective)
-            best_bound = np.nan  # sol.solve_details.best_bound
-            mip_gap = np.nan  # sol.solve_details.mip_relative_gap
-            solve_time = self.model.solutionTime
-            kpis = {kpi_name: (kpi if isinstance(kpi, (float, int)) else pulp.value(kpi))
-                    for kpi_name, kpi in self.kpi.items()}
-            for var_name, var in self.vars.items():
-                vars_sln[var_name] = {key: v.value() for key, v in var.items()}
-            scores = [(i, j, round(self.dat.q[i, j] * round(v.value()), 2)) for (i, j), v in self.vars['x'].items()]
-            self.model_sln = {'status': status, 'vars': vars_sln, 'obj_val': obj_val, 'best_bound': best_bound,
-                              'mip_gap': mip_gap, 'solve_time': solve_time, 'kpis': kpis, 'scores': scores}
-
+            dat = self.dat
+            x = np.fromiter((v.varValue or 0.0 for v in self.vars['x'].values()), dtype=np.float64,
+                            count=len(self.vars['x']))
+            edge_idx = np.flatnonzero(x > 0.5)
+            obj_val = float(dat.edges.cost[edge_idx].sum())
+            if 'relax_scored_requirement' in self.complexities:
+                obj_val -= float(dat.edges.score[edge_idx].sum())
+            y = None
+            if 'y' in self.vars:
+                y = np.fromiter((self.vars['y'][j].varValue or 0.0 for j in dat.J), dtype=np.float64, count=len(dat.J))
+                obj_val += float(dat.p * y.sum())
+            best_bound, mip_gap = _read_cbc_bound(solver_log, obj_val)
+            self.model_sln = dat.solution_dict(status, edge_idx, y, obj_val, best_bound, mip_gap,
+                                               self.model.solutionTime)
 
 
+def _read_cbc_bound(solver_log, obj_val):
+    """
+    Reads the best bound from the CBC log and computes the relative MIP gap.
+    CBC reports 'Lower bound' when it stops before proving optimality. Otherwise the bound is the objective value.
+    :return: (best bound, MIP gap)
+    """
+    match = re.search(r'^Lower bound:\s*(\S+)', solver_log, flags=re.MULTILINE)
+    if match:
+        best_bound = float(match.group(1))
+    elif re.search(r'^Result - Optimal solution found', solver_log, flags=re.MULTILINE):
+        best_bound = obj_val
+    else:
+        return np.nan, np.nan
+    if obj_val is None:
+        return best_bound, np.nan
+    if obj_val == best_bound:
+        return best_bound, 0.0
+    return best_bound, abs(obj_val - best_bound) / max(abs(obj_val), 1e-10)
@@ -2,14 +2,43 @@
 Module that builds the optimization model.
 
 Created by Aster Santana (Jul 14, 20), Opex Analytics.
+
+The model is built by one of the solver backends below, selected with the 'Solver Backend' parameter. A backend is a
+class taking an OptInputData that implements build_base_model(), add_complexity_alternative_assignments(),
+add_complexity_relax_scored_requirement() and optimize(), after which model_sln holds the solution dictionary read by
+OptOutputData.
+
+With 'Solve Mode' = 'Fast heuristic', the model is opt_model_heuristic.OptModel (same interface) whatever the backend.
+
+Backend modules (and their solver libraries) are only imported when a model is built with them.
 """
+import importlib
+
+from evermatch import instrumentation
+
+SOLVER_BACKENDS = {
+    'CBC': 'evermatch.opt_model_pulp',  # pulp expressions, CBC subprocess
+    'HiGHS': 'evermatch.opt_model_highs',  # sparse matrix, HiGHS in-process (requires scipy)
+    'Min-Cost Flow': 'evermatch.opt_model_flow'  # exact min-cost assignment, no MIP solver (requires scipy)
+    }
 
-from evermatch.opt_model_pulp import OptModel
+HEURISTIC_MODULE = 'evermatch.opt_model_heuristic'
 
 
-def build_optimization_model(opt_input_dat, params):
+@instrumentation.traced()
+def build_optimization_model(opt_input_dat, params, backend=None):
+    """
+    Builds the optimization model according to the user input parameters.
+    :param opt_input_dat: An OptInputData.
+    :param params: Full parameters dictionary.
+    :param backend: Solver backend name (a key of SOLVER_BACKENDS). Defaults to the 'Solver Backend' parameter. Not
+    used in the 'Fast heuristic' solve mode.
+    :return: The optimization model, ready to be optimized.
+    """
+    backend = backend or params['Solver Backend']
     # Build base optimization model
-    opt_model = OptModel(opt_input_dat)
+    module = HEURISTIC_MODULE if params['Solve Mode'] == 'Fast heuristic' else SOLVER_BACKENDS[backend]
+    opt_model = importlib.import_module(module).OptModel(opt_input_dat)
     opt_model.build_base_model()
     # Add complexities
     if params['Request Coverage'] == 'Flexible with alternative options':
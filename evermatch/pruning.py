@@ -0,0 +1,169 @@
+"""
+Top-K pruning of the candidate pairs, with an optimality certificate.
+
+A request needs at most N tissues, yet it may have hundreds of candidate tissues, most of them with an objective
+coefficient (tc - q, or tc if the scored requirements are not relaxed) far above its best options. With the
+'Candidate Pruning Top-K' parameter set to K > 0, the model is built over the K best candidate pairs of each request and
+of each tissue only.
+
+The constraint matrix of the model is totally unimodular, so its LP relaxation has the same optimal value as the MIP.
+The pruned LP is solved (HiGHS, through scipy) and its duals u (request constraints) and v (tissue constraints) give the
+reduced cost c - u - v of every pruned pair. If none is negative, the duals are feasible for the full LP, and the pruned
+model has the same optimal value as the full model. Otherwise, the K pairs with the most negative reduced cost of each
+request are added and the check is repeated (K is doubled if the pruned LP is infeasible). With alternative
+assignments, pairs costing more than the shortfall penalty p are never in an optimal solution (leaving the slot short
+is cheaper), so they are not checked.
+
+Pruning pays off with the MIP backends (CBC, HiGHS), whose solve time grows quickly with the number of variables. The
+Min-Cost Flow backend usually solves the full model faster than the certificate LPs.
+"""
+
+import numpy as np
+
+import evermatch.optimization as optimization
+from evermatch import instrumentation
+from evermatch.utils import timeit
+
+PRUNING_PARAMETER = 'Candidate Pruning Top-K'
+
+
+def enabled(params):
+    """
+    :return: Whether the candidate pairs are pruned. Writing the lp file requires the full model and the heuristic solve
+    mode has its own search, so pruning is skipped in these cases.
+    """
+    return (bool(params[PRUNING_PARAMETER]) and params['Solve Mode'] != 'Fast heuristic' and
+            params['Write lp File'] in ['None', 'none'])
+
+
+def objective_coefficients(opt_input_dat, params):
+    """Objective coefficient of the x variable of each candidate edge."""
+    edges = opt_input_dat.edges
+    c = np.asarray(edges.cost, dtype=np.float64)
+    if params['Requirement Satisfaction'] == 'Relax scored requirements':
+        c = c - edges.score
+    return c
+
+
+def _group_rank(group, c):
+    """Rank of each edge within its group (tissue or request code), by increasing coefficient c."""
+    order = np.lexsort((c, group))
+    sorted_group = group[order]
+    starts = np.flatnonzero(np.r_[True, sorted_group[1:] != sorted_group[:-1]])
+    counts = np.diff(np.r_[starts, len(group)])
+    rank = np.empty(len(group), dtype=np.int64)
+    rank[order] = np.arange(len(group)) - np.repeat(starts, counts)
+    return rank
+
+
+def top_k_mask(edges, c, k):
+    """Flags the edges among the k best (lowest c) of their request or of their tissue."""
+    return (_group_rank(edges.request, c) < k) | (_group_rank(edges.tissue, c) < k)
+
+
+def lp_duals(opt_input_dat, params, c, kept):
+    """
+    Solves the LP relaxation of the model over some of the candidate edges.
+    :param opt_input_dat: An OptInputData.
+    :param params: Full parameters dictionary.
+    :param c: Objective coefficient of each edge (see objective_coefficients).
+    :param kept: bool array flagging the edges of the model. Every request with candidates must have a kept edge.
+    :return: (u, v) - the duals of the constraints of each request code and each tissue code, or None if the LP has no
+    optimal solution.
+    """
+    from scipy import sparse
+    from scipy.optimize import linprog
+
+    edges = opt_input_dat.edges
+    idx = np.flatnonzero(kept)
+    n = len(idx)
+    # one row per request with candidates, as in the model
+    requests, request_rows = np.unique(edges.request, return_inverse=True)
+    request_rows = request_rows[idx]
+    a_request = sparse.csr_matrix((np.ones(n), (request_rows, np.arange(n))), shape=(len(requests), n))
+    a_tissue = sparse.csr_matrix((np.ones(n), (edges.tissue[idx], np.arange(n))), shape=(edges.n_tissues, n))
+    # x <= 1 and y <= N are implied by the constraints, and are left out so the reduced costs only depend on u and v
+    bounds = (0, None)
+    if params['Request Coverage'] == 'Flexible with alternative options':
+        # shortfall variables y, with sum(x) + y == N
+        n_requests = len(requests)
+        objective = np.concatenate([c[idx], np.full(n_requests, float(opt_input_dat.p))])
+        a_eq = sparse.hstack([a_request, sparse.identity(n_requests)], format='csr')
+        a_ub = sparse.hstack([a_tissue, sparse.csr_matrix((edges.n_tissues, n_requests))], format='csr')
+        b_eq = np.full(n_requests, float(opt_input_dat.N))
+    else:
+        objective, a_eq, a_ub, b_eq = c[idx], a_request, a_tissue, np.ones(len(requests))
+    res = linprog(objective, A_ub=a_ub, b_ub=np.ones(edges.n_tissues), A_eq=a_eq, b_eq=b_eq, bounds=bounds,
+                  method='highs')
+    if res.status != 0:
+        return None
+    u = np.zeros(edges.n_requests)
+    u[requests] = res.eqlin.marginals
+    return u, res.ineqlin.marginals
+
+
+@timeit
+def prune(opt_input_dat, params, initial_edges=None):
+    """
+    Finds a subset of the candidate edges over which the model has the same optimal value as over all of them.
+    :param opt_input_dat: An OptInputData.
+    :param params: Full parameters dictionary.
+    :param initial_edges: Optional positions of the assignments of an initial solution, which are always kept.
+    :return: (kept_idx, k) - the sorted positions of the kept edges and the final K.
+    """
+    edges = opt_input_dat.edges
+    c = objective_coefficients(opt_input_dat, params)
+    checked = np.ones(len(edges), dtype=bool)
+    if params['Request Coverage'] == 'Flexible with alternative options':
+        checked = c <= opt_input_dat.p
+    extra = np.zeros(len(edges), dtype=bool)
+    if initial_edges is not None:
+        extra[initial_edges] = True
+    tol = 1e-7 * max(1.0, float(np.abs(c).max(initial=0.0)))
+    k, rounds = params[PRUNING_PARAMETER], 0
+    while True:
+        rounds += 1
+        kept = top_k_mask(edges, c, k) | extra
+        if kept.all():
+            break
+        duals = lp_duals(opt_input_dat, params, c, kept)
+        if duals is None:
+            if lp_duals(opt_input_dat, params, c, np.ones(len(edges), dtype=bool)) is None:
+                # the full model has no solution either
+                kept[:] = True
+                break
+            k *= 2
+            continue
+        u, v = duals
+        reduced_cost = c - u[edges.request] - v[edges.tissue]
+        violated = ~kept & checked & (reduced_cost < -tol)
+        if not violated.any():
+            break
+        # grow each request with violated pairs by its k most violated ones
+        extra |= violated & (_group_rank(edges.request, np.where(violated, reduced_cost, np.inf)) < k)
+    kept_idx = np.flatnonzero(kept)
+    instrumentation.count(candidate_pairs=len(edges), kept_pairs=len(kept_idx), top_k=k, rounds=rounds)
+    print(f"#businesslog Candidate pruning: {len(kept_idx)} of {len(edges)} candidate pairs kept (K = {k}, "
+          f"{rounds} rounds)")
+    return kept_idx, k
+
+
+def solve_pruned(opt_input_dat, params, initial_edges=None):
+    """
+    Builds and solves the optimization model over the pruned candidate edges.
+    :param opt_input_dat: An OptInputData.
+    :param params: Full parameters dictionary.
+    :param initial_edges: Optional positions in opt_input_dat.edges of the assignments of an initial solution.
+    :return: Solution dictionary (see OptInputData.solution_dict), with 'x' as positions in opt_input_dat.edges, or
+    None.
+    """
+    kept_idx, _ = prune(opt_input_dat, params, initial_edges)
+    pruned = opt_input_dat if len(kept_idx) == len(opt_input_dat.edges) else opt_input_dat.subset(kept_idx)
+    opt_model = optimization.build_optimization_model(pruned, params)
+    if initial_edges is not None:
+        opt_model.set_initial_solution(np.searchsorted(kept_idx, np.sort(initial_edges)))
+    opt_model.optimize()
+    model_sln = opt_model.model_sln
+    if model_sln:
+        model_sln['x'] = kept_idx[model_sln['x']]
+    return model_sln
@@ -56,7 +56,18 @@ input_schema.add_parameter(name='Time Limit (sec.)', default_value=12 * 60**2, n
                            min=0, max=20*60**2, inclusive_min=True, inclusive_max=True)
 input_schema.add_parameter(name='MIP Gap', default_value=0.01, number_allowed=True, must_be_int=False,
                            min=0, max=1, inclusive_min=True, inclusive_max=True)
+input_schema.add_parameter(name='Solve Mode', default_value='Exact', number_allowed=False,
+                           strings_allowed=['Exact', 'Fast heuristic'])
+input_schema.add_parameter(name='Heuristic Time Budget (sec.)', default_value=1, number_allowed=True, must_be_int=False,
+                           min=0, max=20*60**2, inclusive_min=True, inclusive_max=True)
+input_schema.add_parameter(name='Solver Backend', default_value='CBC', number_allowed=False,
+                           strings_allowed=['CBC', 'HiGHS', 'Min-Cost Flow'])
+input_schema.add_parameter(name='Parallel Workers', default_value=0, number_allowed=True, must_be_int=True,
+                           min=0, max=256, inclusive_min=True, inclusive_max=True)
+input_schema.add_parameter(name='Candidate Pruning Top-K', default_value=0, number_allowed=True, must_be_int=True,
+                           min=0, max=10000, inclusive_min=True, inclusive_max=True)
 input_schema.add_parameter(name='Write lp File', default_value='None', number_allowed=False, strings_allowed="*")
+input_schema.add_parameter(name='Stage Cache', default_value='Off', number_allowed=False, strings_allowed=['On', 'Off'])
 input_schema.add_parameter(name='Request Coverage', default_value='Flexible with alternative options',
                            number_allowed=False,
                            strings_allowed=['Exactly one tissue_df per request_df',
@@ -87,6 +98,10 @@ input_schema.add_parameter(name='Reward Type', default_value='Dynamic Reward', n
 
 # region APPLY DATA TYPES AND PREDICATES TO THE INPUT SCHEMAS
 
+# Column-wise versions of the row predicates, {(table, predicate name): function of the table DataFrame returning a
+# bool Series}, with the same result as the row predicate on every row (see validation.py)
+vectorized_row_predicates = dict()
+
 # region locations
 table_name = "locations"
 text_fields = ['Site ID', 'Hospital']
@@ -167,6 +182,7 @@ input_schema.add_foreign_key(table_name, 'surgeons', [('Surgeon ID', 'Surgeon ID
 input_schema.add_foreign_key(table_name, 'locations', [('Site ID', 'Site ID')])
 input_schema.add_data_row_predicate(table_name, predicate_name="Age Min <= Age Max",
                                     predicate=lambda row: row['Age Min'] <= row['Age Max'])
+vectorized_row_predicates[table_name, "Age Min <= Age Max"] = lambda df: df['Age Min'] <= df['Age Max']
 # endregion
 
 # region surgeons_pref
@@ -182,9 +198,24 @@ for col in score_fields:
 input_schema.add_foreign_key(table_name, 'surgeons', [('Surgeon ID', 'Surgeon ID')])
 input_schema.add_data_row_predicate(table_name, predicate_name="Scores add up to 1.0",
                                     predicate=lambda row: abs(sum(row[col_] for col_ in score_fields) - 1) < 1e-4)
+vectorized_row_predicates[table_name, "Scores add up to 1.0"] = \
+    lambda df: (df[score_fields].sum(axis=1, skipna=False) - 1).abs() < 1e-4
 # endregion
 # endregion
 
+# region ID DOMAINS
+# Input schema fields holding the IDs of each domain. The fields of a domain share one categorical dtype inside the
+# pipeline (see indexing.intern_tables).
+id_domains = {
+    'site': [('locations', 'Site ID'), ('cost_matrix', 'Origin Site ID'), ('cost_matrix', 'Dest. Site ID'),
+             ('tissues', 'Current Site ID'), ('requests', 'Site ID')],
+    'surgeon': [('surgeons', 'Surgeon ID'), ('requests', 'Surgeon ID'), ('surgeons_pref', 'Surgeon ID')],
+    'tissue': [('tissues', 'Tissue ID')],
+    'request': [('requests', 'Request ID')],
+    'tissue use': [('requests', 'Tissue Use'), ('surgeons_pref', 'Tissue Use')]
+    }
+# endregion
+
 
 # region APPLY DATA TYPES AND PREDICATES TO THE OUTPUT SCHEMA
 
@@ -0,0 +1,75 @@
+"""
+Scoring of the soft (relaxed) requirements for the Ever Sight matching problem.
+
+Computes the score q[i, j] of every candidate pair in one batched pass over aligned arrays. The per-pair rules are:
+- Fixed Reward: a requirement that is met earns its full surgeon preference weight.
+- Dynamic Reward: the weight is scaled by the relative slack (positive) or violation (negative) of the requirement.
+- Age range is always rewarded in full inside the range and scaled by the relative violation outside it.
+A zero bound has no relative scale: where the score would be scaled by bound, a requirement with a zero bound earns its
+full weight when it is met and loses it when it is violated.
+"""
+
+import numpy as np
+
+# surgeons_pref score fields
+SCORE_FIELDS = ['Cell Count Min', 'Age Range', 'Death to Recovery Max (hrs.)', 'Death to Surgery Max (days)',
+                'Death to Cooling Max (hrs.)', 'Tissue Origin']
+
+
+def _as_float(values):
+    return np.asarray(values, dtype=np.float64)
+
+
+def _relative(slack, bound, where):
+    """
+    Relative slack (positive) or violation (negative) slack / bound, computed only where selected.
+    :param slack: How much the requirement is met by (negative if violated).
+    :param bound: Bound of the requirement.
+    :param where: Mask of the pairs whose relative slack is used.
+    :return: float array with slack / bound, or 1 (met) / -1 (violated) where bound is 0.
+    """
+    return np.divide(slack, bound, out=np.where(slack >= 0, 1.0, -1.0), where=where & (bound != 0))
+
+
+def _lower_bound_score(weight, value, bound, fixed):
+    """Score of a 'value >= bound' requirement."""
+    full = fixed & (bound <= value)
+    return np.where(full, weight, weight * _relative(value - bound, bound, ~full))
+
+
+def _upper_bound_score(weight, value, bound, fixed):
+    """Score of a 'value <= bound' requirement."""
+    full = fixed & (value <= bound)
+    return np.where(full, weight, weight * _relative(bound - value, bound, ~full))
+
+
+def soft_requirement_scores(pairs, weights, reward_type):
+    """
+    Computes the soft requirement score of each candidate pair.
+    :param pairs: Mapping from tissues/requests field names to arrays aligned with the candidate pairs. Must have
+    'Cell Count', 'Cell Count Min', 'Donor Age', 'Age Min', 'Age Max', 'Death to Recovery (hrs.)',
+    'Death to Recovery Max (hrs.)', 'Death to Surgery (days)', 'Death to Surgery Max (days)',
+    'Death to Cooling (hrs.)' and 'Death to Cooling Max (hrs.)'.
+    :param weights: Mapping from surgeons_pref score fields to arrays aligned with the candidate pairs.
+    :param reward_type: 'Fixed Reward' or 'Dynamic Reward'.
+    :return: float array with the score of each candidate pair.
+    """
+    fixed = reward_type == 'Fixed Reward'
+    cc, ccl = _as_float(pairs['Cell Count']), _as_float(pairs['Cell Count Min'])
+    a, al, au = _as_float(pairs['Donor Age']), _as_float(pairs['Age Min']), _as_float(pairs['Age Max'])
+    dr, dru = _as_float(pairs['Death to Recovery (hrs.)']), _as_float(pairs['Death to Recovery Max (hrs.)'])
+    ds, dsu = _as_float(pairs['Death to Surgery (days)']), _as_float(pairs['Death to Surgery Max (days)'])
+    # death to cooling is scored against the request's death to recovery max
+    dc, dcu = _as_float(pairs['Death to Cooling (hrs.)']), _as_float(pairs['Death to Recovery Max (hrs.)'])
+    w = {col: _as_float(weights[col]) for col in SCORE_FIELDS}
+
+    cq = _lower_bound_score(w['Cell Count Min'], cc, ccl, fixed)
+    inside, below = (al <= a) & (a <= au), a < al
+    aq = np.select(
+        [inside, below],
+        [w['Age Range'], w['Age Range'] * _relative(a - al, al, below)],
+        default=w['Age Range'] * _relative(au - a, au, ~inside & ~below))
+    drq = _upper_bound_score(w['Death to Recovery Max (hrs.)'], dr, dru, fixed)
+    dsq = _upper_bound_score(w['Death to Surgery Max (days)'], ds, dsu, fixed)
+    dcq = _upper_bound_score(w['Death to Cooling Max (hrs.)'], dc, dcu, fixed)
+    return cq + aq + drq + dsq + dcq
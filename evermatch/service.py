@@ -0,0 +1,387 @@
+"""
+Long-running matching service for the Ever Sight matching problem.
+
+The service loads the input data once and keeps it resident with all its derived structures (ID indices, cost index,
+candidate edges and the optimization model of an incremental.IncrementalSolver), so master data (locations, surgeons,
+surgeons_pref and cost_matrix) is never re-loaded between solves. Clients send tissue/request updates and solve
+requests over HTTP (on a TCP port or a local unix socket) and get rpt_matching back as JSON.
+
+Endpoints (JSON bodies and responses):
+- GET /health - status and data sizes.
+- GET /metrics - request, batch and solve counters and latencies.
+- POST /delta - {"tissues": [rows], "requests": [rows], "removed_tissues": [IDs], "removed_requests": [IDs]}, rows with
+  the input schema fields. Applies the update to the data and model.
+- POST /solve - optional update (same body as /delta), then solve: {"status", "version", "rpt_matching": [rows],
+  "rpt_kpi_summary": [rows]}.
+
+Updates and solves are queued and processed by a single worker, in micro-batches: the operations that arrive while a
+batch is collected (batch_window seconds) or processed are handled together, with the updates applied in arrival order
+and a single solve shared by all the solve requests of the batch, after all its updates. A solve with no update since
+the last one returns the previous solution without re-optimizing. The solver runs in a worker thread, so health and
+metrics requests are answered while a batch is processed.
+
+Usage (from the evermatch directory):
+python service.py --port 8765
+python service.py --unix-socket /tmp/evermatch.sock
+"""
+
+import argparse
+import asyncio
+import collections
+import http.client
+import json
+import os
+import socket
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from time import perf_counter, time
+
+import numpy as np
+import pandas as pd
+
+from evermatch import constants
+from evermatch import table_cache
+from evermatch import validation
+from evermatch.incremental import IncrementalSolver
+from evermatch.schemas import input_schema
+
+# Default time (in seconds) the worker waits for more operations before processing a batch
+BATCH_WINDOW = 0.005
+
+# Number of recent request latencies kept for the metrics
+LATENCY_WINDOW = 1000
+
+DELTA_FIELDS = ['tissues', 'requests', 'removed_tissues', 'removed_requests']
+
+
+class ServiceError(Exception):
+    """Error reported to the client with an HTTP status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class MatchingService:
+    """Keeps the data and model of the matching problem in memory and serves updates and solves."""
+
+    def __init__(self, dat, backend=None, batch_window=BATCH_WINDOW):
+        """
+        Builds the optimization data and model (see IncrementalSolver). Solving is left to the first solve request.
+        :param dat: A good PanDat for the input schema.
+        :param backend: Solver backend name (see optimization.SOLVER_BACKENDS). Defaults to the 'Solver Backend'
+        parameter.
+        :param batch_window: Time (in seconds) the worker waits for more operations before processing a batch.
+        """
+        self.solver = IncrementalSolver(dat, backend)
+        self.batch_window = batch_window
+        self.version = 0  # number of updates applied
+        self.solved_version = None  # version of the last solution
+        self.solution = None  # response of the last solve
+        self._queue = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._started = time()
+        self.metrics = collections.Counter()
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._last_solve_time = None
+
+    # region Server
+    async def start(self, host='127.0.0.1', port=0, unix_socket=None):
+        """
+        Starts serving on a TCP port or a unix socket, and starts the batch worker.
+        :param host: Host of the TCP server.
+        :param port: Port of the TCP server (0 for any free port, see address()).
+        :param unix_socket: Path of a unix socket to serve on instead of TCP.
+        :return: The asyncio server.
+        """
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._batch_worker())
+        if unix_socket:
+            self.server = await asyncio.start_unix_server(self._handle_connection, unix_socket)
+        else:
+            self.server = await asyncio.start_server(self._handle_connection, host, port)
+        return self.server
+
+    def address(self):
+        """:return: (host, port) of the TCP server, or the path of the unix socket."""
+        return self.server.sockets[0].getsockname()
+
+    async def stop(self):
+        """Stops the server and the batch worker."""
+        self.server.close()
+        await self.server.wait_closed()
+        self._worker.cancel()
+        self._executor.shutdown(wait=True)
+
+    async def _handle_connection(self, reader, writer):
+        """Serves the HTTP/1.1 requests of one connection (kept alive unless the client asks otherwise)."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                start = perf_counter()
+                status, payload = await self._dispatch(method, target.split('?')[0], body)
+                self._latencies.append(perf_counter() - start)
+                data = json.dumps(payload, default=_json_default).encode()
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                writer.write(f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                             f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, path, body):
+        """:return: (HTTP status, JSON payload) of a request."""
+        routes = {('GET', '/health'): self._health, ('GET', '/metrics'): self._metrics,
+                  ('POST', '/delta'): self._delta, ('POST', '/solve'): self._solve}
+        handler = routes.get((method, path))
+        self.metrics[f'requests {path}'] += 1
+        if handler is None:
+            return 404, {'error': f'No endpoint {method} {path}'}
+        try:
+            return 200, await handler(json.loads(body) if body else dict())
+        except ServiceError as e:
+            self.metrics['errors'] += 1
+            return e.status, {'error': str(e)}
+        except json.JSONDecodeError as e:
+            self.metrics['errors'] += 1
+            return 400, {'error': f'Invalid JSON body: {e}'}
+        except Exception as e:
+            self.metrics['errors'] += 1
+            traceback.print_exc()
+            return 500, {'error': repr(e)}
+    # endregion
+
+    # region Endpoints
+    async def _health(self, body):
+        dat = self.solver.dat
+        return {'status': 'ok', 'version': self.version, 'solved_version': self.solved_version,
+                'tissues': len(dat.tissues), 'requests': len(dat.requests),
+                'candidate_pairs': len(self.solver.opt_input_dat.edges)}
+
+    async def _metrics(self, body):
+        latencies = np.array(self._latencies) if self._latencies else np.zeros(1)
+        return {'uptime': time() - self._started, **self.metrics,
+                'queued_operations': self._queue.qsize(), 'last_solve_time': self._last_solve_time,
+                'latency_mean': float(latencies.mean()), 'latency_p50': float(np.percentile(latencies, 50)),
+                'latency_p95': float(np.percentile(latencies, 95)), 'latency_max': float(latencies.max())}
+
+    async def _delta(self, body):
+        return await self._submit('delta', _parse_delta(body))
+
+    async def _solve(self, body):
+        delta = _parse_delta(body)
+        if any(len(v) for v in delta.values() if v is not None):
+            await self._submit('delta', delta)
+        return await self._submit('solve', None)
+    # endregion
+
+    # region Micro-batching
+    async def _submit(self, kind, payload):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((kind, payload, future))
+        return await future
+
+    async def _batch_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            if self.batch_window:
+                await asyncio.sleep(self.batch_window)
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self.metrics['batches'] += 1
+            self.metrics['batched_operations'] += len(batch)
+            self.metrics['max_batch_size'] = max(self.metrics['max_batch_size'], len(batch))
+            results = await loop.run_in_executor(self._executor, self._run_batch, [op[:2] for op in batch])
+            for (_, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _run_batch(self, operations):
+        """
+        Processes a batch of operations in the worker thread: updates in order, then one solve for all the solve
+        requests.
+        :param operations: list of (kind, payload).
+        :return: list with the result (or exception) of each operation.
+        """
+        results = [None] * len(operations)
+        for k, (kind, payload) in enumerate(operations):
+            if kind == 'delta':
+                try:
+                    results[k] = self._apply_delta(payload)
+                except Exception as e:
+                    results[k] = e
+        solves = [k for k, (kind, _) in enumerate(operations) if kind == 'solve']
+        if solves:
+            try:
+                solution = self._solve_current()
+            except Exception as e:
+                solution = e
+            for k in solves:
+                results[k] = solution
+        return results
+
+    def _apply_delta(self, delta):
+        tissues, requests = delta['tissues'], delta['requests']
+        _check_rows(tissues, requests)
+        removed_keys, added_keys = self.solver.apply_delta(tissues, requests, delta['removed_tissues'],
+                                                           delta['removed_requests'])
+        self.version += 1
+        self.metrics['deltas'] += 1
+        return {'version': self.version, 'removed_pairs': len(removed_keys), 'added_pairs': len(added_keys)}
+
+    def _solve_current(self):
+        if self.solved_version == self.version and self.solution is not None:
+            self.metrics['cached_solves'] += 1
+            return self.solution
+        start = perf_counter()
+        sln = self.solver.solve()
+        self._last_solve_time = perf_counter() - start
+        self.metrics['solves'] += 1
+        if sln is None:
+            self.solution = {'status': 'No solution', 'version': self.version, 'rpt_matching': list(),
+                             'rpt_kpi_summary': list()}
+        else:
+            self.solution = {'status': self.solver.opt_model.model_sln['status'], 'version': self.version,
+                             'rpt_matching': _records(sln.rpt_matching),
+                             'rpt_kpi_summary': _records(sln.rpt_kpi_summary)}
+        self.solved_version = self.version
+        return self.solution
+    # endregion
+
+
+def _parse_delta(body):
+    """Update of a request body, with the tissues and requests rows as DataFrames (input schema fields)."""
+    if not isinstance(body, dict) or set(body) - set(DELTA_FIELDS):
+        raise ServiceError(400, f'The body must be a JSON object with some of the fields {DELTA_FIELDS}')
+    rtn = dict()
+    for table in ['tissues', 'requests']:
+        rows = body.get(table)
+        fields = list(input_schema.primary_key_fields[table]) + list(input_schema.data_fields[table])
+        rtn[table] = None if not rows else pd.DataFrame.from_records(rows, columns=fields)
+    for field in ['removed_tissues', 'removed_requests']:
+        rtn[field] = [str(v) for v in body.get(field) or ()]
+    return rtn
+
+
+def _check_rows(tissues, requests):
+    """Raises a ServiceError if the rows of an update have data type failures."""
+    tables = {t: df for t, df in [('tissues', tissues), ('requests', requests)] if df is not None}
+    if not tables:
+        return
+    # own cache directory, not to replace the cached validation results of the full tables
+    data_type_failures, _, _ = validation.find_failures(input_schema.PanDat(**tables), input_schema,
+                                                        os.path.join(constants.cache_path, 'service'))
+    failures = [f'{key.table}.{key.field}' for key in data_type_failures if key.table in tables]
+    if failures:
+        raise ServiceError(400, f"Data type failures in the update: {', '.join(failures)}")
+
+
+def _records(df):
+    """Rows of a DataFrame as JSON-ready dicts, with missing values as None."""
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+
+def _json_default(value):
+    # numpy scalars
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class ServiceClient:
+    """Blocking client of a MatchingService, over a TCP port or a unix socket (one kept-alive connection)."""
+
+    def __init__(self, host='127.0.0.1', port=None, unix_socket=None, timeout=None):
+        self.connection = (_UnixHTTPConnection(unix_socket, timeout=timeout) if unix_socket else
+                           http.client.HTTPConnection(host, port, timeout=timeout))
+
+    def request(self, method, path, body=None):
+        """
+        :return: The JSON response.
+        :raises ServiceError: if the response status is not 200.
+        """
+        data = None if body is None else json.dumps(body, default=_json_default).encode()
+        self.connection.request(method, path, body=data, headers={'Content-Type': 'application/json'})
+        response = self.connection.getresponse()
+        payload = json.loads(response.read())
+        if response.status != 200:
+            raise ServiceError(response.status, payload.get('error'))
+        return payload
+
+    def health(self):
+        return self.request('GET', '/health')
+
+    def metrics(self):
+        return self.request('GET', '/metrics')
+
+    def delta(self, tissues=None, requests=None, removed_tissues=(), removed_requests=()):
+        """Sends an update. tissues and requests are DataFrames or lists of dicts with the input schema fields."""
+        return self.request('POST', '/delta', _delta_body(tissues, requests, removed_tissues, removed_requests))
+
+    def solve(self, tissues=None, requests=None, removed_tissues=(), removed_requests=()):
+        """Sends an optional update and solves. :return: dict with 'status', 'version' and the output tables rows."""
+        return self.request('POST', '/solve', _delta_body(tissues, requests, removed_tissues, removed_requests))
+
+    def close(self):
+        self.connection.close()
+
+
+def _delta_body(tissues, requests, removed_tissues, removed_requests):
+    return {'tissues': _records(tissues) if isinstance(tissues, pd.DataFrame) else list(tissues or ()),
+            'requests': _records(requests) if isinstance(requests, pd.DataFrame) else list(requests or ()),
+            'removed_tissues': list(removed_tissues), 'removed_requests': list(removed_requests)}
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+async def serve(dat, host='127.0.0.1', port=0, unix_socket=None, backend=None, batch_window=BATCH_WINDOW):
+    """Runs a MatchingService until cancelled."""
+    service = MatchingService(dat, backend, batch_window)
+    server = await service.start(host, port, unix_socket)
+    print(f'#businesslog Matching service listening on {service.address()}')
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Ever Sight matching service.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix-socket', default=None, help='Serve on this unix socket instead of TCP.')
+    parser.add_argument('--backend', default=None)
+    parser.add_argument('--batch-window', type=float, default=BATCH_WINDOW)
+    args = parser.parse_args()
+    _dat = table_cache.create_pan_dat(input_schema, constants.input_path)
+    asyncio.run(serve(_dat, args.host, args.port, args.unix_socket, args.backend, args.batch_window))
@@ -5,44 +5,67 @@ Created by Aster Santana (May 26, 20), Opex Analytics.
 
 The solve function performs the following steps:
 - Prepares the input data for the optimization
-- Build de optimization model
-- Optimize
+- Build de optimization model and optimize, one independent batch of components at a time
 - Process the solution
 - Populates the output schema
 """
 
 import evermatch.data_maintemance as data_maintenance
-import evermatch.optimization as optimization
-from evermatch.schemas import input_schema, output_schema
+import evermatch.decomposition as decomposition
+from evermatch.schemas import input_schema, output_schema, id_domains
 from evermatch.opt_data import OptInputData, OptOutputData
 from evermatch import constants
+from evermatch.indexing import intern_tables
+from evermatch import instrumentation
+from evermatch import stage_cache
+from evermatch import table_cache
 
 
-def solve(dat):
+def solve(dat, prev_sln=None):
     """
     Maps input data to the input optimization data, builds and solves the optimization model, and maps the solution
     to the output data.
     :param dat: A good TicDat for the input schema.
+    :param prev_sln: Optional TicDat for the output schema from a previous run. Its still-valid assignments are used
+    as the initial solution (warm start).
     :return: A good TicDat for the output schema, or None.
     """
 
-    data_maintenance.data_check(dat, input_schema)
-    data_maintenance.remove_inactive_records(dat)
-    params = input_schema.create_full_parameters_dict(dat)
+    with instrumentation.span('solve'):
+        with instrumentation.span('intern_ids'):
+            intern_tables(dat, id_domains)
+        with instrumentation.span('input_data_check'):
+            data_maintenance.data_check(dat, input_schema)
+        with instrumentation.span('remove_inactive_records'):
+            data_maintenance.remove_inactive_records(dat)
+        params = input_schema.create_full_parameters_dict(dat)
 
-    opt_input_dat = OptInputData(dat)
-    opt_model = optimization.build_optimization_model(opt_input_dat, params)
-    opt_model.optimize()
-    opt_output_dat = OptOutputData(opt_model.model_sln, params)
-    opt_output_dat.populate_output_schema(dat)
-    rtn = opt_output_dat.sln
+        with instrumentation.span('opt_input_data'):
+            opt_input_dat = OptInputData(dat)
+        model_sln = stage_cache.load_solution(opt_input_dat)
+        if model_sln is None:
+            initial_edges = None
+            if prev_sln is not None:
+                with instrumentation.span('warm_start') as span:
+                    initial_edges = opt_input_dat.incumbent_from_matching(prev_sln.rpt_matching)
+                    span.count(initial_assignments=len(initial_edges))
+            model_sln = decomposition.solve_by_components(opt_input_dat, params, initial_edges)
+            stage_cache.save_solution(opt_input_dat, model_sln)
+        with instrumentation.span('opt_output_data'):
+            opt_output_dat = OptOutputData(model_sln, params)
+            opt_output_dat.populate_output_schema(dat, opt_input_dat.cost_index)
+        rtn = opt_output_dat.sln
 
-    data_maintenance.data_check(rtn, output_schema)
+        with instrumentation.span('output_data_check'):
+            data_maintenance.data_check(rtn, output_schema)
     return rtn
 
 
 if __name__ == "__main__":
-    _dat = input_schema.csv.create_pan_dat(constants.input_path)
-    sln = solve(_dat)
+    _dat = table_cache.create_pan_dat(input_schema, constants.input_path)
+    _prev_sln = None
+    if (constants.output_path / 'rpt_matching.csv').exists():
+        _prev_sln = output_schema.csv.create_pan_dat(constants.output_path)
+    sln = solve(_dat, _prev_sln)
     print('#businesslog Writing data to the data base')
     output_schema.csv.write_directory(sln, constants.output_path)
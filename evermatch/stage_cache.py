@@ -0,0 +1,214 @@
+"""
+On-disk cache of the intermediate results of the solve pipeline, reused across runs and actions.
+
+Each stage of the pipeline only depends on part of the input:
+- candidates: the candidate (tissue, request) pairs, from the tissues and requests tables and the '* Max Violation'
+  parameters.
+- costs: the transportation cost of each candidate pair, from the candidates and the cost_matrix table.
+- scores: the soft requirement score of each candidate pair, from the candidates, the surgeons_pref table and the
+  'Reward Type' parameter.
+- solution: the optimal assignments, from the costs, the scores and the model and solver parameters.
+
+The key of a stage is a hash of the content of its input tables, of its parameters, of the source code of the modules
+that compute it and of the keys of the stages it depends on, so an entry is reused exactly when all of the inputs and
+the code of its stage are unchanged. Entries are stored as .npy
+arrays (plus a meta.json file) in <constants.cache_path>/stages/<stage>/<key>/, written under a temporary name and
+renamed so concurrent runs never read a partial entry. Reading an entry marks it as recently used, and the least
+recently used entries are removed when the cache grows over MAX_BYTES.
+
+Only optimal solutions are cached, so a solve stopped by the time limit is run again. A solution reused from the cache
+is flagged by the 'Cached Solution' KPI, and its solve time is not reported. The cache is off by default and is turned
+on with the 'Stage Cache' parameter. The solution is not cached when the lp file is written.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import evermatch
+from evermatch import constants
+from evermatch import instrumentation
+from evermatch.candidates import VIOLATION_PARAMETERS
+from evermatch.utils import evict_lru, frame_digest, module_digest
+
+CACHE_PARAMETER = 'Stage Cache'
+
+# Size of the cache over which the least recently used entries are removed
+MAX_BYTES = 2 * 1024 ** 3
+
+# Changed when the content of the entries changes, so entries written by older code are not reused
+FORMAT_VERSION = 2
+
+# Inputs of each stage: (input tables, parameters, modules computing it, upstream stages), in dependency order
+STAGES = {
+    'candidates': (['tissues', 'requests'], VIOLATION_PARAMETERS, ['candidates', 'indexing', 'opt_data'], []),
+    'costs': (['cost_matrix'], [], ['indexing', 'opt_data'], ['candidates']),
+    'scores': (['surgeons_pref'], ['Reward Type'], ['scoring', 'opt_data'], ['candidates']),
+    'solution': ([], ['Solve Mode', 'Solver Backend', 'MIP Gap', 'Time Limit (sec.)', 'Heuristic Time Budget (sec.)',
+                      'Candidate Pruning Top-K', 'Request Coverage', 'Num. of Assignments',
+                      'Assignment Shortfall Penalty', 'Requirement Satisfaction'],
+                 ['decomposition', 'optimization', 'pruning', 'opt_model_pulp', 'opt_model_highs', 'opt_model_flow',
+                  'opt_model_heuristic', 'opt_data'], ['costs', 'scores'])
+    }
+
+# Numeric values of the solution dictionary stored in the meta.json file of a solution entry
+SOLUTION_VALUES = ['obj_val', 'best_bound', 'mip_gap']
+
+# KPI added to the solution dictionary of a solution reused from the cache
+CACHED_KPI = 'Cached Solution'
+
+
+def enabled(params):
+    """:return: Whether the stage cache is used."""
+    return params[CACHE_PARAMETER] == 'On'
+
+
+@instrumentation.traced()
+def stage_keys(dat, params):
+    """
+    Fingerprints the inputs of each stage.
+    :param dat: The PanDat for the input schema that is optimized.
+    :param params: Full parameters dictionary.
+    :return: dict {stage: hex key}, or None if the cache is off.
+    """
+    if not enabled(params):
+        return None
+    table_digests = dict()
+    keys = dict()
+    for stage, (tables, parameters, modules, upstream) in STAGES.items():
+        digest = hashlib.sha1(f'{evermatch.__version__}/{FORMAT_VERSION}/{stage}'.encode())
+        for module in modules:
+            digest.update(f'{module}:{module_digest(module)}'.encode())
+        for table in tables:
+            if table not in table_digests:
+                table_digests[table] = frame_digest(getattr(dat, table))
+            digest.update(f'{table}:{table_digests[table]}'.encode())
+        digest.update(json.dumps({name: params[name] for name in parameters}, sort_keys=True, default=str).encode())
+        for name in upstream:
+            digest.update(keys[name].encode())
+        keys[stage] = digest.hexdigest()
+    return keys
+
+
+def _root(cache_path=None):
+    return os.path.join(cache_path or constants.cache_path, 'stages')
+
+
+def load(keys, stage, cache_path=None):
+    """
+    Loads the cache entry of a stage.
+    :param keys: Keys of the stages (see stage_keys), or None if the cache is off.
+    :param stage: Stage name (see STAGES).
+    :param cache_path: Cache directory. Defaults to constants.cache_path.
+    :return: dict {name: array} with the arrays of the entry and its 'meta' dict, or None on a cache miss.
+    """
+    if keys is None:
+        return None
+    path = os.path.join(_root(cache_path), stage, keys[stage])
+    if not os.path.isdir(path):
+        return None
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            rtn = {'meta': json.load(f)}
+        for name in rtn['meta']['arrays']:
+            rtn[name] = np.load(os.path.join(path, f'{name}.npy'), allow_pickle=False)
+        os.utime(path)  # most recently used
+    except (OSError, ValueError, KeyError):
+        return None
+    print(f"#businesslog Stage cache: reusing the {stage} of a previous run")
+    instrumentation.count(**{f'cached_{stage}': 1})
+    return rtn
+
+
+def save(keys, stage, arrays, meta=None, cache_path=None, max_bytes=None):
+    """
+    Saves the cache entry of a stage, then removes the least recently used entries if the cache is too large. Write
+    errors (e.g. a read-only cache directory) are ignored.
+    :param keys: Keys of the stages (see stage_keys), or None if the cache is off.
+    :param stage: Stage name (see STAGES).
+    :param arrays: dict {name: numpy array}.
+    :param meta: Optional JSON-serializable dict saved with the arrays.
+    :param cache_path: Cache directory. Defaults to constants.cache_path.
+    :param max_bytes: Max. size of the cache. Defaults to MAX_BYTES.
+    """
+    if keys is None:
+        return
+    path = os.path.join(_root(cache_path), stage, keys[stage])
+    if os.path.isdir(path):
+        return
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path))
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f'{name}.npy'), np.asarray(array), allow_pickle=False)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({**(meta or dict()), 'arrays': list(arrays)}, f)
+        os.rename(tmp_path, path)
+    except (OSError, ValueError):
+        # read-only cache directory, or another run saved the same entry first
+        if tmp_path is not None:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+    evict(cache_path, max_bytes)
+
+
+def evict(cache_path=None, max_bytes=None):
+    """
+    Removes the least recently used entries until the cache is at most max_bytes.
+    :param cache_path: Cache directory. Defaults to constants.cache_path.
+    :param max_bytes: Max. size of the cache. Defaults to MAX_BYTES.
+    :return: Number of entries removed.
+    """
+    root = _root(cache_path)
+    return evict_lru([os.path.join(root, stage) for stage in STAGES], MAX_BYTES if max_bytes is None else max_bytes)
+
+
+def _solution_enabled(opt_input_dat):
+    return opt_input_dat.stage_keys is not None and opt_input_dat.params['Write lp File'] in ['None', 'none']
+
+
+def load_solution(opt_input_dat):
+    """
+    :param opt_input_dat: An OptInputData.
+    :return: The cached solution dictionary (see OptInputData.solution_dict) of the same model, or None. Its solve
+    time is NaN, as the model is not solved, and its 'kpis' flag it with the CACHED_KPI.
+    """
+    if not _solution_enabled(opt_input_dat):
+        return None
+    entry = load(opt_input_dat.stage_keys, 'solution')
+    if entry is None:
+        return None
+    meta = entry['meta']
+    values = {name: np.nan if meta[name] is None else meta[name] for name in SOLUTION_VALUES}
+    rtn = opt_input_dat.solution_dict(meta['status'], entry['x'], entry.get('shortfall'), values['obj_val'],
+                                      values['best_bound'], values['mip_gap'], np.nan)
+    rtn['kpis'][CACHED_KPI] = 1
+    return rtn
+
+
+def save_solution(opt_input_dat, model_sln):
+    """
+    Caches a solution dictionary if it is optimal.
+    :param opt_input_dat: The OptInputData that was optimized.
+    :param model_sln: Its solution dictionary (see OptInputData.solution_dict), or None.
+    """
+    if not model_sln or model_sln['status'] != 'Optimal' or not _solution_enabled(opt_input_dat):
+        return
+    arrays = {'x': np.asarray(model_sln['x'], dtype=np.int64)}
+    if 'Assignment Shortfall Penalty' in model_sln['kpis']:
+        # shortfall of each request of opt_input_dat.J, from the listed non-zero ones
+        shortfalls = model_sln['shortfalls']
+        positions = pd.Index(np.asarray(opt_input_dat.J, dtype=object)).get_indexer(shortfalls['Request ID'])
+        arrays['shortfall'] = np.zeros(len(opt_input_dat.J))
+        arrays['shortfall'][positions] = shortfalls['Penalty'].to_numpy(dtype=np.float64)
+    meta = {'status': model_sln['status']}
+    for name in SOLUTION_VALUES:
+        value = model_sln[name]
+        meta[name] = None if value is None or np.isnan(value) else float(value)
+    save(opt_input_dat.stage_keys, 'solution', arrays, meta)
@@ -0,0 +1,195 @@
+"""
+Parameter sweep: solves the matching problem for a grid of parameter scenarios and compares their KPIs.
+
+The candidate pairs only depend on the parameters through the '* Max Violation' levels, and a pair that meets the
+requirements at some violation levels meets them at any looser levels. So the candidate superset is found once, at the
+loosest violation level of each requirement over all the scenarios, and the candidate pairs of each scenario are a
+subset of it, found by re-checking the superset pairs against the bounds of the scenario (no new range join). The
+transportation costs are computed once and the scores once per reward type. Each scenario is then a lean copy of the
+optimization data (see OptInputData.subset) with its own parameters, and the scenarios are solved in parallel worker
+processes.
+
+Usage (from the evermatch directory):
+python sweep.py --grid "Cell Count Max Violation=0%,10%,20%" --grid "Reward Type=Fixed Reward,Dynamic Reward"
+"""
+
+import argparse
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+import numpy as np
+import pandas as pd
+
+import evermatch.data_maintemance as data_maintenance
+import evermatch.optimization as optimization
+from evermatch import candidates
+from evermatch import constants
+from evermatch import pruning
+from evermatch import table_cache
+from evermatch.indexing import intern_tables
+from evermatch.opt_data import NUM_ASSIGNMENTS, OptInputData
+from evermatch.schemas import input_schema, id_domains
+from evermatch.utils import timeit
+
+
+def parameter_grid(grid):
+    """
+    Expands a grid of parameter values into scenarios.
+    :param grid: dict {parameter name: list of values}.
+    :return: list of dicts {parameter name: value}, one per combination of values.
+    """
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def _check_scenario(overrides):
+    for name, value in overrides.items():
+        chk = input_schema.parameters.get(name)
+        if chk is None:
+            raise ValueError(f"Unknown parameter '{name}'")
+        if chk.type_dictionary is not None and not chk.type_dictionary.valid_data(value):
+            raise ValueError(f"Invalid value {value!r} for parameter '{name}'")
+
+
+def _with_parameters(dat, params):
+    """Shallow copy of dat with its parameters table replaced by params."""
+    rtn = input_schema.PanDat(**{t: getattr(dat, t) for t in input_schema.all_tables})
+    rtn.parameters = pd.DataFrame({'Parameter': list(params), 'Value': pd.Series(list(params.values()), dtype=object)})
+    return rtn
+
+
+def scenario_data(superset, params, edge_idx, scores):
+    """
+    Optimization data of one scenario, as a lean copy of the superset data.
+    :param superset: OptInputData at the loosest violation levels.
+    :param params: Full parameters dictionary of the scenario.
+    :param edge_idx: Positions in superset.edges of the candidate pairs of the scenario.
+    :param scores: dict {reward type: score of each superset edge}.
+    :return: OptInputData with the data needed to build and solve the optimization model of the scenario.
+    """
+    rtn = superset.subset(edge_idx)
+    rtn.edges.score = scores[params['Reward Type']][edge_idx]
+    rtn.params = params
+    rtn.N = NUM_ASSIGNMENTS[params['Num. of Assignments']]
+    rtn.p = params['Assignment Shortfall Penalty']
+    return rtn
+
+
+def _solve_scenario(opt_input_dat, params):
+    """Builds and solves the optimization model of one scenario. Runs in the worker processes."""
+    if pruning.enabled(params):
+        return pruning.solve_pruned(opt_input_dat, params)
+    opt_model = optimization.build_optimization_model(opt_input_dat, params)
+    opt_model.optimize()
+    return opt_model.model_sln
+
+
+def _kpi_row(model_sln, n_pairs):
+    """KPIs of the solution of one scenario, with the names of rpt_kpi_summary."""
+    if not model_sln:
+        return {'Status': 'No solution', 'Candidate Pairs': n_pairs}
+    assignments = model_sln['assignments']
+    mip_gap = model_sln['mip_gap']
+    return {'Status': model_sln['status'], 'Candidate Pairs': n_pairs,
+            'Objective Value': model_sln['obj_val'], 'Best Bound': model_sln['best_bound'],
+            'MIP Gap (%)': np.nan if np.isnan(mip_gap) else round(100 * mip_gap, 2),
+            'Solve Time': round(model_sln['solve_time'], 2), **model_sln['kpis'],
+            'Assignments': len(assignments), 'Matched Requests': assignments['Request ID'].nunique(),
+            'Total Score': float(assignments['Score'].sum())}
+
+
+@timeit
+def sweep(dat, scenarios, workers=None):
+    """
+    Solves the matching problem for each parameter scenario.
+    :param dat: A good PanDat for the input schema. Its parameters are the defaults of every scenario.
+    :param scenarios: list of dicts {parameter name: value} overriding the parameters of dat, or a dict
+    {scenario name: such dict}.
+    :param workers: Number of worker processes. Defaults to the 'Parallel Workers' parameter (0 for all cores).
+    :return: DataFrame with one row per scenario: its name, the parameters it overrides and the KPIs of its solution.
+    """
+    if not isinstance(scenarios, dict):
+        scenarios = {f'Scenario {k + 1}': overrides for k, overrides in enumerate(scenarios)}
+    for overrides in scenarios.values():
+        _check_scenario(overrides)
+    intern_tables(dat, id_domains)
+    data_maintenance.data_check(dat, input_schema)
+    data_maintenance.remove_inactive_records(dat)
+    base_params = input_schema.create_full_parameters_dict(dat)
+    scenario_params = {name: {**base_params, **overrides} for name, overrides in scenarios.items()}
+
+    # region Candidate superset, costs and scores, computed once
+    loosest = dict(base_params)
+    for name in candidates.VIOLATION_PARAMETERS:
+        loosest[name] = max((params[name] for params in scenario_params.values()),
+                            key=candidates.VIOLATION_LEVELS.get)
+    superset = OptInputData(_with_parameters(dat, loosest))
+    edges = superset.edges
+    reward_types = {params['Reward Type'] for params in scenario_params.values()}
+    scores = {reward_type: (edges.score if reward_type == loosest['Reward Type'] else
+                            superset.edge_scores(edges.tissue, edges.request, reward_type))
+              for reward_type in reward_types}
+    print(f"#businesslog Candidate superset: {len(edges)} pairs for {len(scenarios)} scenarios")
+    # endregion
+
+    tasks = list()
+    for name, params in scenario_params.items():
+        mask = candidates.feasible_mask(superset.tissue_attrs, superset.request_attrs, edges.tissue, edges.request,
+                                        params)
+        tasks.append((scenario_data(superset, params, np.flatnonzero(mask), scores), params))
+    workers = min(workers or base_params['Parallel Workers'] or os.cpu_count() or 1, len(tasks))
+    start = time()
+    if workers == 1:
+        model_slns = [_solve_scenario(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            model_slns = list(executor.map(_solve_scenario, *zip(*tasks)))
+    print(f"#businesslog Solved {len(tasks)} scenarios in {time() - start:.2f} seconds with {workers} workers")
+
+    swept = list(dict.fromkeys(name for overrides in scenarios.values() for name in overrides))
+    rows = list()
+    for name, model_sln, (opt_input_dat, _) in zip(scenarios, model_slns, tasks):
+        row = {'Scenario': name, **{p: scenario_params[name][p] for p in swept}}
+        # KPIs named as a parameter (e.g. 'Assignment Shortfall Penalty') are suffixed
+        row.update({f'{kpi} (KPI)' if kpi in row else kpi: value
+                    for kpi, value in _kpi_row(model_sln, len(opt_input_dat.edges)).items()})
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def parse_parameter_value(name, text):
+    """Value of a parameter given on the command line: a number if the parameter allows numbers."""
+    chk = input_schema.parameters.get(name)
+    if chk is not None and chk.type_dictionary is not None and chk.type_dictionary.number_allowed:
+        try:
+            value = float(text)
+            return int(value) if chk.type_dictionary.must_be_int or value.is_integer() else value
+        except ValueError:
+            pass
+    return text
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Solve a grid of parameter scenarios and compare their KPIs.')
+    parser.add_argument('--grid', action='append', required=True, metavar='"NAME=VALUE1,VALUE2,..."',
+                        help='Values of a parameter. Repeat for each swept parameter.')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', default=str(constants.output_path / 'sweep_kpis.csv'))
+    args = parser.parse_args(args)
+    grid = dict()
+    for item in args.grid:
+        name, _, values = item.partition('=')
+        grid[name.strip()] = [parse_parameter_value(name.strip(), v.strip()) for v in values.split(',')]
+    dat = table_cache.create_pan_dat(input_schema, constants.input_path)
+    kpis = sweep(dat, parameter_grid(grid), args.workers)
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(kpis)
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    kpis.to_csv(args.output, index=False)
+    print(f'#businesslog Scenario KPIs written to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
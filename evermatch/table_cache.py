@@ -0,0 +1,223 @@
+"""
+On-disk binary cache of the input tables read from csv files.
+
+Each table is stored in a directory of its own, keyed by a hash of the csv file content (and of the schema or read
+arguments), with one .npy file per column:
+- Numeric, boolean and datetime columns are stored as typed arrays and memory-mapped (copy-on-write) when loaded.
+- Text columns (IDs, names, categories) are stored as integer codes into an array of distinct values, and decoded back
+  to their original dtype when loaded. Categorical columns are stored the same way, with their categories.
+- Nullable integer, float and boolean columns are stored as a typed array of values and a mask of missing values.
+Loading a cached table skips both the text parsing and the TicDat post-read adjustments. A table is re-parsed only when
+its own csv file, the schema or the code reading it (this module and the TicDat version) changes. Tables that can not
+be stored losslessly in this format (e.g. columns of mixed types) are simply not cached. Reading an entry marks it as
+recently used, and the least recently used entries are removed when the cache grows over MAX_BYTES.
+"""
+
+import contextlib
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+import ticdat
+
+from evermatch import constants
+from evermatch.utils import evict_lru, module_digest, schema_digest
+
+# Size of the cache over which the least recently used entries are removed
+MAX_BYTES = 1024 ** 3
+
+
+def read_csv(path, cache_path=None, **kwargs):
+    """
+    Cached pandas.read_csv.
+    :param path: Path of the csv file.
+    :param cache_path: Cache directory. Defaults to constants.cache_path.
+    :param kwargs: Additional named arguments to pass to pandas.read_csv. They are part of the cache key.
+    :return: DataFrame.
+    """
+    return read_file(path, lambda p: pd.read_csv(p, **kwargs), repr(sorted(kwargs.items())), cache_path=cache_path)
+
+
+def read_file(path, read, *extra, cache_path=None):
+    """
+    Cached read of a file into a DataFrame.
+    :param path: Path of the file.
+    :param read: Function reading the DataFrame from the file path.
+    :param extra: Strings identifying the read function and its arguments. They are part of the cache key.
+    :param cache_path: Cache directory. Defaults to constants.cache_path.
+    :return: DataFrame.
+    """
+    entry_path = _entry_path(cache_path, _file_digest(path, *extra))
+    rtn = _load_table(entry_path)
+    if rtn is None:
+        rtn = read(path)
+        _save_table(rtn, entry_path)
+    return rtn
+
+
+def create_pan_dat(schema, dir_path, cache_path=None):
+    """
+    Cached schema.csv.create_pan_dat: the tables whose csv file did not change are loaded from the cache, and only the
+    other ones are parsed (with schema.csv.create_pan_dat, so the result is the same).
+    :param schema: A PanDatFactory.
+    :param dir_path: Directory containing the csv files.
+    :param cache_path: Cache directory. Defaults to constants.cache_path.
+    :return: a PanDat object populated by the matching tables.
+    """
+    digest = schema_digest(schema)
+    file_names = {f.lower().replace(' ', '_'): f for f in os.listdir(dir_path)
+                  if os.path.isfile(os.path.join(dir_path, f))}
+    tables, missed = dict(), dict()
+    for table in schema.all_tables:
+        file_name = file_names.get(f'{table.lower()}.csv')
+        if file_name is None:
+            print(f"The following table names could not be found in the {dir_path} directory.\n{table}\n")
+            continue
+        entry_path = _entry_path(cache_path, _file_digest(os.path.join(dir_path, file_name), table, digest))
+        tables[table] = _load_table(entry_path)
+        if tables[table] is None:
+            missed[table] = (file_name, entry_path)
+    if missed:
+        print(f"#businesslog Parsing {len(missed)} changed input tables: {', '.join(missed)}")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for file_name, _ in missed.values():
+                shutil.copyfile(os.path.join(dir_path, file_name), os.path.join(tmp_dir, file_name))
+            # the tables that are not parsed are reported as missing, which is expected here
+            with contextlib.redirect_stdout(io.StringIO()):
+                parsed = schema.csv.create_pan_dat(tmp_dir)
+        for table, (_, entry_path) in missed.items():
+            tables[table] = getattr(parsed, table)
+            _save_table(tables[table], entry_path)
+    return schema.PanDat(**tables)
+
+
+def _file_digest(path, *extra):
+    """Hex digest of the content of a file, of the extra strings and of the code reading it."""
+    digest = hashlib.sha1(f"{module_digest('table_cache')}/{ticdat.__version__}".encode())
+    for value in extra:
+        digest.update(value.encode())
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _entry_path(cache_path, digest):
+    return os.path.join(cache_path or constants.cache_path, 'tables', digest)
+
+
+def _encode_column(values):
+    """
+    :return: (kind, arrays) - the arrays to save for a column, or None if the column can not be stored losslessly.
+    """
+    dtype = values.dtype
+    if isinstance(values.array, (pd.arrays.IntegerArray, pd.arrays.FloatingArray, pd.arrays.BooleanArray)):
+        mask = values.isna().to_numpy()
+        return 'masked', {'values': values.to_numpy(dtype=dtype.numpy_dtype, na_value=0), 'mask': mask}
+    if pd.api.types.is_bool_dtype(dtype) or (pd.api.types.is_numeric_dtype(dtype) and isinstance(dtype, np.dtype)):
+        return 'array', {'values': values.to_numpy()}
+    if isinstance(dtype, pd.CategoricalDtype):
+        categories = np.asarray(dtype.categories, dtype=object)
+        if not all(isinstance(v, str) for v in categories):
+            return None
+        return 'category', {'codes': values.cat.codes.to_numpy().astype(np.int32),
+                            'uniques': categories.astype(str) if len(categories) else np.empty(0, dtype='U1')}
+    if isinstance(dtype, np.dtype) and dtype.kind == 'M':
+        return 'datetime', {'values': values.to_numpy().view(np.int64)}
+    if pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+        codes, uniques = pd.factorize(values, use_na_sentinel=True)
+        uniques = np.asarray(uniques, dtype=object)
+        if not all(isinstance(v, str) for v in uniques):
+            return None
+        return 'text', {'codes': codes.astype(np.int32), 'uniques': uniques.astype(str) if len(uniques) else
+                        np.empty(0, dtype='U1')}
+    return None
+
+
+_ARRAY_NAMES = {'array': ['values'], 'datetime': ['values'], 'text': ['codes', 'uniques'],
+                'category': ['codes', 'uniques'], 'masked': ['values', 'mask']}
+
+
+def _decode_column(kind, dtype, arrays):
+    # plain ndarray views of the memory-mapped values, so the frame does not hold np.memmap objects
+    if kind == 'array':
+        return arrays['values'].view(np.ndarray)
+    if kind == 'datetime':
+        return arrays['values'].view(np.ndarray).view(dtype)
+    if kind == 'category':
+        return pd.Categorical.from_codes(arrays['codes'], categories=arrays['uniques'].astype(object))
+    if kind == 'masked':
+        return pd.Series(pd.array(np.asarray(arrays['values']), dtype=dtype)).mask(np.asarray(arrays['mask']))
+    codes = arrays['codes']
+    # missing cells have the code -1, and a column of missing cells only has no uniques to index
+    values = np.full(len(codes), np.nan, dtype=object)
+    values[codes >= 0] = arrays['uniques'].astype(object)[codes[codes >= 0]]
+    return pd.Series(values, dtype=dtype)
+
+
+def _save_table(df, entry_path):
+    """
+    Saves a table as a cache entry. The entry is written under a temporary name and renamed, so concurrent runs never
+    read a partial entry. Tables that can not be stored losslessly are skipped, as are write errors.
+    """
+    if not isinstance(df.index, pd.RangeIndex) or df.index.start != 0 or df.index.step != 1:
+        return
+    columns = list()
+    encoded = list()
+    for col in df.columns:
+        if not isinstance(col, str):
+            return
+        column = _encode_column(df[col])
+        if column is None:
+            return
+        columns.append({'name': col, 'kind': column[0], 'dtype': str(df[col].dtype)})
+        encoded.append(column[1])
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(entry_path))
+        for k, arrays in enumerate(encoded):
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_path, f'{k}_{name}.npy'), array, allow_pickle=False)
+        with open(os.path.join(tmp_path, 'columns.json'), 'w') as f:
+            json.dump({'length': len(df), 'columns': columns}, f)
+        loaded = _load_table(tmp_path)
+        if loaded is None or not loaded.equals(df):
+            shutil.rmtree(tmp_path)
+            return
+        os.rename(tmp_path, entry_path)
+    except OSError:
+        # read-only cache directory, or another run saved the same entry first
+        if tmp_path is not None:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+    evict_lru([os.path.dirname(entry_path)], MAX_BYTES)
+
+
+def _load_table(entry_path):
+    """
+    Loads a cache entry, memory-mapping the typed columns: the frame uses the mapped arrays without copying them, and
+    the mapping is copy-on-write, so changes to the frame are never written to the entry. Returns None if there is no
+    (valid) entry.
+    """
+    if not os.path.isdir(entry_path):
+        return None
+    try:
+        with open(os.path.join(entry_path, 'columns.json')) as f:
+            meta = json.load(f)
+        data = dict()
+        for k, column in enumerate(meta['columns']):
+            arrays = {name: np.load(os.path.join(entry_path, f'{k}_{name}.npy'), allow_pickle=False,
+                                    mmap_mode='c' if name == 'values' else None)
+                      for name in _ARRAY_NAMES[column['kind']]}
+            data[column['name']] = _decode_column(column['kind'], column['dtype'], arrays)
+        os.utime(entry_path)  # most recently used
+    except (OSError, ValueError, KeyError, IndexError):
+        return None
+    return pd.DataFrame(data, index=pd.RangeIndex(meta['length']), columns=[c['name'] for c in meta['columns']],
+                        copy=False)
@@ -1,9 +1,15 @@
+import contextlib
+import hashlib
 import time
-from functools import wraps
+from functools import lru_cache, wraps
 from time import time
 import os
 import shutil
 
+import pandas as pd
+
+from evermatch import instrumentation
+
 
 def find_path(graph, start, path):
     path += [start]
@@ -17,12 +23,18 @@ def find_path(graph, start, path):
 
 def timeit(func):
     """
+    Runs the decorated function in an instrumentation span (see instrumentation.py), or logs its execution time when
+    instrumentation is disabled.
     :param func: Decorated function
     :return: Execution time for the decorated function
     """
+    span_name = f"{func.__module__.rsplit('.', 1)[-1]}.{func.__qualname__}"
 
     @wraps(func)
     def wrapper(*args, **kwargs):
+        if instrumentation.enabled():
+            with instrumentation.span(span_name):
+                return func(*args, **kwargs)
         start = time()
         result = func(*args, **kwargs)
         end = time()
@@ -32,6 +44,85 @@ def timeit(func):
     return wrapper
 
 
+def frame_digest(df):
+    """
+    :param df: DataFrame.
+    :return: Hex digest of the content (column names and values, not the index) of df.
+    """
+    digest = hashlib.sha1(repr(list(df.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def module_digest(module):
+    """
+    :param module: Name of a module of the package (e.g. 'candidates').
+    :return: Hex digest of the source file of the module.
+    """
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), f'{module}.py'), 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def schema_digest(schema):
+    """
+    :param schema: A PanDatFactory.
+    :return: Hex digest of the schema, with its ancillary info (data types, foreign keys, parameters). TicDat builds
+    some of its dicts and tuples from sets, whose order changes with the hash seed, so they are sorted first.
+    """
+    def canonical(value):
+        if isinstance(value, dict):
+            return sorted((repr(k), canonical(v)) for k, v in value.items())
+        if isinstance(value, (set, frozenset)):
+            return sorted(repr(canonical(v)) for v in value)
+        if isinstance(value, (list, tuple)) and not hasattr(value, '_fields'):
+            return [canonical(v) for v in value]
+        return repr(value)
+
+    info = schema.schema(include_ancillary_info=True)
+    info = {**info, 'foreign_keys': sorted(map(repr, info.get('foreign_keys', ())))}
+    return hashlib.sha1(repr(canonical(info)).encode()).hexdigest()
+
+
+def evict_lru(roots, max_bytes):
+    """
+    Removes the least recently used cache entries (the files and directories in roots) until they take at most
+    max_bytes. Entries are marked as used by touching them when they are read, and entries still being written (under a
+    temporary 'tmp' name) are kept.
+    :param roots: Directories holding the entries.
+    :param max_bytes: Max. size of the entries.
+    :return: Number of entries removed.
+    """
+    entries = list()
+    for root in roots:
+        if not os.path.isdir(root):
+            continue
+        for entry in os.scandir(root):
+            if entry.name.startswith('tmp'):
+                continue
+            try:
+                if entry.is_dir():
+                    size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                else:
+                    size = entry.stat().st_size
+                entries.append((entry.stat().st_mtime, size, entry.path))
+            except OSError:
+                pass  # removed by another run
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        total -= size
+        removed += 1
+    return removed
+
+
 def copy_directory(src, dst):
     for item in os.listdir(src):
         s = os.path.join(src, item)
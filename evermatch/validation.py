@@ -0,0 +1,262 @@
+"""
+Vectorized, memoized data integrity checks, with the same results as the TicDat find_data_type_failures,
+find_data_row_failures and find_foreign_key_failures functions.
+
+- Data types are compiled into column-wise checks (range, integrality, allowed strings and nulls), with a fallback to
+  the TicDat cell check for columns of mixed types. The categories of categorical columns are checked only once.
+- Row predicates use the column-wise versions registered in schemas.vectorized_row_predicates, with a fallback to the
+  row predicate itself for the others.
+- Foreign keys are checked with a vectorized membership test of the native key columns in the foreign table.
+
+Every row is identified by a hash of its content. The hashes of the rows that were checked and of the rows that failed
+each check are saved per table in the on-disk cache, so only the rows that were not in the last checked version of a
+table are checked again: an unchanged table is not re-validated at all, and only the new rows of an appended table are.
+The stores are keyed by the schema and the code of its checks, and the least recently used stores are removed when the
+cache grows over MAX_BYTES. The tables are checked concurrently.
+"""
+
+import hashlib
+import os
+import tempfile
+import types
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from ticdat.utils import TypeDictionary
+
+from evermatch import constants
+from evermatch.schemas import vectorized_row_predicates
+from evermatch.utils import evict_lru, module_digest, schema_digest
+
+TableField = namedtuple('TableField', ['table', 'field'])
+TablePredicateName = namedtuple('TablePredicateName', ['table', 'predicate_name'])
+
+# Name of the row predicate TicDat adds to the parameters table
+PARAMETERS_PREDICATE = 'Good Name/Value Check'
+# Size of the on-disk stores over which the least recently used ones are removed
+MAX_BYTES = 256 * 1024 ** 2
+
+
+def find_failures(dat, schema, cache_path=None):
+    """
+    Finds the data type, data row and foreign key failures of dat.
+    :param dat: A good PanDat for schema.
+    :param schema: A PanDatFactory.
+    :param cache_path: Cache directory. Defaults to constants.cache_path.
+    :return: (data type failures, data row failures, foreign key failures) - dicts with the same keys and failed rows
+    as the corresponding TicDat find_*_failures functions.
+    """
+    tables = list(schema.all_tables)
+    root = os.path.join(cache_path or constants.cache_path, 'validation')
+    store_dir = os.path.join(root, _schema_digest(schema))
+    with ThreadPoolExecutor(max_workers=min(len(tables), os.cpu_count() or 1)) as executor:
+        row_hashes = dict(zip(tables, executor.map(lambda t: _row_hashes(getattr(dat, t)), tables)))
+        digests = {t: hashlib.sha1(hashes.tobytes()).hexdigest() for t, hashes in row_hashes.items()}
+        failures = list(executor.map(
+            lambda t: _check_table(getattr(dat, t), row_hashes[t], _table_checks(dat, schema, t, digests),
+                                   os.path.join(store_dir, f'{t}.npz')), tables))
+    if os.path.isdir(store_dir):
+        try:
+            os.utime(store_dir)  # most recently used
+        except OSError:
+            pass
+        evict_lru([root], MAX_BYTES)
+    rtn = (dict(), dict(), dict())
+    for table_failures in failures:
+        for (group, key), rows in table_failures.items():
+            rtn[group][key] = rows
+    return rtn
+
+
+def _schema_digest(schema):
+    """
+    Hex digest of the data types, foreign keys, parameters and row predicates of schema, and of the code of the checks:
+    the code of the row predicates and of their vectorized versions, and the source of this module and of schemas.py
+    (for the values the predicates read from it, e.g. score_fields).
+    """
+    digest = hashlib.sha1(schema_digest(schema).encode())
+    for table in schema.all_tables:
+        for name, rpi in schema.get_row_predicates(table).items():
+            digest.update(f'{table}.{name}'.encode())
+            _update_code_digest(digest, rpi.predicate.__code__)
+    for (table, name), vectorized in sorted(vectorized_row_predicates.items()):
+        digest.update(f'{table}.{name}:vectorized'.encode())
+        _update_code_digest(digest, vectorized.__code__)
+    for module in ['validation', 'schemas']:
+        digest.update(f'{module}:{module_digest(module)}'.encode())
+    return digest.hexdigest()
+
+
+def _update_code_digest(digest, code):
+    """Adds the bytecode, constants (e.g. thresholds) and names of code, and of the code it defines, to digest."""
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _update_code_digest(digest, const)
+        else:
+            # the order of the items of a frozenset depends on the hash seed
+            digest.update(repr(sorted(map(repr, const)) if isinstance(const, frozenset) else const).encode())
+
+
+def _row_hashes(df):
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+def _table_checks(dat, schema, table, digests):
+    """
+    :return: list of (name, (group, key), check) - the checks of the rows of table. name identifies the check in the
+    cache, group is the position of the failures dict in the find_failures output, key is its key in the TicDat output,
+    and check(df) returns a bool array flagging the rows of df that fail.
+    """
+    rtn = list()
+    data_types = dict(schema.data_types.get(table, {}))
+    for field in schema.primary_key_fields.get(table, ()):
+        # TicDat only requires primary key fields without a data type to be non-null
+        data_types.setdefault(field, TypeDictionary.safe_creator(
+            number_allowed=True, inclusive_min=True, inclusive_max=True, min=-float('inf'), max=float('inf'),
+            must_be_int=False, strings_allowed='*', nullable=False, datetime=False))
+    for field, data_type in data_types.items():
+        rtn.append((f'type:{field}', (0, TableField(table, field)), _data_type_check(field, data_type)))
+    for name, rpi in schema.get_row_predicates(table).items():
+        rtn.append((f'row:{name}', (1, TablePredicateName(table, name)), _row_predicate_check(table, name, rpi)))
+    if table == 'parameters' and schema.parameters:
+        rtn.append((f'row:{PARAMETERS_PREDICATE}', (1, TablePredicateName(table, PARAMETERS_PREDICATE)),
+                    _parameters_check(schema)))
+    for fk in schema.foreign_keys:
+        if fk.native_table == table:
+            name = f'fk:{fk.foreign_table}:{fk.mapping}:{digests[fk.foreign_table]}'
+            rtn.append((name, (2, fk), _foreign_key_check(fk, getattr(dat, fk.foreign_table))))
+    return rtn
+
+
+def _data_type_check(field, data_type):
+    """Compiles a TicDat data type into a column-wise check (see TypeDictionary.valid_data)."""
+
+    def numbers_bad(x):
+        if not data_type.number_allowed:
+            return np.ones(len(x), dtype=bool)
+        bad = (x < data_type.min) | (x > data_type.max)
+        if not data_type.inclusive_min:
+            bad |= x == data_type.min
+        if not data_type.inclusive_max:
+            bad |= x == data_type.max
+        if data_type.must_be_int:
+            not_int = ~np.isfinite(x) | (x != np.trunc(x))
+            if data_type.max == float('inf') and data_type.inclusive_max:
+                not_int &= x != float('inf')
+            bad |= not_int
+        return bad
+
+    def strings_bad(x):
+        if data_type.strings_allowed == '*':
+            return np.zeros(len(x), dtype=bool)
+        return ~pd.Series(x).isin(data_type.strings_allowed).to_numpy()
+
+    def check(df):
+        values = df[field]
+        null = values.isna().to_numpy()
+        bad = null & (not data_type.nullable)
+        values = values[~null]
+        dtype = values.dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            # each category is checked once
+            categories = pd.DataFrame({field: pd.Series(dtype.categories, dtype=object)})
+            bad[~null] = check(categories)[values.cat.codes.to_numpy()]
+            return bad
+        if data_type.datetime:
+            inferred = None
+        elif isinstance(dtype, np.dtype) and dtype.kind in 'iuf':
+            inferred = 'numbers'
+        elif isinstance(dtype, pd.StringDtype):
+            inferred = 'string'
+        else:
+            inferred = pd.api.types.infer_dtype(values, skipna=True)
+        if inferred == 'numbers' or inferred in ['integer', 'floating', 'mixed-integer-float']:
+            bad[~null] = numbers_bad(values.to_numpy(dtype=np.float64))
+        elif inferred == 'string':
+            bad[~null] = strings_bad(values.to_numpy(dtype=object))
+        elif inferred != 'empty':
+            bad[~null] = [not data_type.valid_data(v) for v in values]
+        return bad
+
+    return check
+
+
+def _row_predicate_check(table, name, rpi):
+    vectorized = vectorized_row_predicates.get((table, name))
+    if vectorized is not None:
+        # missing values of nullable columns fail the predicate
+        return lambda df: ~np.asarray(vectorized(df).fillna(False), dtype=bool)
+    assert rpi.predicate_kwargs_maker is None and rpi.predicate_failure_response == 'Boolean', \
+        f"Row predicate '{name}' of table '{table}' needs to be checked with TicDat find_data_row_failures"
+    return lambda df: np.array([not rpi.predicate(row) for _, row in df.iterrows()], dtype=bool)
+
+
+def _parameters_check(schema):
+    name_field, value_field = schema.primary_key_fields['parameters'][0], schema.data_fields['parameters'][0]
+
+    def good_parameter(name, value):
+        chk = schema.parameters.get(name)
+        return bool(chk) and (chk.type_dictionary is None or chk.type_dictionary.valid_data(value))
+
+    return lambda df: np.array([not good_parameter(k, None if pd.isnull(v) else v)
+                                for k, v in zip(df[name_field], df[value_field])], dtype=bool)
+
+
+def _foreign_key_check(fk, foreign_df):
+    mapping = fk.foreigntonativemapping()
+    foreign_fields = list(mapping)
+    native_fields = [mapping[f] for f in foreign_fields]
+    if len(foreign_fields) == 1:
+        return lambda df: ~df[native_fields[0]].isin(foreign_df[foreign_fields[0]]).to_numpy()
+    foreign_keys = pd.MultiIndex.from_frame(foreign_df[foreign_fields])
+    return lambda df: ~pd.MultiIndex.from_frame(df[native_fields]).isin(foreign_keys)
+
+
+def _check_table(df, hashes, checks, store_path):
+    """
+    Runs the checks of one table, reusing the cached results of the rows that were already checked.
+    :return: dict {(group, key): failed rows}.
+    """
+    stored_hashes, stored_failures = _load_store(store_path)
+    known = np.isin(hashes, stored_hashes)
+    failures, rtn = dict(), dict()
+    changed = len(stored_hashes) != len(np.unique(hashes)) or set(stored_failures) != {name for name, _, _ in checks}
+    for name, group_key, check in checks:
+        bad = np.zeros(len(df), dtype=bool)
+        reuse = known if name in stored_failures else np.zeros(len(df), dtype=bool)
+        bad[reuse] = np.isin(hashes[reuse], stored_failures.get(name, []))
+        if not reuse.all():
+            bad[~reuse] = check(df[~reuse])
+            changed = True
+        failures[name] = np.unique(hashes[bad])
+        if bad.any():
+            rtn[group_key] = df[bad].copy()
+    if changed:
+        _save_store(store_path, np.unique(hashes), failures)
+    return rtn
+
+
+def _load_store(store_path):
+    """:return: (row hashes, {check name: failed row hashes}) of the last checked version of a table."""
+    try:
+        with np.load(store_path, allow_pickle=False) as store:
+            return store['hashes'], {str(name): store[f'failures_{k}'] for k, name in enumerate(store['names'])}
+    except (OSError, ValueError, KeyError):
+        return np.empty(0, dtype=np.uint64), dict()
+
+
+def _save_store(store_path, hashes, failures):
+    """Saves the row hashes and failures of a table. The file is replaced atomically, and write errors are ignored."""
+    try:
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(store_path), suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, hashes=hashes, names=np.array(list(failures), dtype=str),
+                     **{f'failures_{k}': v for k, v in enumerate(failures.values())})
+        os.replace(tmp_path, store_path)
+    except OSError:
+        pass
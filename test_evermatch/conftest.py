@@ -0,0 +1,45 @@
+"""
+Fixtures shared by the tests: a small synthetic instance drawn from the raw_data reference dataset, for each request
+coverage mode.
+"""
+
+import contextlib
+import io
+import tempfile
+
+import numpy as np
+import pytest
+
+from evermatch import benchmark
+from evermatch import candidates
+from evermatch import table_cache
+from evermatch.schemas import input_schema
+from helpers import DATA_PATH
+
+COVERAGE_MODES = ['Flexible with alternative options', 'Exactly one tissue_df per request_df']
+
+# n_tissues, n_requests, n_sites, n_surgeons of the synthetic instance
+SIZES = (200, 60, 20, 10)
+
+
+@pytest.fixture(scope='session')
+def reference():
+    """The raw_data reference dataset."""
+    with contextlib.redirect_stdout(io.StringIO()), tempfile.TemporaryDirectory() as cache_path:
+        return table_cache.create_pan_dat(input_schema, DATA_PATH / 'raw_data', cache_path)
+
+
+@pytest.fixture(scope='session')
+def profile(reference):
+    return benchmark.reference_profile(reference)
+
+
+@pytest.fixture(params=COVERAGE_MODES)
+def instance(request, profile):
+    """Synthetic instance whose candidate pairs form several independent components."""
+    rtn = benchmark.synthetic_instance(*SIZES, profile, seed=1,
+                                       params={'Request Coverage': request.param, 'MIP Gap': 0, 'Stage Cache': 'Off'})
+    # single-use tissues, so the candidate pairs of each tissue use form independent components
+    uses = candidates.TISSUE_USES
+    rtn.tissues[uses] = (np.arange(len(rtn.tissues))[:, None] % len(uses) == np.arange(len(uses))).astype(int)
+    return rtn
@@ -0,0 +1,65 @@
+"""Helpers shared by the tests."""
+
+import contextlib
+import io
+import warnings
+from pathlib import Path
+
+import pandas as pd
+
+import evermatch.data_maintemance as data_maintenance
+from evermatch import decomposition
+from evermatch import optimization
+from evermatch.opt_data import OptInputData
+from evermatch.schemas import input_schema
+
+DATA_PATH = Path(__file__).parent / 'data'
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silences the business logs and the solver warnings."""
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        yield
+
+
+def with_params(dat, **params):
+    """:return: A copy of dat with the parameters (name: value) overridden."""
+    rtn = input_schema.copy_pan_dat(dat)
+    values = rtn.parameters.set_index('Parameter')['Value'].to_dict()
+    values.update(params)
+    rtn.parameters = pd.DataFrame({'Parameter': list(values), 'Value': list(values.values())})
+    return rtn
+
+
+def opt_input_data(dat):
+    """:return: (OptInputData, full parameters dictionary) of a copy of dat, prepared as by solve_code.solve."""
+    dat = input_schema.copy_pan_dat(dat)
+    with quiet():
+        data_maintenance.data_check(dat, input_schema)
+        data_maintenance.remove_inactive_records(dat)
+        return OptInputData(dat), input_schema.create_full_parameters_dict(dat)
+
+
+def solve_objective(dat):
+    """:return: (status, objective value) of the solve of dat, as run by solve_code.solve."""
+    opt_input_dat, params = opt_input_data(dat)
+    with quiet():
+        model_sln = decomposition.solve_by_components(opt_input_dat, params)
+    return model_sln['status'], model_sln['obj_val']
+
+
+def solve_model(opt_input_dat, params, backend=None):
+    """:return: Solution dictionary of the monolithic model of opt_input_dat, or None."""
+    with quiet():
+        opt_model = optimization.build_optimization_model(opt_input_dat, params, backend)
+        opt_model.optimize()
+    return opt_model.model_sln
+
+
+def without_candidates(dat):
+    """:return: A copy of dat without any candidate pair: no tissue can be used for any tissue use."""
+    rtn = input_schema.copy_pan_dat(dat)
+    rtn.tissues = rtn.tissues.assign(PK=0, DSAEK=0, DMEK=0)
+    return rtn
@@ -0,0 +1,84 @@
+"""Raw tables streamed in chunks must hold the same values as a single read, in compact dtypes."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from evermatch import action_data_ingestion as ingestion
+from evermatch import constants
+from evermatch import validation
+from evermatch.schemas import input_schema
+from helpers import DATA_PATH, quiet
+
+
+@pytest.fixture
+def raw_path(tmp_path, monkeypatch):
+    """The raw_data reference dataset, with the raw column names of the client data source."""
+    monkeypatch.setattr(constants, 'cache_path', tmp_path / 'cache')
+    rtn = tmp_path / 'raw'
+    rtn.mkdir()
+    for table, raw_columns in ingestion.RAW_COLUMNS.items():
+        df = pd.read_csv(DATA_PATH / 'raw_data' / f'{table}.csv', dtype=str, keep_default_na=False)
+        df.rename(columns={field: raw_col for raw_col, field in raw_columns.items()}).to_csv(rtn / f'{table}.csv',
+                                                                                             index=False)
+    return rtn
+
+
+def single_read(table, path):
+    dtypes = ingestion.raw_dtypes(table)
+    rtn = pd.read_csv(path, usecols=list(ingestion.RAW_COLUMNS[table]), dtype=dtypes)
+    for col in rtn.columns.difference(list(dtypes)):
+        rtn[col] = ingestion.parse_numbers(rtn[col])
+    return rtn
+
+
+@pytest.mark.parametrize('chunk_rows', [7, ingestion.CHUNK_ROWS])
+def test_same_values(raw_path, chunk_rows, monkeypatch):
+    monkeypatch.setattr(ingestion, 'CHUNK_ROWS', chunk_rows)
+    dtypes = set()
+    for table, raw_columns in ingestion.RAW_COLUMNS.items():
+        path = raw_path / f'{table}.csv'
+        rtn, expected = ingestion.read_raw_table(table, path), single_read(table, path)
+        pd.testing.assert_frame_equal(rtn, expected, check_dtype=False, check_categorical=False)
+        for col in expected.select_dtypes('integer').columns:
+            data_type = input_schema.data_types[table][raw_columns[col]]
+            if not data_type.must_be_int:
+                continue
+            assert rtn[col].dtype == (np.int8 if 0 <= data_type.min and data_type.max <= 1 else np.int32)
+            dtypes.add(rtn[col].dtype)
+        for col in ingestion.raw_dtypes(table):
+            assert isinstance(rtn[col].dtype, pd.CategoricalDtype)
+    assert dtypes == {np.dtype(np.int8), np.dtype(np.int32)}
+
+
+def test_dirty_cells(raw_path, monkeypatch):
+    monkeypatch.setattr(ingestion, 'CHUNK_ROWS', 7)
+    path = raw_path / 'tissues.csv'
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    df.loc[len(df) - 1, ['CellCount', 'PK']] = ['unknown', '0.5']
+    df.to_csv(path, index=False)
+    tissues = ingestion.read_raw_table('tissues', path)
+    # the cells are kept for the data check to report them
+    assert tissues['CellCount'].iloc[-1] == 'unknown'
+    assert tissues['PK'].iloc[-1] == 0.5
+    assert (tissues['CellCount'].iloc[:-1] == single_read('tissues', path)['CellCount'].iloc[:-1]).all()
+
+
+def test_data_ingestion(raw_path, monkeypatch):
+    monkeypatch.setattr(ingestion, 'CHUNK_ROWS', 7)
+    dats = list()
+    for read in [ingestion.read_raw_table, single_read]:
+        monkeypatch.setattr(ingestion, 'read_raw_table', read)
+        raw = ingestion.read_raw_data(raw_path)
+        with quiet():
+            rtn = ingestion.data_ingestion_solve(raw['requests'], raw['tissues'], raw['locations'], raw['surgeons'],
+                                                 raw['cost_matrix'], raw['surgeons_pref'])
+        dats.append(rtn['dat'])
+    for table in input_schema.all_tables:
+        pd.testing.assert_frame_equal(getattr(dats[0], table), getattr(dats[1], table), check_dtype=False,
+                                      check_categorical=False)
+    # same data check results
+    streamed, expected = [validation.find_failures(dat, input_schema, constants.cache_path) for dat in dats]
+    for failures, expected_failures in zip(streamed, expected):
+        assert {key: len(rows) for key, rows in failures.items()} == \
+               {key: len(rows) for key, rows in expected_failures.items()}
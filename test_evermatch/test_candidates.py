@@ -0,0 +1,66 @@
+"""The candidate pairs must be the pairs of the tissues x requests cross join that pass the hard requirements."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from evermatch import candidates
+from evermatch.schemas import input_schema
+from helpers import with_params
+
+VIOLATION_LEVELS = ['0%', '10%', '30%']
+
+
+def reference_pairs(tissues, requests, params):
+    """:return: sorted set of the (tissue position, request position) pairs of the original cross join filter."""
+    violation = candidates.violation_factors(params)
+    df = pd.merge(tissues.reset_index(drop=True).rename_axis('t').reset_index(),
+                  requests.reset_index(drop=True).rename_axis('r').reset_index(), how='cross')
+    keep = (
+        (df['Donor Age'] >= (1 - violation['Age Range']) * df['Age Min']) &
+        (df['Donor Age'] <= (1 + violation['Age Range']) * df['Age Max']) &
+        (df['Cell Count'] >= (1 - violation['Cell Count']) * df['Cell Count Min']) &
+        np.any([(df[use] == 1) & (df['Tissue Use'] == use) for use in candidates.TISSUE_USES], axis=0) &
+        (df['Death to Recovery (hrs.)'] <= (1 + violation['Death to Recovery']) * df['Death to Recovery Max (hrs.)']) &
+        (df['Death to Surgery (days)'] <= (1 + violation['Death to Surgery']) * df['Death to Surgery Max (days)']) &
+        (df['Death to Cooling (hrs.)'] <= (1 + violation['Death to Cooling']) * df['Death to Cooling Max (hrs.)']) &
+        (df['Clear Zone'] >= df['Clear Zone Min']) &
+        np.all([df[flag] <= 1 - df[exclude_flag] for flag, exclude_flag in candidates.EXCLUSION_FLAGS], axis=0))
+    return sorted(zip(df.loc[keep, 't'], df.loc[keep, 'r']))
+
+
+def check_pairs(dat, level):
+    dat = with_params(dat, **{name: level for name in candidates.VIOLATION_PARAMETERS})
+    params = input_schema.create_full_parameters_dict(dat)
+    t_pos, r_pos = candidates.get_candidate_pairs(dat.tissues, dat.requests, params)
+    expected = reference_pairs(dat.tissues, dat.requests, params)
+    assert expected
+    assert list(zip(t_pos, r_pos)) == expected
+
+
+@pytest.mark.parametrize('level', VIOLATION_LEVELS)
+def test_same_pairs(instance, level):
+    check_pairs(instance, level)
+
+
+@pytest.mark.parametrize('level', VIOLATION_LEVELS)
+def test_bound_ties(instance, level):
+    # the bounds of the requests are values of the tissues, so many pairs are exactly at a bound
+    dat = input_schema.copy_pan_dat(instance)
+    rng = np.random.default_rng(0)
+    for bound, field in [('Cell Count Min', 'Cell Count'), ('Age Min', 'Donor Age'), ('Age Max', 'Donor Age'),
+                         ('Death to Recovery Max (hrs.)', 'Death to Recovery (hrs.)'),
+                         ('Death to Surgery Max (days)', 'Death to Surgery (days)'),
+                         ('Death to Cooling Max (hrs.)', 'Death to Cooling (hrs.)'), ('Clear Zone Min', 'Clear Zone')]:
+        dat.requests[bound] = rng.choice(dat.tissues[field].to_numpy(), len(dat.requests))
+    check_pairs(dat, level)
+
+
+def test_feasible_mask(instance):
+    loose = input_schema.create_full_parameters_dict(
+        with_params(instance, **{name: '30%' for name in candidates.VIOLATION_PARAMETERS}))
+    params = input_schema.create_full_parameters_dict(instance)
+    t_pos, r_pos = candidates.get_candidate_pairs(instance.tissues, instance.requests, loose)
+    mask = candidates.feasible_mask(instance.tissues, instance.requests, t_pos, r_pos, params)
+    assert not mask.all()
+    assert list(zip(t_pos[mask], r_pos[mask])) == reference_pairs(instance.tissues, instance.requests, params)
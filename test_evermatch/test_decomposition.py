@@ -0,0 +1,37 @@
+"""Solving the independent components in batches must give the optimal objective value of the monolithic model."""
+
+from time import time
+
+import pytest
+
+from evermatch import decomposition
+from evermatch import optimization
+from helpers import opt_input_data, quiet, solve_objective, with_params
+
+
+def test_decomposition(instance, monkeypatch):
+    status, obj_val = solve_objective(instance)
+    assert status == 'Optimal'
+    # one batch per component
+    monkeypatch.setattr(decomposition, 'MIN_BATCH_EDGES', 1)
+    assert len(decomposition.edge_batches(opt_input_data(instance)[0].edges)) > 1
+    assert solve_objective(with_params(instance, **{'Parallel Workers': 2})) == pytest.approx((status, obj_val))
+
+
+def test_batch_time_limit(instance, monkeypatch):
+    opt_input_dat, params = opt_input_data(instance)
+    time_limits = list()
+
+    def build_optimization_model(opt_input_dat, params, backend=None):
+        time_limits.append(params['Time Limit (sec.)'])
+        return build(opt_input_dat, params, backend)
+
+    build = optimization.build_optimization_model
+    monkeypatch.setattr(optimization, 'build_optimization_model', build_optimization_model)
+    with quiet():
+        # the time left, not rounded up to a whole second
+        decomposition._solve_batch(opt_input_dat, params, None, deadline=time() + 0.5, share=0.5)
+        assert 0 < time_limits[0] <= 0.25
+        # no time left
+        assert decomposition._solve_batch(opt_input_dat, params, None, deadline=time() - 1) is None
+    assert len(time_limits) == 1
@@ -0,0 +1,37 @@
+"""Incremental re-solves must reach the optimal objective value of cold solves of the same data."""
+
+import pytest
+
+from evermatch.incremental import IncrementalSolver, compute_delta
+from evermatch.schemas import input_schema
+from helpers import quiet, solve_objective
+
+
+@pytest.mark.parametrize('backend', ['CBC', 'HiGHS'])
+def test_incremental(instance, backend):
+    n_tissues, n_requests = len(instance.tissues), len(instance.requests)
+    base = input_schema.copy_pan_dat(instance)
+    base.tissues = instance.tissues.iloc[:n_tissues * 3 // 4]
+    base.requests = instance.requests.iloc[:n_requests * 3 // 4]
+    with quiet():
+        solver = IncrementalSolver(base, backend)
+        solver.solve()
+    previous = base
+    # additions only, then a delta removing assigned tissues and some requests and changing other tissues
+    for step in range(2):
+        if step == 0:
+            dat = instance
+        else:
+            assigned = {tissue_id for tissue_id, _ in solver.selected}
+            dat = input_schema.copy_pan_dat(instance)
+            dat.tissues = instance.tissues[~instance.tissues['Tissue ID'].isin(assigned)].reset_index(drop=True)
+            dat.tissues.loc[:4, 'Donor Age'] += 5
+            dat.requests = instance.requests.iloc[3:].reset_index(drop=True)
+        with quiet():
+            solver.apply_delta(**compute_delta(previous, dat))
+            solver.solve()
+        status, obj_val = solve_objective(dat)
+        assert status == 'Optimal'
+        model_sln = solver.opt_model.model_sln
+        assert (model_sln['status'], model_sln['obj_val']) == pytest.approx((status, obj_val))
+        previous = dat
@@ -0,0 +1,48 @@
+"""The spans recorded in the decomposition worker processes must be merged into the spans of the parent process."""
+
+import os
+
+from evermatch import decomposition
+from evermatch import instrumentation
+from evermatch.utils import timeit
+from helpers import opt_input_data, quiet, with_params
+
+
+def test_worker_spans(instance, monkeypatch):
+    monkeypatch.setattr(decomposition, 'MIN_BATCH_EDGES', 1)
+    opt_input_dat, params = opt_input_data(with_params(instance, **{'Parallel Workers': 2}))
+    instrumentation.reset()
+    instrumentation.enable()
+    try:
+        with quiet():
+            decomposition.solve_by_components(opt_input_dat, params)
+    finally:
+        instrumentation.disable()
+    records = instrumentation.records()
+    instrumentation.reset()
+    by_id = {record['id']: record for record in records}
+    assert len(by_id) == len(records)
+    root = next(record for record in records if record['name'] == 'decomposition.solve_by_components')
+    worker_records = [record for record in records if record['pid'] != os.getpid()]
+    assert worker_records
+    for record in worker_records:
+        # nested under the parent span, with consistent depths
+        parent = by_id[record['parent']]
+        assert parent['depth'] == record['depth'] - 1
+        while parent['id'] != root['id']:
+            parent = by_id[parent['parent']]
+
+
+def test_timeit_log(capsys):
+    timed = timeit(lambda: None)
+    timed()
+    assert 'executed in' in capsys.readouterr().out
+    instrumentation.enable()
+    try:
+        timed()
+    finally:
+        instrumentation.disable()
+    assert capsys.readouterr().out == ''
+    assert [record['name'] for record in instrumentation.records()] == [
+        'test_instrumentation.test_timeit_log.<locals>.<lambda>']
+    instrumentation.reset()
@@ -0,0 +1,47 @@
+"""The Min-Cost Flow backend must find the same optimum as the MIP backends, and the same status when there is none."""
+
+import numpy as np
+import pytest
+
+from helpers import opt_input_data, solve_model, with_params, without_candidates
+
+MIP_BACKENDS = ['CBC', 'HiGHS']
+
+
+@pytest.mark.parametrize('satisfaction', ['Must meet all requirements', 'Relax scored requirements'])
+def test_same_optimum(instance, satisfaction):
+    opt_input_dat, params = opt_input_data(with_params(instance, **{'Requirement Satisfaction': satisfaction}))
+    flow = solve_model(opt_input_dat, params, 'Min-Cost Flow')
+    assert flow['status'] == 'Optimal'
+    for backend in MIP_BACKENDS:
+        model_sln = solve_model(opt_input_dat, params, backend)
+        assert (model_sln['status'], model_sln['obj_val']) == pytest.approx(('Optimal', flow['obj_val']))
+        assert model_sln['kpis'] == pytest.approx(flow['kpis'])
+
+
+def test_more_requests_than_tissues(instance):
+    opt_input_dat, params = opt_input_data(instance)
+    # batch (see decomposition) with the candidate pairs of the two tissues with the most candidates only
+    edges = opt_input_dat.edges
+    tissues = np.argsort(-np.diff(edges.indptr), kind='stable')[:2]
+    batch = opt_input_dat.subset(np.flatnonzero(np.isin(edges.tissue, tissues)))
+    assert len(batch.J) > len(batch.I)
+    flow = solve_model(batch, params, 'Min-Cost Flow')
+    if params['Request Coverage'] == 'Exactly one tissue_df per request_df':
+        assert flow is None
+        for backend in MIP_BACKENDS:
+            model_sln = solve_model(batch, params, backend)
+            assert model_sln is None or model_sln['status'] != 'Optimal'
+    else:
+        assert flow['status'] == 'Optimal'
+        for backend in MIP_BACKENDS:
+            assert solve_model(batch, params, backend)['obj_val'] == pytest.approx(flow['obj_val'])
+
+
+def test_no_candidate_pairs(instance):
+    opt_input_dat, params = opt_input_data(without_candidates(instance))
+    assert len(opt_input_dat.edges) == 0
+    flow = solve_model(opt_input_dat, params, 'Min-Cost Flow')
+    cbc = solve_model(opt_input_dat, params, 'CBC')
+    assert (flow['status'], flow['obj_val'], len(flow['x'])) == (cbc['status'], cbc['obj_val'], 0)
+    assert flow['kpis'] == cbc['kpis']
@@ -0,0 +1,23 @@
+"""The HiGHS backend must find the same optimum as the CBC backend."""
+
+import pytest
+
+from helpers import opt_input_data, solve_model, with_params, without_candidates
+
+
+@pytest.mark.parametrize('satisfaction', ['Must meet all requirements', 'Relax scored requirements'])
+def test_same_optimum(instance, satisfaction):
+    opt_input_dat, params = opt_input_data(with_params(instance, **{'Requirement Satisfaction': satisfaction}))
+    highs = solve_model(opt_input_dat, params, 'HiGHS')
+    cbc = solve_model(opt_input_dat, params, 'CBC')
+    assert (highs['status'], highs['obj_val']) == pytest.approx(('Optimal', cbc['obj_val']))
+    assert highs['kpis'] == pytest.approx(cbc['kpis'])
+
+
+def test_no_candidate_pairs(instance):
+    opt_input_dat, params = opt_input_data(without_candidates(instance))
+    assert len(opt_input_dat.edges) == 0
+    highs = solve_model(opt_input_dat, params, 'HiGHS')
+    cbc = solve_model(opt_input_dat, params, 'CBC')
+    assert (highs['status'], highs['obj_val'], len(highs['x'])) == (cbc['status'], cbc['obj_val'], 0)
+    assert highs['kpis'] == cbc['kpis']
@@ -0,0 +1,30 @@
+"""The lp file must name the variables and constraints after the IDs, and writing it must not change the solution."""
+
+import re
+
+import pytest
+
+from evermatch import opt_model_pulp
+from helpers import opt_input_data, solve_model, with_params
+
+
+def test_lp_names(instance, tmp_path):
+    # IDs with characters that are not allowed in an lp file
+    dat = with_params(instance, **{'Write lp File': str(tmp_path / 'model.lp')})
+    dat.tissues['Tissue ID'] = dat.tissues['Tissue ID'] + ' 21-08/3'
+    opt_input_dat, params = opt_input_data(dat)
+    model_sln = solve_model(opt_input_dat, params, 'CBC')
+    expected = solve_model(*opt_input_data(with_params(dat, **{'Write lp File': 'None'})), 'CBC')
+    assert (model_sln['status'], model_sln['obj_val']) == pytest.approx((expected['status'], expected['obj_val']))
+    lp = (tmp_path / 'model.lp').read_text()
+    names = re.findall(r'\b[xytr]_\d{9}[^\s:]*', lp)
+    assert names
+    assert all(re.fullmatch(r'[A-Za-z0-9_.]+', name) for name in names)
+    for tissue_id, request_id in zip(model_sln['assignments']['Tissue ID'], model_sln['assignments']['Request ID']):
+        label = opt_model_pulp.LP_NAME_ILLEGAL.sub('_', f'{tissue_id}_{request_id}')
+        assert re.search(rf'\bx_\d{{9}}_{re.escape(label)}\b', lp)
+    # unique names
+    model = opt_model_pulp.OptModel(opt_input_dat)
+    model.build_base_model()
+    variables = [v.name for v in model.vars['x'].values()]
+    assert len(set(variables)) == len(variables)
@@ -0,0 +1,53 @@
+"""The vectorized rpt_matching construction must match the one-request-at-a-time construction it replaced."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from evermatch.opt_data import OptOutputData
+from helpers import opt_input_data, quiet, solve_model, with_params, without_candidates
+
+ASSIGNMENT_COLS = ['Tissue ID', 'Transp. Cost', 'Score']
+
+
+def reference_rpt_matching(model_sln, dat):
+    """rpt_matching built one request at a time: main assignment, then alternatives, by cost and decreasing score."""
+    matching = model_sln['assignments'].astype({'Tissue ID': object, 'Request ID': object})
+    matching = matching.merge(dat.requests[['Request ID', 'Site ID']].astype(object), on='Request ID', how='left')
+    matching = matching.merge(dat.tissues[['Tissue ID', 'Current Site ID']].astype(object), on='Tissue ID', how='left')
+    matching = matching.merge(dat.cost_matrix.astype({'Origin Site ID': object, 'Dest. Site ID': object}), how='left',
+                              left_on=['Current Site ID', 'Site ID'], right_on=['Origin Site ID', 'Dest. Site ID'])
+    rows = list()
+    for request_id, group_df in matching.groupby('Request ID'):
+        group_df = group_df.assign(**{'Transp. Cost': group_df['Transp. Cost'].fillna(0)})
+        group_df = group_df.sort_values(['Transp. Cost', 'Score'], ascending=[True, False], kind='stable')
+        row = [request_id]
+        for rank in range(3):
+            row += list(group_df.iloc[rank][ASSIGNMENT_COLS]) if rank < len(group_df) else [np.nan] * 3
+        rows.append(row)
+    cols = ['Request ID'] + [f'{col}{suffix}' for suffix in ['', ' - Alt. 1', ' - Alt. 2'] for col in ASSIGNMENT_COLS]
+    rtn = pd.DataFrame(rows, columns=cols).astype({'Request ID': object})
+    rtn = rtn.merge(model_sln['shortfalls'], on='Request ID', how='left')
+    rtn['Penalty'] = rtn['Penalty'].fillna(0.0)
+    return rtn
+
+
+def rpt_matching(dat):
+    opt_input_dat, params = opt_input_data(dat)
+    model_sln = solve_model(opt_input_dat, params)
+    with quiet():
+        opt_output_dat = OptOutputData(model_sln, params)
+        opt_output_dat.populate_output_schema(opt_input_dat.dat, opt_input_dat.cost_index)
+    return opt_output_dat.sln.rpt_matching, reference_rpt_matching(model_sln, opt_input_dat.dat)
+
+
+@pytest.mark.parametrize('assignments', ['Up to one tissue_df per request_df', 'Up to three tissues per request_df'])
+def test_rpt_matching(instance, assignments):
+    rtn, expected = rpt_matching(with_params(instance, **{'Num. of Assignments': assignments}))
+    assert len(rtn)
+    pd.testing.assert_frame_equal(rtn.astype(object), expected[rtn.columns].astype(object))
+
+
+def test_no_assignments(instance):
+    rtn, _ = rpt_matching(without_candidates(instance))
+    assert rtn.empty
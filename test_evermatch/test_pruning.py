@@ -0,0 +1,13 @@
+"""Top-K candidate pruning must not change the optimal objective value."""
+
+import pytest
+
+from helpers import solve_objective, with_params
+
+
+def test_pruning(instance):
+    status, obj_val = solve_objective(instance)
+    assert status == 'Optimal'
+    for k in [1, 2]:
+        pruned = with_params(instance, **{'Candidate Pruning Top-K': k})
+        assert solve_objective(pruned) == pytest.approx((status, obj_val))
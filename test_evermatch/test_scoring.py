@@ -0,0 +1,90 @@
+"""The batched scores must be equal to the per-pair scores of the original soft_requirement_coefficients loop."""
+
+import numpy as np
+import pytest
+
+from evermatch import scoring
+
+N = 500
+
+REWARD_TYPES = ['Fixed Reward', 'Dynamic Reward']
+
+
+def random_pairs(rng, low=1):
+    """:return: (pairs, weights) of N random candidate pairs, with many values equal to their bounds."""
+    pairs = {'Cell Count': rng.integers(2000, 3000, N), 'Cell Count Min': rng.choice([low, 2000, 2500, 3000], N),
+             'Donor Age': rng.integers(0, 80, N), 'Age Min': rng.integers(low, 40, N),
+             'Age Max': rng.integers(40, 75, N)}
+    for field, bound in [('Death to Recovery (hrs.)', 'Death to Recovery Max (hrs.)'),
+                         ('Death to Surgery (days)', 'Death to Surgery Max (days)'),
+                         ('Death to Cooling (hrs.)', 'Death to Cooling Max (hrs.)')]:
+        pairs[field] = rng.integers(0, 12, N)
+        pairs[bound] = rng.integers(low, 12, N)
+    weights = {field: rng.integers(0, 4, N).astype(float) for field in scoring.SCORE_FIELDS}
+    return pairs, weights
+
+
+def reference_scores(pairs, weights, reward_type):
+    """Scores of the original per-pair loop."""
+    rtn = list()
+    for k in range(N):
+        p = {field: float(values[k]) for field, values in pairs.items()}
+        r = {field: values[k] for field, values in weights.items()}
+        fixed = reward_type == 'Fixed Reward'
+        if fixed and p['Cell Count Min'] <= p['Cell Count']:
+            cq = r['Cell Count Min']
+        else:
+            cq = r['Cell Count Min'] * (p['Cell Count'] - p['Cell Count Min']) / p['Cell Count Min']
+        if p['Age Min'] <= p['Donor Age'] <= p['Age Max']:
+            aq = r['Age Range']
+        elif p['Donor Age'] < p['Age Min']:
+            aq = r['Age Range'] * (p['Donor Age'] - p['Age Min']) / p['Age Min']
+        else:
+            aq = r['Age Range'] * (p['Age Max'] - p['Donor Age']) / p['Age Max']
+        score = cq + aq
+        # death to cooling is scored against the request's death to recovery max
+        for field, weight, bound in [('Death to Recovery (hrs.)', 'Death to Recovery Max (hrs.)',
+                                      'Death to Recovery Max (hrs.)'),
+                                     ('Death to Surgery (days)', 'Death to Surgery Max (days)',
+                                      'Death to Surgery Max (days)'),
+                                     ('Death to Cooling (hrs.)', 'Death to Cooling Max (hrs.)',
+                                      'Death to Recovery Max (hrs.)')]:
+            if fixed and p[field] <= p[bound]:
+                score += r[weight]
+            else:
+                score += r[weight] * (p[bound] - p[field]) / p[bound]
+        rtn.append(score)
+    return np.array(rtn)
+
+
+@pytest.mark.parametrize('reward_type', REWARD_TYPES)
+def test_same_scores(reward_type):
+    pairs, weights = random_pairs(np.random.default_rng(0))
+    np.testing.assert_allclose(scoring.soft_requirement_scores(pairs, weights, reward_type),
+                               reference_scores(pairs, weights, reward_type))
+
+
+@pytest.mark.parametrize('reward_type', REWARD_TYPES)
+def test_zero_bounds(reward_type):
+    pairs, weights = random_pairs(np.random.default_rng(0), low=0)
+    with np.errstate(all='raise'):
+        scores = scoring.soft_requirement_scores(pairs, weights, reward_type)
+    assert np.isfinite(scores).all()
+    nonzero = np.all([pairs[bound] != 0 for bound in ['Cell Count Min', 'Age Min', 'Death to Recovery Max (hrs.)',
+                                                       'Death to Surgery Max (days)']], axis=0)
+    with np.errstate(all='ignore'):
+        expected = reference_scores(pairs, weights, reward_type)
+    np.testing.assert_allclose(scores[nonzero], expected[nonzero])
+
+
+def test_zero_bound_score():
+    pairs = {'Cell Count': [2500, 2500], 'Cell Count Min': [0, 0], 'Donor Age': [30, 30], 'Age Min': [0, 0],
+             'Age Max': [60, 20], 'Death to Recovery (hrs.)': [0, 5], 'Death to Recovery Max (hrs.)': [0, 0],
+             'Death to Surgery (days)': [3, 3], 'Death to Surgery Max (days)': [6, 6],
+             'Death to Cooling (hrs.)': [0, 5], 'Death to Cooling Max (hrs.)': [0, 0]}
+    weights = {field: [1.0, 1.0] for field in scoring.SCORE_FIELDS}
+    # zero bounds: full weight when met, minus the weight when violated
+    cq, aq, drq, dsq, dcq = np.array([1, 1]), np.array([1, -0.5]), np.array([1, -1]), np.array([0.5, 0.5]), \
+        np.array([1, -1])
+    np.testing.assert_allclose(scoring.soft_requirement_scores(pairs, weights, 'Dynamic Reward'),
+                               cq + aq + drq + dsq + dcq)
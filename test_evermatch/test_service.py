@@ -0,0 +1,62 @@
+"""Updates and solves through the matching service must give the solutions of cold solves of the same data."""
+
+import asyncio
+import threading
+
+import pytest
+
+from evermatch import constants
+from evermatch.schemas import input_schema
+from evermatch.service import MatchingService, ServiceClient, ServiceError
+from helpers import quiet, solve_objective
+
+
+@pytest.fixture(params=['tcp', 'unix'])
+def transport(request):
+    return request.param
+
+
+def split(instance):
+    """:return: (base data with 3/4 of the tissues and requests, remaining tissues, remaining requests)."""
+    n_tissues, n_requests = len(instance.tissues) * 3 // 4, len(instance.requests) * 3 // 4
+    base = input_schema.copy_pan_dat(instance)
+    base.tissues = instance.tissues.iloc[:n_tissues]
+    base.requests = instance.requests.iloc[:n_requests]
+    return base, instance.tissues.iloc[n_tissues:], instance.requests.iloc[n_requests:]
+
+
+def test_round_trip(instance, transport, tmp_path, monkeypatch):
+    monkeypatch.setattr(constants, 'cache_path', tmp_path / 'cache')
+    base, tissues, requests = split(instance)
+    with quiet():
+        service = MatchingService(base)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    unix_socket = str(tmp_path / 'evermatch.sock') if transport == 'unix' else None
+    asyncio.run_coroutine_threadsafe(service.start(unix_socket=unix_socket), loop).result()
+    client = (ServiceClient(unix_socket=unix_socket) if unix_socket else
+              ServiceClient(port=service.address()[1]))
+    try:
+        with quiet():
+            assert client.health()['tissues'] == len(base.tissues)
+            for dat, delta in [(base, dict()), (instance, {'tissues': tissues, 'requests': requests})]:
+                response = client.solve(**delta)
+                status, obj_val = solve_objective(dat)
+                assert response['status'] == status == 'Optimal'
+                assert service.solver.opt_model.model_sln['obj_val'] == pytest.approx(obj_val)
+                matches = {(row['Tissue ID'], row['Request ID']) for row in response['rpt_matching']}
+                assert matches and matches <= set(service.solver.selected)
+            # no update since the last solve: the solution is reused
+            assert client.solve() == response
+            assert client.metrics()['cached_solves'] == 1
+            assert client.health()['tissues'] == len(instance.tissues)
+            with pytest.raises(ServiceError) as error:
+                client.delta(tissues=[{**tissues.iloc[0].to_dict(), 'Donor Age': 'old'}])
+            assert error.value.status == 400
+    finally:
+        client.close()
+        asyncio.run_coroutine_threadsafe(service.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
@@ -0,0 +1,72 @@
+"""A stage is reused exactly when its inputs and code are unchanged, and a reused solution is the same solution."""
+
+import os
+
+import pandas as pd
+import pytest
+
+import evermatch.solve_code as solve_code
+from evermatch import constants
+from evermatch import decomposition
+from evermatch import stage_cache
+from evermatch.schemas import input_schema
+from helpers import quiet, with_params
+
+
+@pytest.fixture
+def solve(tmp_path, monkeypatch):
+    """Solves a copy of the data, with the cache in tmp_path. :return: (solution, whether the model was solved)."""
+    monkeypatch.setattr(constants, 'cache_path', tmp_path)
+    solved = list()
+
+    def solve_by_components(*args, **kwargs):
+        solved.append(True)
+        return solve_by_components_(*args, **kwargs)
+
+    solve_by_components_ = decomposition.solve_by_components
+    monkeypatch.setattr(decomposition, 'solve_by_components', solve_by_components)
+
+    def rtn(dat):
+        solved.clear()
+        with quiet():
+            sln = solve_code.solve(input_schema.copy_pan_dat(dat))
+        return sln, bool(solved)
+
+    return rtn
+
+
+def entries(tmp_path):
+    """:return: dict {stage: number of cache entries}."""
+    root = tmp_path / 'stages'
+    return {stage: len(os.listdir(root / stage)) if (root / stage).is_dir() else 0 for stage in stage_cache.STAGES}
+
+
+def test_hit_and_invalidation(instance, solve, tmp_path, monkeypatch):
+    dat = with_params(instance, **{'Stage Cache': 'On'})
+    cold, solved = solve(dat)
+    assert solved
+    assert entries(tmp_path) == {'candidates': 1, 'costs': 1, 'scores': 1, 'solution': 1}
+    cached, solved = solve(dat)
+    assert not solved
+    pd.testing.assert_frame_equal(cached.rpt_matching, cold.rpt_matching)
+    assert entries(tmp_path) == {'candidates': 1, 'costs': 1, 'scores': 1, 'solution': 1}
+    # the scores depend on the reward type, the candidates and costs do not
+    assert solve(with_params(dat, **{'Reward Type': 'Fixed Reward'}))[1]
+    assert entries(tmp_path) == {'candidates': 1, 'costs': 1, 'scores': 2, 'solution': 2}
+    # every stage depends on the tissues
+    changed = input_schema.copy_pan_dat(dat)
+    changed.tissues.loc[0, 'Donor Age'] += 1
+    assert solve(changed)[1]
+    assert entries(tmp_path) == {'candidates': 2, 'costs': 2, 'scores': 3, 'solution': 3}
+    # a change to the scoring code invalidates the scores and the solution only
+    module_digest = stage_cache.module_digest
+    monkeypatch.setattr(stage_cache, 'module_digest',
+                        lambda module: 'changed' if module == 'scoring' else module_digest(module))
+    assert solve(dat)[1]
+    assert entries(tmp_path) == {'candidates': 2, 'costs': 2, 'scores': 4, 'solution': 4}
+
+
+def test_off(instance, solve, tmp_path):
+    assert solve(with_params(instance, **{'Stage Cache': 'Off'}))[1]
+    assert solve(with_params(instance, **{'Stage Cache': 'Off'}))[1]
+    assert not (tmp_path / 'stages').exists()
@@ -0,0 +1,23 @@
+"""Each scenario of a sweep must have the candidate pairs and optimal objective value of a cold solve of its data."""
+
+import pytest
+
+from evermatch import sweep
+from evermatch.schemas import input_schema
+from helpers import opt_input_data, quiet, solve_objective, with_params
+
+GRID = {'Cell Count Max Violation': ['0%', '20%'], 'Age Range Max Violation': ['0%', '10%'],
+        'Reward Type': ['Fixed Reward', 'Dynamic Reward']}
+
+
+def test_same_as_cold_solves(instance):
+    scenarios = sweep.parameter_grid(GRID)
+    with quiet():
+        kpis = sweep.sweep(input_schema.copy_pan_dat(instance), scenarios, workers=2)
+    assert len(kpis) == len(scenarios)
+    assert kpis['Candidate Pairs'].nunique() > 1
+    for overrides, (_, row) in zip(scenarios, kpis.iterrows()):
+        assert {name: row[name] for name in overrides} == overrides
+        dat = with_params(instance, **overrides)
+        assert row['Candidate Pairs'] == len(opt_input_data(dat)[0].edges)
+        assert (row['Status'], row['Objective Value']) == pytest.approx(solve_objective(dat))
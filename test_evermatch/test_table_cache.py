@@ -0,0 +1,102 @@
+"""Tables loaded from the binary cache must be equal to the tables that were saved, or parsed by TicDat."""
+
+import contextlib
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from evermatch import table_cache
+from evermatch.schemas import input_schema
+from helpers import DATA_PATH
+
+N = 4
+
+COLUMNS = {
+    'int': pd.Series(np.arange(N, dtype=np.int64)),
+    'int8': pd.Series(np.arange(N, dtype=np.int8)),
+    'float': pd.Series([0.5, np.nan, 2.0, -1.0]),
+    'bool': pd.Series([True, False, True, True]),
+    'datetime': pd.Series(pd.to_datetime(['2024-03-29', '2024-03-30', None, '2024-04-03'])),
+    'text': pd.Series(['a', np.nan, 'b', 'a'], dtype=object),
+    'blank text': pd.Series([np.nan] * N, dtype=object),
+    'string': pd.Series(['x', 'y', None, 'x'], dtype='string'),
+    'blank string': pd.Series([None] * N, dtype='string'),
+    'category': pd.Series(['PK', 'DMEK', None, 'PK'], dtype='category'),
+    'blank category': pd.Series([None] * N, dtype=pd.CategoricalDtype([])),
+    'masked int': pd.Series([1, None, 3, 4], dtype='Int64'),
+    'masked float': pd.Series([1.5, None, 3.0, 4.0], dtype='Float64'),
+    'masked bool': pd.Series([True, None, False, True], dtype='boolean')}
+
+
+def round_trip(df, tmp_path):
+    entry_path = str(tmp_path / 'entry')
+    table_cache._save_table(df, entry_path)
+    assert os.path.isdir(entry_path)
+    return table_cache._load_table(entry_path)
+
+
+@pytest.mark.parametrize('column', list(COLUMNS))
+def test_round_trip(column, tmp_path):
+    df = pd.DataFrame({column: COLUMNS[column]})
+    pd.testing.assert_frame_equal(round_trip(df, tmp_path), df)
+
+
+def test_empty_table(tmp_path):
+    df = pd.DataFrame({name: values.iloc[:0] for name, values in COLUMNS.items()})
+    pd.testing.assert_frame_equal(round_trip(df, tmp_path), df)
+
+
+def test_memory_mapped(tmp_path):
+    df = pd.DataFrame({name: COLUMNS[name] for name in ['int', 'float', 'text']})
+    loaded = round_trip(df, tmp_path)
+    for name in ['int', 'float']:
+        base = loaded[name].to_numpy()
+        while base is not None and not isinstance(base, np.memmap):
+            base = base.base
+        assert base is not None
+    # the mapping is private: changes to the frame are not written to the entry
+    loaded.loc[0, 'int'] = -1
+    assert table_cache._load_table(str(tmp_path / 'entry'))['int'][0] == 0
+
+
+@pytest.mark.parametrize('blank', [None, 'Hospital'])
+def test_create_pan_dat(blank, tmp_path):
+    dir_path = tmp_path / 'data'
+    dir_path.mkdir()
+    for file in (DATA_PATH / 'raw_data').glob('*.csv'):
+        df = pd.read_csv(file, dtype=str, keep_default_na=False)
+        if blank in df.columns:
+            df[blank] = ''
+        df.to_csv(dir_path / file.name, index=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        expected = input_schema.csv.create_pan_dat(str(dir_path))
+        # parsed and saved, then loaded from the cache
+        for _ in range(2):
+            dat = table_cache.create_pan_dat(input_schema, dir_path, tmp_path / 'cache')
+            for table in input_schema.all_tables:
+                pd.testing.assert_frame_equal(getattr(dat, table), getattr(expected, table))
+    assert len(os.listdir(tmp_path / 'cache' / 'tables')) == len(input_schema.all_tables)
+
+
+def test_evict_least_recently_used(tmp_path, monkeypatch):
+    df = pd.DataFrame({name: COLUMNS[name] for name in ['int', 'float', 'text']})
+    root = tmp_path / 'tables'
+    for name, mtime in [('a', 1000), ('b', 2000)]:
+        table_cache._save_table(df, str(root / name))
+        os.utime(root / name, (mtime, mtime))
+    entry_bytes = sum(f.stat().st_size for f in os.scandir(root / 'a'))
+    assert table_cache._load_table(str(root / 'a')) is not None
+    monkeypatch.setattr(table_cache, 'MAX_BYTES', 2 * entry_bytes)
+    table_cache._save_table(df, str(root / 'c'))
+    assert sorted(os.listdir(root)) == ['a', 'c']
+
+
+def test_code_change(tmp_path, monkeypatch):
+    with contextlib.redirect_stdout(io.StringIO()):
+        table_cache.create_pan_dat(input_schema, DATA_PATH / 'raw_data', tmp_path)
+        monkeypatch.setattr(table_cache, 'module_digest', lambda module: 'changed')
+        table_cache.create_pan_dat(input_schema, DATA_PATH / 'raw_data', tmp_path)
+    assert len(os.listdir(tmp_path / 'tables')) == 2 * len(input_schema.all_tables)
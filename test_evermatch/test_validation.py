@@ -0,0 +1,69 @@
+"""The vectorized, memoized data integrity checks must find the same failures as the TicDat functions."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from evermatch import validation
+from evermatch.indexing import intern_tables
+from evermatch.schemas import id_domains, input_schema, vectorized_row_predicates
+
+
+def ticdat_failures(dat):
+    return (input_schema.find_data_type_failures(dat), input_schema.find_data_row_failures(dat),
+            input_schema.find_foreign_key_failures(dat))
+
+
+def assert_same_failures(rtn, expected):
+    for failures, expected_failures in zip(rtn, expected):
+        assert set(failures) == set(expected_failures)
+        for key, rows in expected_failures.items():
+            pd.testing.assert_frame_equal(failures[key].sort_index(), rows.sort_index(), check_dtype=False,
+                                          check_categorical=False)
+
+
+def dirty(dat):
+    """:return: A copy of dat with failures of every kind."""
+    rtn = input_schema.copy_pan_dat(dat)
+    tissues = rtn.tissues
+    tissues.loc[0, 'Donor Age'] = -5  # out of range
+    tissues.loc[1, 'Cell Count'] = 2500.5  # not an integer
+    tissues.loc[2, 'Clear Zone'] = np.nan  # not nullable
+    tissues.loc[3, 'Current Site ID'] = 'Nowhere'  # foreign key
+    requests = rtn.requests
+    requests.loc[0, 'Tissue Use'] = 'Cornea'  # not an allowed string
+    requests.loc[1, ['Age Min', 'Age Max']] = [80, 20]  # row predicate
+    requests.loc[2, 'Surgeon ID'] = 'Nobody'  # foreign key
+    rtn.surgeons_pref.loc[0, 'Age Range'] += 0.1  # scores do not add up to 1
+    rtn.parameters = pd.concat([rtn.parameters, pd.DataFrame({'Parameter': ['Unknown', 'MIP Gap'],
+                                                              'Value': ['1', 'Large']})], ignore_index=True)
+    return rtn
+
+
+@pytest.mark.parametrize('interned', [False, True])
+@pytest.mark.parametrize('kind', ['clean', 'dirty'])
+def test_same_failures(kind, interned, instance, reference, tmp_path):
+    dat = instance if kind == 'clean' else dirty(reference)
+    dat = input_schema.copy_pan_dat(dat)
+    if interned:
+        intern_tables(dat, id_domains)
+    expected = ticdat_failures(dat)
+    assert any(expected) == (kind == 'dirty')
+    # checked, then read from the cache
+    for _ in range(2):
+        assert_same_failures(validation.find_failures(dat, input_schema, tmp_path), expected)
+    # appended rows only are checked
+    dat.tissues = pd.concat([dat.tissues, dirty(reference).tissues.iloc[:4]], ignore_index=True)
+    assert_same_failures(validation.find_failures(dat, input_schema, tmp_path), ticdat_failures(dat))
+
+
+def test_predicate_change(monkeypatch):
+    digest = validation._schema_digest(input_schema)
+    key = 'surgeons_pref', 'Scores add up to 1.0'
+    score_fields = ['Cell Count Min', 'Age Range']
+    monkeypatch.setitem(vectorized_row_predicates, key,
+                        lambda df: (df[score_fields].sum(axis=1, skipna=False) - 1).abs() < 1e-3)
+    changed = validation._schema_digest(input_schema)
+    monkeypatch.setitem(vectorized_row_predicates, key,
+                        lambda df: (df[score_fields].sum(axis=1, skipna=False) - 1).abs() < 1e-2)
+    assert len({digest, changed, validation._schema_digest(input_schema)}) == 3